@@ -0,0 +1,43 @@
+#!/usr/bin/env python3
+"""
+Script para preparar la base de datos para los KPIs de la flota:
+tabla AgregadoPartes (cubo por día, semana y mes) calculada desde los partes existentes
+"""
+
+import os
+from sqlmodel import SQLModel, Session, create_engine, select
+from app.models import AgregadoPartes, Company
+from app.agregados import reconstruir
+
+DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///app_nueva.db")
+
+if DATABASE_URL.startswith("postgres://"):
+    DATABASE_URL = DATABASE_URL.replace("postgres://", "postgresql://", 1)
+
+engine = create_engine(DATABASE_URL)
+
+def actualizar_bd():
+    print("🔄 Actualizando base de datos para los KPIs de la flota...")
+
+    try:
+        SQLModel.metadata.create_all(engine, tables=[AgregadoPartes.__table__])
+        print("✅ Tabla AgregadoPartes creada")
+
+        with Session(engine) as db:
+            empresas = db.exec(select(Company)).all()
+            for company in empresas:
+                reconstruir(db, company.id)
+                db.commit()
+                print(f"✅ Agregados de '{company.name}' calculados")
+
+    except Exception as e:
+        print(f"❌ Error al actualizar la base de datos: {e}")
+        return False
+
+    return True
+
+if __name__ == "__main__":
+    if actualizar_bd():
+        print("🎉 Base de datos actualizada correctamente")
+    else:
+        print("💥 Error en la actualización")
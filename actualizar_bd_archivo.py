@@ -0,0 +1,44 @@
+#!/usr/bin/env python3
+"""
+Script para preparar la base de datos para el archivo de meses antiguos:
+tabla ArchivoMes (catálogo de los ficheros Parquet).
+
+Con --archivar-ahora archiva además los meses pendientes sin esperar al
+archivador automático.
+"""
+
+import os
+import sys
+from sqlmodel import SQLModel, create_engine
+from app.models import ArchivoMes
+
+DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///app_nueva.db")
+
+if DATABASE_URL.startswith("postgres://"):
+    DATABASE_URL = DATABASE_URL.replace("postgres://", "postgresql://", 1)
+
+engine = create_engine(DATABASE_URL)
+
+def actualizar_bd(archivar_ahora: bool = False):
+    print("🔄 Actualizando base de datos para el archivo de meses antiguos...")
+
+    try:
+        SQLModel.metadata.create_all(engine, tables=[ArchivoMes.__table__])
+        print("✅ Tabla ArchivoMes creada")
+
+        if archivar_ahora:
+            from app.archivo import archivar_pendientes, DIRECTORIO
+            n = archivar_pendientes(engine)
+            print(f"✅ {n} partes archivados en {DIRECTORIO}")
+
+    except Exception as e:
+        print(f"❌ Error al actualizar la base de datos: {e}")
+        return False
+
+    return True
+
+if __name__ == "__main__":
+    if actualizar_bd("--archivar-ahora" in sys.argv):
+        print("🎉 Base de datos actualizada correctamente")
+    else:
+        print("💥 Error en la actualización")
@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+"""
+Script para preparar la base de datos para el cierre de mes:
+tabla CierreMes e índice único de ParteMensual por repartidor y mes
+"""
+
+import os
+from sqlmodel import SQLModel, create_engine, text
+from app.models import CierreMes
+
+DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///app_nueva.db")
+
+if DATABASE_URL.startswith("postgres://"):
+    DATABASE_URL = DATABASE_URL.replace("postgres://", "postgresql://", 1)
+
+engine = create_engine(DATABASE_URL)
+
+def actualizar_bd():
+    print("🔄 Actualizando base de datos para el cierre de mes...")
+
+    try:
+        SQLModel.metadata.create_all(engine, tables=[CierreMes.__table__])
+        print("✅ Tabla CierreMes creada")
+
+        with engine.begin() as conn:
+            duplicados = conn.execute(text("""
+                SELECT user_id, "año", mes, COUNT(*) FROM partemensual
+                GROUP BY user_id, "año", mes HAVING COUNT(*) > 1
+            """)).all()
+            if duplicados:
+                print("❌ Hay partes mensuales duplicados, corrígelos antes de continuar:")
+                for user_id, año, mes, n in duplicados:
+                    print(f"  - usuario {user_id}, {mes:02d}/{año}: {n} filas")
+                return False
+
+            conn.execute(text(
+                'CREATE UNIQUE INDEX IF NOT EXISTS uq_partemensual_user_mes ON partemensual (user_id, "año", mes)'
+            ))
+            print("✅ Índice único de ParteMensual creado")
+
+    except Exception as e:
+        print(f"❌ Error al actualizar la base de datos: {e}")
+        return False
+
+    return True
+
+if __name__ == "__main__":
+    if actualizar_bd():
+        print("🎉 Base de datos actualizada correctamente")
+    else:
+        print("💥 Error en la actualización")
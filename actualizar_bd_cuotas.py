@@ -0,0 +1,35 @@
+#!/usr/bin/env python3
+"""
+Script para preparar la base de datos para las cuotas por empresa: tabla
+UsoEmpresa (filas exportadas e importadas por empresa y hora)
+"""
+
+import os
+from sqlmodel import SQLModel, create_engine
+from app.models import UsoEmpresa
+
+DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///app_nueva.db")
+
+if DATABASE_URL.startswith("postgres://"):
+    DATABASE_URL = DATABASE_URL.replace("postgres://", "postgresql://", 1)
+
+engine = create_engine(DATABASE_URL)
+
+def actualizar_bd():
+    print("🔄 Actualizando base de datos para las cuotas por empresa...")
+
+    try:
+        SQLModel.metadata.create_all(engine, tables=[UsoEmpresa.__table__])
+        print("✅ Tabla UsoEmpresa creada")
+
+    except Exception as e:
+        print(f"❌ Error al actualizar la base de datos: {e}")
+        return False
+
+    return True
+
+if __name__ == "__main__":
+    if actualizar_bd():
+        print("🎉 Base de datos actualizada correctamente")
+    else:
+        print("💥 Error en la actualización")
@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+"""
+Script para preparar la base de datos para la lectura incremental de integraciones:
+columna fecha_actualizacion en ParteDia, índices de keyset y tabla TokenApi
+"""
+
+import os
+from datetime import datetime
+from sqlalchemy import inspect
+from sqlmodel import SQLModel, create_engine, text
+from app.models import TokenApi
+
+DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///app_nueva.db")
+
+if DATABASE_URL.startswith("postgres://"):
+    DATABASE_URL = DATABASE_URL.replace("postgres://", "postgresql://", 1)
+
+engine = create_engine(DATABASE_URL)
+
+def actualizar_bd():
+    print("🔄 Actualizando base de datos para las integraciones...")
+
+    try:
+        SQLModel.metadata.create_all(engine, tables=[TokenApi.__table__])
+        print("✅ Tabla TokenApi creada")
+
+        columnas = {c["name"] for c in inspect(engine).get_columns("partedia")}
+        with engine.begin() as conn:
+            if "fecha_actualizacion" not in columnas:
+                conn.execute(text("ALTER TABLE partedia ADD COLUMN fecha_actualizacion TIMESTAMP"))
+                # Los partes existentes cuentan como actualizados ahora
+                conn.execute(
+                    text("UPDATE partedia SET fecha_actualizacion = :ahora WHERE fecha_actualizacion IS NULL"),
+                    {"ahora": datetime.now()},
+                )
+                print("✅ Columna partedia.fecha_actualizacion creada")
+            conn.execute(text(
+                "CREATE INDEX IF NOT EXISTS ix_partedia_company_actualizacion ON partedia (company_id, fecha_actualizacion, id)"
+            ))
+            conn.execute(text(
+                "CREATE INDEX IF NOT EXISTS ix_partemensual_company_actualizacion ON partemensual (company_id, fecha_actualizacion, id)"
+            ))
+            conn.execute(text(
+                "CREATE INDEX IF NOT EXISTS ix_cambioparte_company_fecha ON cambioparte (company_id, fecha, id)"
+            ))
+            print("✅ Índices de lectura incremental creados")
+
+    except Exception as e:
+        print(f"❌ Error al actualizar la base de datos: {e}")
+        return False
+
+    return True
+
+if __name__ == "__main__":
+    if actualizar_bd():
+        print("🎉 Base de datos actualizada correctamente")
+        print("📝 Crea un token desde el panel de administración para conectar el ERP")
+    else:
+        print("💥 Error en la actualización")
@@ -0,0 +1,45 @@
+#!/usr/bin/env python3
+"""
+Script para preparar la base de datos para la revisión de cuentakilómetros:
+tablas AnomaliaParte (incidencias detectadas) y RevisionOdometro (hasta dónde
+se ha revisado cada empresa).
+
+Con --revisar-ahora revisa además todos los partes sin esperar a la revisión
+automática (la primera vez se revisa el histórico completo).
+"""
+
+import os
+import sys
+from sqlmodel import SQLModel, create_engine
+from app.models import AnomaliaParte, RevisionOdometro
+
+DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///app_nueva.db")
+
+if DATABASE_URL.startswith("postgres://"):
+    DATABASE_URL = DATABASE_URL.replace("postgres://", "postgresql://", 1)
+
+engine = create_engine(DATABASE_URL)
+
+def actualizar_bd(revisar_ahora: bool = False):
+    print("🔄 Actualizando base de datos para la revisión de cuentakilómetros...")
+
+    try:
+        SQLModel.metadata.create_all(engine, tables=[AnomaliaParte.__table__, RevisionOdometro.__table__])
+        print("✅ Tablas AnomaliaParte y RevisionOdometro creadas")
+
+        if revisar_ahora:
+            from app.odometro import revisar_todas
+            n = revisar_todas(engine)
+            print(f"✅ Revisión completada: {n} anomalías")
+
+    except Exception as e:
+        print(f"❌ Error al actualizar la base de datos: {e}")
+        return False
+
+    return True
+
+if __name__ == "__main__":
+    if actualizar_bd("--revisar-ahora" in sys.argv):
+        print("🎉 Base de datos actualizada correctamente")
+    else:
+        print("💥 Error en la actualización")
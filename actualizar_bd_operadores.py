@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+"""
+Script para añadir la columna es_operador a User y marcar o desmarcar a los
+operadores de la plataforma (acceso a /operador/*: uso de todas las empresas y
+capturas de perfilado). No se puede conseguir desde la aplicación.
+
+    python actualizar_bd_operadores.py                  # solo la columna
+    python actualizar_bd_operadores.py --marcar 12      # user.id 12 es operador
+    python actualizar_bd_operadores.py --desmarcar 12
+"""
+
+import os, sys
+from sqlalchemy import inspect
+from sqlmodel import create_engine, text
+
+DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///app_nueva.db")
+
+if DATABASE_URL.startswith("postgres://"):
+    DATABASE_URL = DATABASE_URL.replace("postgres://", "postgresql://", 1)
+
+engine = create_engine(DATABASE_URL)
+
+def actualizar_bd():
+    print("🔄 Actualizando base de datos para los operadores de la plataforma...")
+
+    columnas = {c["name"] for c in inspect(engine).get_columns("user")}
+
+    try:
+        with engine.begin() as conn:
+            if "es_operador" not in columnas:
+                conn.execute(text('ALTER TABLE "user" ADD COLUMN es_operador BOOLEAN NOT NULL DEFAULT FALSE'))
+                print("✅ Columna es_operador creada (nadie es operador)")
+            else:
+                print("ℹ️ La columna es_operador ya existía")
+
+    except Exception as e:
+        print(f"❌ Error al actualizar la base de datos: {e}")
+        return False
+
+    return True
+
+def marcar_operador(user_id: int, valor: bool):
+    with engine.begin() as conn:
+        fila = conn.execute(
+            text('UPDATE "user" SET es_operador = :valor WHERE id = :id RETURNING username, company_id'),
+            {"valor": valor, "id": user_id},
+        ).first()
+    if fila is None:
+        print(f"❌ No existe el usuario {user_id}")
+        return False
+    print(f"✅ {fila.username} (empresa {fila.company_id}) {'es' if valor else 'ya no es'} operador")
+    return True
+
+if __name__ == "__main__":
+    ok = actualizar_bd()
+    if ok and len(sys.argv) == 3 and sys.argv[1] in ("--marcar", "--desmarcar"):
+        ok = marcar_operador(int(sys.argv[2]), sys.argv[1] == "--marcar")
+    if ok:
+        print("🎉 Base de datos actualizada correctamente")
+    else:
+        print("💥 Error en la actualización")
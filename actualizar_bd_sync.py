@@ -0,0 +1,46 @@
+#!/usr/bin/env python3
+"""
+Script para preparar la base de datos para la sincronización offline:
+columna client_id en ParteDia y tablas CambioParte y ClaveIdempotencia
+"""
+
+import os
+from sqlalchemy import inspect
+from sqlmodel import SQLModel, create_engine, text
+from app.models import CambioParte, ClaveIdempotencia
+
+DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///app_nueva.db")
+
+if DATABASE_URL.startswith("postgres://"):
+    DATABASE_URL = DATABASE_URL.replace("postgres://", "postgresql://", 1)
+
+engine = create_engine(DATABASE_URL)
+
+def actualizar_bd():
+    print("🔄 Actualizando base de datos para la sincronización offline...")
+
+    try:
+        SQLModel.metadata.create_all(engine, tables=[CambioParte.__table__, ClaveIdempotencia.__table__])
+        print("✅ Tablas CambioParte y ClaveIdempotencia creadas")
+
+        columnas = {c["name"] for c in inspect(engine).get_columns("partedia")}
+        with engine.begin() as conn:
+            if "client_id" not in columnas:
+                conn.execute(text("ALTER TABLE partedia ADD COLUMN client_id VARCHAR"))
+                print("✅ Columna partedia.client_id creada")
+            conn.execute(text(
+                "CREATE UNIQUE INDEX IF NOT EXISTS uq_partedia_user_client_id ON partedia (user_id, client_id)"
+            ))
+
+    except Exception as e:
+        print(f"❌ Error al actualizar la base de datos: {e}")
+        return False
+
+    return True
+
+if __name__ == "__main__":
+    if actualizar_bd():
+        print("🎉 Base de datos actualizada correctamente")
+        print("📝 Los partes existentes aparecerán en la primera sincronización cuando se modifiquen")
+    else:
+        print("💥 Error en la actualización")
@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+"""
+Script para añadir las horas normalizadas y la duración en minutos a
+ParteDia y Ruta, rellenándolas a partir de los textos antiguos
+"""
+
+import os
+from sqlalchemy import bindparam, inspect, select, update
+from sqlmodel import create_engine, text
+from app.models import ParteDia, Ruta
+from app.tiempos import normalizar_tiempos
+
+DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///app_nueva.db")
+
+if DATABASE_URL.startswith("postgres://"):
+    DATABASE_URL = DATABASE_URL.replace("postgres://", "postgresql://", 1)
+
+engine = create_engine(DATABASE_URL)
+
+TAMAÑO_LOTE = 1000
+
+class _Fila:
+    """Contenedor mínimo para reutilizar normalizar_tiempos sin cargar el modelo completo"""
+    def __init__(self, salida_hora, llegada_hora):
+        self.salida_hora = salida_hora
+        self.llegada_hora = llegada_hora
+
+def _añadir_columnas(conn, tabla: str):
+    columnas = {c["name"] for c in inspect(conn).get_columns(tabla)}
+    for nombre, tipo in (("salida_hora_norm", "TIME"), ("llegada_hora_norm", "TIME"), ("duracion_minutos", "INTEGER")):
+        if nombre not in columnas:
+            conn.execute(text(f"ALTER TABLE {tabla} ADD COLUMN {nombre} {tipo}"))
+            print(f"✅ Columna {tabla}.{nombre} creada")
+    conn.execute(text(f"CREATE INDEX IF NOT EXISTS ix_{tabla}_duracion_minutos ON {tabla} (duracion_minutos)"))
+
+def _rellenar(conn, modelo, con_tiempo_total: bool):
+    tabla = modelo.__table__
+    columnas = [tabla.c.id, tabla.c.salida_hora, tabla.c.llegada_hora]
+    if con_tiempo_total:
+        columnas.append(tabla.c.tiempo_total)
+
+    stmt = (
+        update(tabla)
+        .where(tabla.c.id == bindparam("b_id"))
+        .values(
+            salida_hora_norm=bindparam("b_salida"),
+            llegada_hora_norm=bindparam("b_llegada"),
+            duracion_minutos=bindparam("b_duracion"),
+        )
+    )
+
+    total = sin_interpretar = 0
+    ultimo_id = 0
+    while True:
+        filas = conn.execute(
+            select(*columnas).where(tabla.c.id > ultimo_id).order_by(tabla.c.id).limit(TAMAÑO_LOTE)
+        ).all()
+        if not filas:
+            break
+        cambios = []
+        for fila in filas:
+            f = _Fila(fila.salida_hora, fila.llegada_hora)
+            normalizar_tiempos(f, fila.tiempo_total if con_tiempo_total else None)
+            if (fila.salida_hora and f.salida_hora_norm is None) or (fila.llegada_hora and f.llegada_hora_norm is None):
+                sin_interpretar += 1
+            cambios.append({
+                "b_id": fila.id,
+                "b_salida": f.salida_hora_norm,
+                "b_llegada": f.llegada_hora_norm,
+                "b_duracion": f.duracion_minutos,
+            })
+        conn.execute(stmt, cambios)
+        total += len(filas)
+        ultimo_id = filas[-1].id
+
+    print(f"✅ {tabla.name}: {total} filas procesadas, {sin_interpretar} con horas que no se pudieron interpretar")
+
+def actualizar_bd():
+    print("🔄 Actualizando base de datos con horas normalizadas y duraciones...")
+
+    try:
+        with engine.begin() as conn:
+            _añadir_columnas(conn, "partedia")
+            _añadir_columnas(conn, "ruta")
+        with engine.begin() as conn:
+            _rellenar(conn, ParteDia, con_tiempo_total=True)
+            _rellenar(conn, Ruta, con_tiempo_total=False)
+
+    except Exception as e:
+        print(f"❌ Error al actualizar la base de datos: {e}")
+        return False
+
+    return True
+
+if __name__ == "__main__":
+    if actualizar_bd():
+        print("🎉 Base de datos actualizada correctamente")
+    else:
+        print("💥 Error en la actualización")
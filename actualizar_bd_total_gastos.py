@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+"""
+Script para añadir la columna total_gastos a ParteDia y rellenarla
+con la suma de los gastos de los partes ya existentes
+"""
+
+import os
+from sqlalchemy import inspect
+from sqlmodel import create_engine, text
+from app.models import GASTOS_CAMPOS
+
+DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///app_nueva.db")
+
+if DATABASE_URL.startswith("postgres://"):
+    DATABASE_URL = DATABASE_URL.replace("postgres://", "postgresql://", 1)
+
+engine = create_engine(DATABASE_URL)
+
+def actualizar_bd():
+    print("🔄 Actualizando base de datos para añadir total_gastos...")
+
+    columnas = {c["name"] for c in inspect(engine).get_columns("partedia")}
+    suma = " + ".join(f"COALESCE({campo}, 0)" for campo in GASTOS_CAMPOS)
+
+    try:
+        with engine.begin() as conn:
+            if "total_gastos" not in columnas:
+                conn.execute(text("ALTER TABLE partedia ADD COLUMN total_gastos FLOAT NOT NULL DEFAULT 0"))
+                print("✅ Columna total_gastos creada")
+            else:
+                print("ℹ️ La columna total_gastos ya existía, solo se recalcula")
+
+            resultado = conn.execute(text(f"UPDATE partedia SET total_gastos = {suma}"))
+            print(f"✅ {resultado.rowcount} partes recalculados")
+
+            conn.execute(text("CREATE INDEX IF NOT EXISTS ix_partedia_total_gastos ON partedia (total_gastos)"))
+            conn.execute(text(
+                "CREATE INDEX IF NOT EXISTS ix_partedia_company_total_gastos "
+                "ON partedia (company_id, total_gastos)"
+            ))
+            print("✅ Índices de total_gastos creados")
+
+    except Exception as e:
+        print(f"❌ Error al actualizar la base de datos: {e}")
+        return False
+
+    return True
+
+if __name__ == "__main__":
+    if actualizar_bd():
+        print("🎉 Base de datos actualizada correctamente")
+    else:
+        print("💥 Error en la actualización")
@@ -0,0 +1,41 @@
+#!/usr/bin/env python3
+"""
+Script para añadir la columna version a ParteDia (control de concurrencia
+optimista: ver app/concurrencia.py)
+"""
+
+import os
+from sqlalchemy import inspect
+from sqlmodel import create_engine, text
+
+DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///app_nueva.db")
+
+if DATABASE_URL.startswith("postgres://"):
+    DATABASE_URL = DATABASE_URL.replace("postgres://", "postgresql://", 1)
+
+engine = create_engine(DATABASE_URL)
+
+def actualizar_bd():
+    print("🔄 Actualizando base de datos para añadir la versión de los partes...")
+
+    columnas = {c["name"] for c in inspect(engine).get_columns("partedia")}
+
+    try:
+        with engine.begin() as conn:
+            if "version" not in columnas:
+                conn.execute(text("ALTER TABLE partedia ADD COLUMN version INTEGER NOT NULL DEFAULT 1"))
+                print("✅ Columna version creada (los partes existentes empiezan en 1)")
+            else:
+                print("ℹ️ La columna version ya existía")
+
+    except Exception as e:
+        print(f"❌ Error al actualizar la base de datos: {e}")
+        return False
+
+    return True
+
+if __name__ == "__main__":
+    if actualizar_bd():
+        print("🎉 Base de datos actualizada correctamente")
+    else:
+        print("💥 Error en la actualización")
@@ -0,0 +1,290 @@
+from __future__ import annotations
+import asyncio, json, math, os, threading, time
+from collections import OrderedDict, defaultdict, deque
+from datetime import date
+from typing import Deque, Dict, List, Optional, Tuple
+from urllib.parse import parse_qs
+from sqlalchemy.engine import Engine
+from sqlmodel import Session, select
+from starlette.concurrency import run_in_threadpool
+from .models import TokenApi, User
+from .auth import SESSION_KEY, hash_token
+
+# Control de admisión: las peticiones de los repartidores no pueden quedarse sin
+# hilos ni conexiones por culpa de los informes.
+#
+# Cada petición se clasifica por su ruta en interactiva (páginas y API del
+# repartidor, login, panel con rangos normales...) o pesada (exportaciones,
+# importación, analítica, panel con rangos largos). Cada clase tiene un número
+# fijo de plazas y una cola de espera acotada: si la cola está llena, o la
+# petición espera más de lo permitido, se responde 503 con Retry-After en vez de
+# acumular trabajo. Las plazas de las dos clases juntas no pasan del pool de
+# hilos (40 en anyio), así que una tanda de exportaciones nunca deja sin hilo a
+# un repartidor, y las pesadas ocupan como mucho ADMISION_PESADAS conexiones.
+#
+# En las pesadas además cada empresa tiene una cola propia y como mucho
+# CUOTA_PESADAS_EMPRESA plazas: las que se liberan se reparten por turno entre
+# las empresas que esperan, así una empresa con muchas exportaciones no deja sin
+# turno a las demás (ver también las cuotas por hora en app/cuotas.py).
+#
+# Los límites son por proceso (cada worker de gunicorn tiene los suyos).
+
+RANGO_LARGO_DIAS = int(os.getenv("ADMISION_RANGO_LARGO_DIAS", "62"))
+
+INTERACTIVA, PESADA = "interactiva", "pesada"
+
+# Sin control: estáticos, comprobación de salud y el directo (conexión larga, ver app/directo.py)
+_LIBRES = ("/static/", "/sw.js", "/health", "/admin/directo")
+_PESADAS = ("/admin/export/", "/api/export/", "/admin/import", "/admin/analytics", "/admin/duraciones")
+
+def _rango_largo(query_string: bytes) -> bool:
+    params = parse_qs(query_string.decode("latin-1"))
+    try:
+        desde = date.fromisoformat(params["desde"][0])
+        hasta = date.fromisoformat(params.get("hasta", [date.today().isoformat()])[0])
+    except (KeyError, ValueError):
+        return False  # sin rango (o inválido) el panel muestra un mes
+    return (hasta - desde).days > RANGO_LARGO_DIAS
+
+def clasificar(path: str, query_string: bytes = b"") -> Optional[str]:
+    """Clase de la petición, o None si no pasa por el control"""
+    if path.startswith(_LIBRES):
+        return None
+    if path.startswith(_PESADAS):
+        return PESADA
+    if path == "/admin" and _rango_largo(query_string):
+        return PESADA
+    return INTERACTIVA
+
+class Plazas:
+    """Plazas de una clase de peticiones con cola de espera acotada. Cada empresa
+    tiene su cola y las plazas que se liberan se dan por turno (round-robin) a
+    las empresas que esperan, sin pasar de `por_empresa` plazas por empresa. Se
+    puede usar desde varios bucles de eventos: las plazas se pasan al siguiente
+    en su propio bucle."""
+
+    def __init__(self, nombre: str, plazas: int, cola: int, espera: float, por_empresa: int = 0):
+        self.nombre = nombre
+        self.plazas = plazas  # 0 = sin límite
+        self.cola = cola
+        self.espera = espera
+        self.por_empresa = por_empresa  # 0 = sin límite
+        self.ocupadas = 0
+        self._en_uso: Dict[Optional[int], int] = defaultdict(int)
+        # El orden del diccionario es el turno: la empresa atendida pasa al final
+        self._colas: "OrderedDict[Optional[int], Deque[asyncio.Future]]" = OrderedDict()
+        self._en_cola = 0
+        self._lock = threading.Lock()
+        # Métricas
+        self.admitidas = 0
+        self.rechazadas_cola = 0
+        self.rechazadas_espera = 0
+        self.esperas = 0
+        self.segundos_espera = 0.0
+        self.max_cola = 0
+
+    @property
+    def reintentar_en(self) -> int:
+        return max(1, math.ceil(self.espera))
+
+    def _cabe(self, empresa: Optional[int]) -> bool:
+        if self.ocupadas >= self.plazas:
+            return False
+        return self.por_empresa <= 0 or empresa is None or self._en_uso[empresa] < self.por_empresa
+
+    def _ocupar(self, empresa: Optional[int]):
+        self.ocupadas += 1
+        self._en_uso[empresa] += 1
+
+    async def entrar(self, empresa: Optional[int] = None) -> bool:
+        """True si se consigue plaza; False si hay que rechazar la petición"""
+        if self.plazas <= 0:
+            return True
+        with self._lock:
+            if self._cabe(empresa) and not self._colas.get(empresa):
+                self._ocupar(empresa)
+                self.admitidas += 1
+                return True
+            if self._en_cola >= self.cola:
+                self.rechazadas_cola += 1
+                return False
+            futuro = asyncio.get_running_loop().create_future()
+            self._colas.setdefault(empresa, deque()).append(futuro)
+            self._en_cola += 1
+            self.max_cola = max(self.max_cola, self._en_cola)
+
+        inicio = time.monotonic()
+        try:
+            await asyncio.wait_for(futuro, self.espera)
+        except BaseException as e:
+            with self._lock:
+                cola = self._colas.get(empresa)
+                if cola is not None and futuro in cola:
+                    cola.remove(futuro)
+                    self._en_cola -= 1
+                    if not cola:
+                        del self._colas[empresa]
+            if futuro.done() and not futuro.cancelled():
+                self.salir(empresa)  # la plaza llegó justo cuando se cancelaba la petición
+            if isinstance(e, asyncio.TimeoutError):
+                with self._lock:
+                    self.rechazadas_espera += 1
+                return False
+            raise
+        with self._lock:
+            self.admitidas += 1
+            self.esperas += 1
+            self.segundos_espera += time.monotonic() - inicio
+        return True
+
+    def salir(self, empresa: Optional[int] = None):
+        """Libera la plaza y se la da a quien le toque"""
+        if self.plazas <= 0:
+            return
+        with self._lock:
+            self.ocupadas -= 1
+            self._en_uso[empresa] -= 1
+            if not self._en_uso[empresa]:
+                del self._en_uso[empresa]
+            siguientes = self._siguientes()
+        for futuro, siguiente in siguientes:
+            futuro.get_loop().call_soon_threadsafe(self._despertar, futuro, siguiente)
+
+    def _siguientes(self) -> List[Tuple[asyncio.Future, Optional[int]]]:
+        """Con el lock: a quién se dan las plazas libres, por turno de empresa"""
+        elegidos = []
+        while self._colas:
+            empresa = next((e for e in self._colas if self._cabe(e)), _NINGUNA)
+            if empresa is _NINGUNA:
+                break  # no hay plazas, o todas las que esperan están en su límite
+            cola = self._colas.pop(empresa)
+            futuro = cola.popleft()
+            self._en_cola -= 1
+            if cola:
+                self._colas[empresa] = cola  # al final del turno
+            if not futuro.done():
+                self._ocupar(empresa)
+                elegidos.append((futuro, empresa))
+        return elegidos
+
+    def _despertar(self, futuro: asyncio.Future, empresa: Optional[int]):
+        if futuro.done():
+            self.salir(empresa)  # se ha rendido mientras tanto
+        else:
+            futuro.set_result(None)
+
+    def estado(self) -> dict:
+        with self._lock:
+            datos = {
+                "plazas": self.plazas,
+                "ocupadas": self.ocupadas,
+                "en_cola": self._en_cola,
+                "cola_maxima": self.cola,
+                "max_cola_observada": self.max_cola,
+                "admitidas": self.admitidas,
+                "rechazadas_cola_llena": self.rechazadas_cola,
+                "rechazadas_espera": self.rechazadas_espera,
+                "espera_media_ms": round(self.segundos_espera / self.esperas * 1000, 1) if self.esperas else 0.0,
+            }
+            if self.por_empresa > 0:
+                datos["por_empresa"] = self.por_empresa
+                datos["empresas"] = {
+                    str(e): {"ocupadas": self._en_uso.get(e, 0), "en_cola": len(self._colas.get(e, ()))}
+                    for e in set(self._en_uso) | set(self._colas) if e is not None
+                }
+            return datos
+
+_NINGUNA = object()
+
+def _config(nombre: str, prefijo: str, plazas: int, cola: int, espera: float, por_empresa: int = 0) -> Plazas:
+    return Plazas(
+        nombre,
+        int(os.getenv(prefijo, str(plazas))),
+        int(os.getenv(f"{prefijo}_COLA", str(cola))),
+        float(os.getenv(f"{prefijo}_ESPERA", str(espera))),
+        por_empresa,
+    )
+
+clases: Dict[str, Plazas] = {
+    INTERACTIVA: _config(INTERACTIVA, "ADMISION_INTERACTIVAS", 32, 200, 5),
+    PESADA: _config(PESADA, "ADMISION_PESADAS", 4, 8, 15, int(os.getenv("CUOTA_PESADAS_EMPRESA", "2"))),
+}
+
+# ---------------------------------------------------------------------------
+# Empresa de la petición (solo hace falta en las clases con límite por empresa)
+
+_engine: Optional[Engine] = None
+_empresas: Dict[Tuple[str, object], Optional[int]] = {}  # el usuario o token no cambia de empresa
+MAX_EMPRESAS_CACHE = 10000
+
+def conectar(engine: Engine):
+    global _engine
+    _engine = engine
+
+def _clave_empresa(scope) -> Optional[Tuple[str, object]]:
+    user_id = (scope.get("session") or {}).get(SESSION_KEY)
+    if user_id:
+        return ("usuario", user_id)
+    for nombre, valor in scope["headers"]:
+        if nombre == b"authorization" and valor[:7].lower() == b"bearer ":
+            return ("token", hash_token(valor[7:].decode("latin-1").strip()))
+    return None
+
+def _buscar_empresa(clave: Tuple[str, object]) -> Optional[int]:
+    with Session(_engine) as db:
+        if clave[0] == "usuario":
+            return db.exec(select(User.company_id).where(User.id == clave[1])).first()
+        return db.exec(select(TokenApi.company_id).where(TokenApi.token_hash == clave[1])).first()
+
+async def empresa_de(scope) -> Optional[int]:
+    clave = _clave_empresa(scope)
+    if clave is None or _engine is None:
+        return None
+    if clave not in _empresas:
+        if len(_empresas) >= MAX_EMPRESAS_CACHE:
+            _empresas.clear()
+        _empresas[clave] = await run_in_threadpool(_buscar_empresa, clave)
+    return _empresas[clave]
+
+def estado() -> dict:
+    return {"pid": os.getpid(), "clases": {nombre: p.estado() for nombre, p in clases.items()}}
+
+async def _rechazar(send, clase: str, reintentar_en: int):
+    cuerpo = json.dumps({
+        "detail": f"Servidor ocupado ({clase}). Reintenta en {reintentar_en} s",
+    }, ensure_ascii=False).encode()
+    await send({
+        "type": "http.response.start",
+        "status": 503,
+        "headers": [
+            (b"content-type", b"application/json"),
+            (b"content-length", str(len(cuerpo)).encode()),
+            (b"retry-after", str(reintentar_en).encode()),
+        ],
+    })
+    await send({"type": "http.response.body", "body": cuerpo})
+
+class ControlAdmision:
+    """Middleware ASGI. La plaza se ocupa hasta que la respuesta se ha enviado
+    entera (también las respuestas en streaming)."""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        clase = clasificar(scope["path"], scope.get("query_string", b""))
+        if clase is None:
+            await self.app(scope, receive, send)
+            return
+        plazas = clases[clase]
+        empresa = await empresa_de(scope) if plazas.por_empresa > 0 else None
+        if not await plazas.entrar(empresa):
+            await _rechazar(send, clase, plazas.reintentar_en)
+            return
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            plazas.salir(empresa)
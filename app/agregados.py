@@ -0,0 +1,250 @@
+from __future__ import annotations
+from calendar import monthrange
+from collections import defaultdict
+from datetime import date, timedelta
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+from sqlalchemy import and_, delete, event, func, insert, literal, or_, true
+from sqlalchemy.orm import Session as SessionORM
+from sqlmodel import Session, select
+from .models import GASTOS_CAMPOS, AgregadoPartes, ArchivoMes, ParteDia, User
+from .eventos import al_cambiar_parte
+from .archivo import partes_archivados
+
+# Cubo de agregados para los KPIs de la flota.
+#
+# AgregadoPartes guarda las sumas de los partes por día, semana ISO y mes, de cada
+# repartidor y de toda la empresa (user_id = 0). Al confirmar una transacción que
+# ha escrito partes se recalculan solo los periodos afectados: los de repartidor
+# desde los partes (también los archivados) y los de empresa sumando los de sus
+# repartidores. Un rango cualquiera se responde sumando el menor número de
+# periodos posible (meses enteros, luego semanas, luego días).
+
+DIA, SEMANA, MES = "d", "s", "m"
+GRANULARIDADES = (DIA, SEMANA, MES)
+EMPRESA = 0
+
+# Columnas sumables, en el orden de _consulta_partes
+SUMAS = ("partes", "km", "envios", "horas", *GASTOS_CAMPOS, "total_gastos")
+
+_CLAVE_PENDIENTES = "agregados_pendientes"
+
+def inicio_periodo(fecha: date, granularidad: str) -> date:
+    if granularidad == SEMANA:
+        return fecha - timedelta(days=fecha.weekday())
+    if granularidad == MES:
+        return fecha.replace(day=1)
+    return fecha
+
+def fin_periodo(inicio: date, granularidad: str) -> date:
+    if granularidad == SEMANA:
+        return inicio + timedelta(days=6)
+    if granularidad == MES:
+        return inicio.replace(day=monthrange(inicio.year, inicio.month)[1])
+    return inicio
+
+# ---------------------------------------------------------------------------
+# Mantenimiento
+
+def marcar(db: Session, company_id: int, user_id: int, fecha: date):
+    """Apunta que hay que recalcular los periodos de ese día al confirmar la transacción"""
+    db.info.setdefault(_CLAVE_PENDIENTES, set()).add((company_id, user_id, fecha))
+
+@al_cambiar_parte
+def _marcar_parte(db: Session, parte: ParteDia, accion: str):
+    marcar(db, parte.company_id, parte.user_id, parte.fecha)
+
+@event.listens_for(SessionORM, "before_commit")
+def _recalcular_pendientes(db: SessionORM):
+    pendientes = db.info.pop(_CLAVE_PENDIENTES, None)
+    if not pendientes:
+        return
+    # Los borrados tienen que estar ya en la base de datos
+    db.flush()
+    por_empresa: Dict[int, List[Tuple[int, date]]] = defaultdict(list)
+    for company_id, user_id, fecha in pendientes:
+        por_empresa[company_id].append((user_id, fecha))
+    for company_id, claves in por_empresa.items():
+        fechas = [f for _, f in claves]
+        recalcular(db, company_id, {u for u, _ in claves}, min(fechas), max(fechas))
+
+@event.listens_for(SessionORM, "after_rollback")
+def _descartar_pendientes(db: SessionORM):
+    db.info.pop(_CLAVE_PENDIENTES, None)
+
+def _consulta_partes(company_id: int, user_ids: Iterable[int], desde: date, hasta: date):
+    return (
+        select(
+            ParteDia.user_id,
+            ParteDia.fecha,
+            func.count(ParteDia.id),
+            func.coalesce(func.sum(ParteDia.km_diferencia), 0),
+            func.coalesce(func.sum(ParteDia.num_envios), 0),
+            func.coalesce(func.sum(ParteDia.horas), 0),
+            *[func.coalesce(func.sum(getattr(ParteDia, c)), 0) for c in GASTOS_CAMPOS],
+            func.coalesce(func.sum(ParteDia.total_gastos), 0),
+        )
+        .where(
+            ParteDia.company_id == company_id,
+            ParteDia.user_id.in_(list(user_ids)),
+            ParteDia.fecha >= desde,
+            ParteDia.fecha <= hasta,
+        )
+        .group_by(ParteDia.user_id, ParteDia.fecha)
+    )
+
+def recalcular(db: Session, company_id: int, user_ids: Set[int], desde: date, hasta: date):
+    """Recalcula los periodos (de los tres tamaños) que tocan [desde, hasta] para
+    esos repartidores, y los de la empresa. No hace commit."""
+    rangos = {
+        g: (inicio_periodo(desde, g), fin_periodo(inicio_periodo(hasta, g), g))
+        for g in GRANULARIDADES
+    }
+    ini = min(r[0] for r in rangos.values())
+    fin = max(r[1] for r in rangos.values())
+
+    sumas: Dict[Tuple[str, int, date], List[float]] = {}
+    def acumular(user_id: int, fecha: date, valores):
+        for g, (g_ini, g_fin) in rangos.items():
+            if g_ini <= fecha <= g_fin:
+                clave = (g, user_id, inicio_periodo(fecha, g))
+                actual = sumas.setdefault(clave, [0] * len(SUMAS))
+                for i, v in enumerate(valores):
+                    actual[i] += v or 0
+
+    for user_id, fecha, *valores in db.execute(_consulta_partes(company_id, user_ids, ini, fin)).all():
+        acumular(user_id, fecha, valores)
+    for p in partes_archivados(db, company_id, ini, fin):
+        if p.user_id in user_ids:
+            acumular(p.user_id, p.fecha, [1, p.km_diferencia, p.num_envios, p.horas, *[getattr(p, c) for c in GASTOS_CAMPOS], p.total_gastos])
+
+    A = AgregadoPartes
+    for g, (g_ini, g_fin) in rangos.items():
+        db.execute(delete(A).where(
+            A.company_id == company_id, A.granularidad == g, A.user_id.in_(list(user_ids)),
+            A.inicio >= g_ini, A.inicio <= g_fin,
+        ))
+    filas = [
+        {"granularidad": g, "inicio": inicio, "user_id": user_id, "company_id": company_id,
+         "repartidores": 1, **dict(zip(SUMAS, valores))}
+        for (g, user_id, inicio), valores in sumas.items()
+    ]
+    if filas:
+        db.execute(insert(A.__table__), filas)
+
+    # Empresa: suma de sus repartidores
+    for g, (g_ini, g_fin) in rangos.items():
+        en_rango = and_(A.company_id == company_id, A.granularidad == g, A.inicio >= g_ini, A.inicio <= g_fin)
+        db.execute(delete(A).where(en_rango, A.user_id == EMPRESA))
+        db.execute(insert(A.__table__).from_select(
+            ["granularidad", "inicio", "user_id", "company_id", "repartidores", *SUMAS],
+            select(
+                A.granularidad, A.inicio, literal(EMPRESA), A.company_id,
+                func.count(A.user_id), *[func.sum(getattr(A, c)) for c in SUMAS],
+            ).where(en_rango, A.user_id != EMPRESA).group_by(A.granularidad, A.inicio, A.company_id),
+        ))
+
+def reconstruir(db: Session, company_id: int):
+    """Recalcula todos los agregados de la empresa (p. ej. tras crear la tabla). No hace commit."""
+    db.execute(delete(AgregadoPartes).where(AgregadoPartes.company_id == company_id))
+    desde, hasta = db.execute(
+        select(func.min(ParteDia.fecha), func.max(ParteDia.fecha)).where(ParteDia.company_id == company_id)
+    ).one()
+    archivados = db.execute(
+        select(ArchivoMes.año, ArchivoMes.mes).where(ArchivoMes.company_id == company_id, ArchivoMes.estado == "archivado")
+    ).all()
+    fechas = [f for f in (desde, hasta) if f] + [date(a, m, 1) for a, m in archivados]
+    fechas += [fin_periodo(date(a, m, 1), MES) for a, m in archivados]
+    if not fechas:
+        return
+    user_ids = set(db.exec(select(User.id).where(User.company_id == company_id)).all())
+    recalcular(db, company_id, user_ids, min(fechas), max(fechas))
+
+# ---------------------------------------------------------------------------
+# Consultas
+
+def descomponer(desde: date, hasta: date) -> List[Tuple[str, date]]:
+    """Cubre [desde, hasta] con el menor número de periodos enteros"""
+    periodos = []
+    f = desde
+    while f <= hasta:
+        if f.day == 1 and fin_periodo(f, MES) <= hasta:
+            g = MES
+        elif f.weekday() == 0 and fin_periodo(f, SEMANA) <= hasta:
+            # Si la semana se mete en un mes que cabe entero, mejor días hasta el mes
+            siguiente_mes = fin_periodo(inicio_periodo(f, MES), MES) + timedelta(days=1)
+            cruza = fin_periodo(f, SEMANA) >= siguiente_mes and fin_periodo(siguiente_mes, MES) <= hasta
+            g = DIA if cruza else SEMANA
+        else:
+            g = DIA
+        periodos.append((g, f))
+        f = fin_periodo(f, g) + timedelta(days=1)
+    return periodos
+
+def _indicadores(fila: Dict[str, float]) -> Dict[str, float]:
+    km, envios = fila["km"], fila["envios"]
+    return {
+        "km_por_envio": round(km / envios, 3) if envios else None,
+        "coste_por_km": round(fila["total_gastos"] / km, 3) if km else None,
+        "gastos_por_categoria": {c: fila[c] for c in GASTOS_CAMPOS},
+    }
+
+def _en_periodos(periodos: List[Tuple[str, date]]):
+    por_granularidad: Dict[str, List[date]] = defaultdict(list)
+    for g, inicio in periodos:
+        por_granularidad[g].append(inicio)
+    A = AgregadoPartes
+    return or_(*[and_(A.granularidad == g, A.inicio.in_(inicios)) for g, inicios in por_granularidad.items()])
+
+def kpis(db: Session, company_id: int, desde: date, hasta: date, user_id: Optional[int] = None) -> dict:
+    """Totales e indicadores del rango, de la empresa o de un repartidor"""
+    A = AgregadoPartes
+    periodos = descomponer(desde, hasta)
+    if not periodos:
+        raise ValueError("El rango de fechas está vacío")
+    en_periodos = _en_periodos(periodos)
+    totales = db.execute(
+        select(*[func.coalesce(func.sum(getattr(A, c)), 0) for c in SUMAS])
+        .where(A.company_id == company_id, A.user_id == (user_id or EMPRESA), en_periodos)
+    ).one()
+    fila = dict(zip(SUMAS, totales))
+    # Repartidores distintos en todo el rango (no se puede sumar entre periodos)
+    activos = db.execute(
+        select(func.count(func.distinct(A.user_id)))
+        .where(A.company_id == company_id, A.user_id != EMPRESA, A.partes > 0, en_periodos)
+        .where(A.user_id == user_id if user_id else true())
+    ).scalar()
+    return {
+        "desde": desde.isoformat(),
+        "hasta": hasta.isoformat(),
+        "user_id": user_id,
+        **fila,
+        "repartidores_activos": activos,
+        **_indicadores(fila),
+        "periodos_sumados": len(periodos),
+    }
+
+def serie(db: Session, company_id: int, desde: date, hasta: date, granularidad: str = MES, user_id: Optional[int] = None) -> List[dict]:
+    """Un punto por periodo entero que toca el rango (para gráficas de tendencia)"""
+    if granularidad not in GRANULARIDADES:
+        raise ValueError("Granularidad inválida: use d, s o m")
+    A = AgregadoPartes
+    filas = db.exec(
+        select(A).where(
+            A.company_id == company_id,
+            A.granularidad == granularidad,
+            A.user_id == (user_id or EMPRESA),
+            A.inicio >= inicio_periodo(desde, granularidad),
+            A.inicio <= hasta,
+        ).order_by(A.inicio)
+    ).all()
+    puntos = []
+    for a in filas:
+        fila = {c: getattr(a, c) for c in SUMAS}
+        puntos.append({
+            "inicio": a.inicio.isoformat(),
+            "fin": fin_periodo(a.inicio, granularidad).isoformat(),
+            **fila,
+            "repartidores_activos": a.repartidores,
+            **_indicadores(fila),
+        })
+    return puntos
@@ -0,0 +1,116 @@
+from __future__ import annotations
+from datetime import date, timedelta
+from typing import Dict, List
+import pandas as pd
+from sqlmodel import Session, select, text
+from .models import User
+from .archivo import columnas_archivadas
+
+# Analítica de la flota con pandas: percentiles por repartidor, variaciones
+# mensual (MoM) e interanual (YoY) y medias móviles de 7 y 28 días.
+#
+# Las columnas se cargan de una vez (sin crear objetos del ORM) y todo el cálculo
+# es vectorizado. Se cargan además los 12 meses anteriores al rango (para la
+# comparación interanual) y los 27 días anteriores (para que las medias móviles
+# del primer día del rango estén completas).
+
+METRICAS = ("km", "envios", "gastos")
+
+_SQL_PARTES = text("""
+    SELECT user_id, fecha, km_diferencia AS km, num_envios AS envios, total_gastos AS gastos
+    FROM partedia
+    WHERE company_id = :company_id AND fecha >= :desde AND fecha <= :hasta
+""")
+
+_TIPOS = {"user_id": "int64", "km": "float64", "envios": "float64", "gastos": "float64"}
+
+def inicio_carga(desde: date) -> date:
+    """Primer día que hace falta cargar para analizar desde `desde`"""
+    hace_un_año = date(desde.year - 1, desde.month, 1)
+    return min(hace_un_año, desde - timedelta(days=27))
+
+def cargar_partes(db: Session, company_id: int, desde: date, hasta: date) -> pd.DataFrame:
+    """Columnas user_id, fecha (datetime64), km, envios y gastos de los partes del rango
+    (también de los meses archivados)"""
+    # text() no aplica conversiones de tipos fila a fila: las fechas llegan como
+    # vienen del driver y se convierten de una vez con pandas
+    df = pd.read_sql(
+        _SQL_PARTES,
+        db.connection(),
+        params={"company_id": company_id, "desde": desde.isoformat(), "hasta": hasta.isoformat()},
+    )
+    archivados = columnas_archivadas(
+        db, company_id, desde, hasta,
+        {"user_id": "user_id", "fecha": "fecha", "km_diferencia": "km", "num_envios": "envios", "total_gastos": "gastos"},
+    )
+    if archivados is not None:
+        df = pd.concat([df, archivados], ignore_index=True)
+    df = df.fillna({"km": 0, "envios": 0, "gastos": 0}).astype(_TIPOS)
+    df["fecha"] = pd.to_datetime(df["fecha"], format="ISO8601")
+    return df
+
+def _variacion(actual: pd.Series, anterior: pd.Series) -> pd.Series:
+    """Variación relativa; None si el periodo anterior es 0"""
+    return ((actual - anterior) / anterior.where(anterior != 0)).round(4)
+
+def _registros(df: pd.DataFrame) -> List[dict]:
+    # Las variaciones ya vienen redondeadas a 4 decimales
+    df = df.round({c: 3 for c in df.columns if not c.endswith(("_mom", "_yoy"))})
+    return df.astype(object).where(df.notna(), None).to_dict("records")
+
+def por_repartidor(df: pd.DataFrame, usernames: Dict[int, str]) -> List[dict]:
+    """Partes, totales y percentiles 50/90 por repartidor"""
+    if df.empty:
+        return []
+    grupos = df.groupby("user_id")[list(METRICAS)]
+    percentiles = grupos.quantile([0.5, 0.9]).unstack()
+    percentiles.columns = [f"{m}_p{int(q * 100)}" for m, q in percentiles.columns]
+    tabla = pd.concat([grupos.size().rename("partes"), grupos.sum().add_prefix("total_"), percentiles], axis=1)
+    tabla.insert(0, "username", tabla.index.map(usernames))
+    return _registros(tabla.reset_index())
+
+def por_mes(df: pd.DataFrame, desde: date, hasta: date) -> List[dict]:
+    """Totales mensuales del rango con su variación MoM y YoY"""
+    meses = pd.period_range(inicio_carga(desde), hasta, freq="M")
+    totales = (
+        df.groupby(df["fecha"].dt.to_period("M"))[list(METRICAS)].sum()
+        .assign(partes=df.groupby(df["fecha"].dt.to_period("M")).size())
+        .reindex(meses, fill_value=0)
+    )
+    tabla = totales.copy()
+    for m in METRICAS:
+        tabla[f"{m}_mom"] = _variacion(totales[m], totales[m].shift(1))
+        tabla[f"{m}_yoy"] = _variacion(totales[m], totales[m].shift(12))
+    tabla = tabla[tabla.index >= pd.Period(desde, freq="M")]
+    tabla.insert(0, "mes", tabla.index.astype(str))
+    return _registros(tabla.reset_index(drop=True))
+
+def por_dia(df: pd.DataFrame, desde: date, hasta: date) -> List[dict]:
+    """Totales diarios de la empresa con medias móviles de 7 y 28 días"""
+    dias = pd.date_range(inicio_carga(desde), hasta, freq="D")
+    totales = df.groupby("fecha")[list(METRICAS)].sum().reindex(dias, fill_value=0)
+    tabla = totales.copy()
+    for ventana in (7, 28):
+        medias = totales.rolling(ventana, min_periods=1).mean()
+        for m in METRICAS:
+            tabla[f"{m}_media_{ventana}d"] = medias[m]
+    tabla = tabla[tabla.index >= pd.Timestamp(desde)]
+    tabla.insert(0, "fecha", tabla.index.strftime("%Y-%m-%d"))
+    return _registros(tabla.reset_index(drop=True))
+
+def analizar(df: pd.DataFrame, desde: date, hasta: date, usernames: Dict[int, str]) -> dict:
+    """Informe completo a partir de las columnas cargadas (desde inicio_carga(desde))"""
+    en_rango = df[(df["fecha"] >= pd.Timestamp(desde)) & (df["fecha"] <= pd.Timestamp(hasta))]
+    return {
+        "desde": desde.isoformat(),
+        "hasta": hasta.isoformat(),
+        "partes": int(len(en_rango)),
+        "repartidores": por_repartidor(en_rango, usernames),
+        "meses": por_mes(df, desde, hasta),
+        "dias": por_dia(df, desde, hasta),
+    }
+
+def informe_analitica(db: Session, company_id: int, desde: date, hasta: date) -> dict:
+    usernames = {u.id: u.username for u in db.exec(select(User).where(User.company_id == company_id)).all()}
+    df = cargar_partes(db, company_id, inicio_carga(desde), hasta)
+    return analizar(df, desde, hasta, usernames)
@@ -0,0 +1,248 @@
+from __future__ import annotations
+import logging, os, threading
+from calendar import monthrange
+from datetime import date, datetime
+from pathlib import Path
+from typing import Dict, List, Optional
+import pandas as pd
+from sqlalchemy import and_, bindparam, delete, exists, func, insert
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import IntegrityError
+from sqlmodel import Session, select, text
+from .models import ArchivoMes, CambioParte, CierreMes, FotoEntrega, ParteDia, Ruta
+from .busqueda import TABLA as TABLA_BUSQUEDA
+from .eventos import anotar_cambio
+
+try:
+    import pyarrow  # noqa: F401  (motor de Parquet de pandas)
+except ImportError:  # sin pyarrow no se archiva
+    pyarrow = None
+
+# Archivo de meses antiguos.
+#
+# Los meses cerrados (bloqueados) más antiguos que ARCHIVO_RETENCION_MESES se
+# sacan de partedia/ruta a dos ficheros Parquet comprimidos por mes y empresa,
+# así la tabla de partes y sus índices no crecen con el histórico. ArchivoMes es
+# el catálogo. consultar_partes y el panel de administración leen los meses
+# archivados junto con los de la tabla.
+#
+# Los partes con fotos de entrega se quedan en la tabla (las fotos apuntan a sus
+# rutas). Los partes archivados no aparecen en la búsqueda; el calendario del
+# repartidor los lee del archivo. Para la sincronización se anota un cambio
+# 'archivado' de cada parte (el cliente lo recibe como borrado; la exportación
+# de la integración no, porque el parte sigue existiendo).
+
+DIRECTORIO = Path(os.getenv("ARCHIVO_DIR", str(Path(__file__).parent.parent / "archivo")))
+RETENCION_MESES = int(os.getenv("ARCHIVO_RETENCION_MESES", "24"))
+INTERVALO_HORAS = float(os.getenv("ARCHIVO_INTERVALO_HORAS", "6"))  # 0 = sin archivador automático
+COMPRESION = "zstd"
+TAMAÑO_BORRADO = 500
+
+log = logging.getLogger(__name__)
+
+def _rango_mes(año: int, mes: int):
+    return date(año, mes, 1), date(año, mes, monthrange(año, mes)[1])
+
+def _fichero(company_id: int, año: int, mes: int) -> str:
+    return f"empresa_{company_id}/{año}-{mes:02d}"
+
+def _escribir(df: pd.DataFrame, destino: Path):
+    """Escribe en un temporal y lo renombra: nunca queda un fichero a medias"""
+    temporal = destino.with_suffix(destino.suffix + ".tmp")
+    df.to_parquet(temporal, engine="pyarrow", compression=COMPRESION, index=False)
+    os.replace(temporal, destino)
+
+def archivar_mes(db: Session, company_id: int, año: int, mes: int) -> Optional[int]:
+    """Mueve los partes del mes a Parquet. Devuelve cuántos se han archivado, o
+    None si el mes ya está archivado (o lo está archivando otro proceso)."""
+    if pyarrow is None:
+        raise RuntimeError("Para archivar partes hay que instalar pyarrow")
+
+    # Reservar el mes: el índice único impide que dos workers lo archiven a la vez
+    registro = ArchivoMes(año=año, mes=mes, company_id=company_id, fichero=_fichero(company_id, año, mes))
+    db.add(registro)
+    try:
+        db.commit()
+    except IntegrityError:
+        db.rollback()
+        return None
+
+    base = DIRECTORIO / registro.fichero
+    destinos = [base.with_suffix(".parquet"), base.with_suffix(".rutas.parquet")]
+    try:
+        desde, hasta = _rango_mes(año, mes)
+        con_fotos = exists(
+            select(Ruta.id).join(FotoEntrega, FotoEntrega.ruta_id == Ruta.id).where(Ruta.parte_dia_id == ParteDia.id)
+        )
+        conexion = db.connection()
+        partes = pd.read_sql(
+            select(ParteDia.__table__).where(and_(
+                ParteDia.company_id == company_id,
+                ParteDia.fecha >= desde,
+                ParteDia.fecha <= hasta,
+                ~con_fotos,
+            )).order_by(ParteDia.fecha, ParteDia.id),
+            conexion,
+        )
+        ids = partes["id"].tolist()
+        rutas = pd.read_sql(
+            select(Ruta.__table__).where(Ruta.parte_dia_id.in_(
+                select(ParteDia.id).where(
+                    ParteDia.company_id == company_id, ParteDia.fecha >= desde, ParteDia.fecha <= hasta, ~con_fotos,
+                )
+            )).order_by(Ruta.parte_dia_id, Ruta.orden),
+            conexion,
+        )
+
+        if ids:
+            base.parent.mkdir(parents=True, exist_ok=True)
+            _escribir(partes, destinos[0])
+            _escribir(rutas, destinos[1])
+
+            borrar_indice = text(f"DELETE FROM {TABLA_BUSQUEDA} WHERE parte_id IN :ids").bindparams(
+                bindparam("ids", expanding=True)
+            )
+            _registrar_archivados(db, partes)
+            for i in range(0, len(ids), TAMAÑO_BORRADO):
+                bloque = ids[i:i + TAMAÑO_BORRADO]
+                db.exec(borrar_indice, params={"ids": bloque})
+                db.exec(delete(Ruta).where(Ruta.parte_dia_id.in_(bloque)))
+                db.exec(delete(ParteDia).where(ParteDia.id.in_(bloque)))
+            anotar_cambio(db, company_id, fecha=desde)
+
+        registro.estado = "archivado"
+        registro.partes = len(ids)
+        registro.rutas = len(rutas)
+        db.add(registro)
+        db.commit()
+        return len(ids)
+    except Exception:
+        db.rollback()
+        for destino in destinos:
+            destino.unlink(missing_ok=True)
+        db.delete(db.get(ArchivoMes, registro.id))
+        db.commit()
+        raise
+
+def _registrar_archivados(db: Session, partes: pd.DataFrame):
+    """Un CambioParte 'archivado' por parte, con la siguiente secuencia de su usuario"""
+    user_ids = partes["user_id"].tolist()
+    ultimos = dict(db.exec(
+        select(CambioParte.user_id, func.max(CambioParte.seq))
+        .where(CambioParte.user_id.in_(set(user_ids)))
+        .group_by(CambioParte.user_id)
+    ).all())
+    ahora = datetime.now()
+    filas = []
+    for parte_id, user_id, client_id, company_id in zip(
+        partes["id"].tolist(), user_ids, partes["client_id"].tolist(), partes["company_id"].tolist()
+    ):
+        ultimos[user_id] = (ultimos.get(user_id) or 0) + 1
+        filas.append({
+            "seq": ultimos[user_id], "accion": "archivado", "parte_id": parte_id,
+            "client_id": None if pd.isna(client_id) else client_id,
+            "fecha": ahora, "user_id": user_id, "company_id": company_id,
+        })
+    for i in range(0, len(filas), TAMAÑO_BORRADO):
+        db.exec(insert(CambioParte), params=filas[i:i + TAMAÑO_BORRADO])
+
+def meses_pendientes(db: Session, hoy: Optional[date] = None) -> List[CierreMes]:
+    """Meses bloqueados más antiguos que la retención y todavía sin archivar"""
+    hoy = hoy or date.today()
+    limite = hoy.year * 12 + hoy.month - 1 - RETENCION_MESES
+    archivado = exists(select(ArchivoMes.id).where(
+        ArchivoMes.company_id == CierreMes.company_id, ArchivoMes.año == CierreMes.año, ArchivoMes.mes == CierreMes.mes,
+    ))
+    return db.exec(
+        select(CierreMes).where(
+            CierreMes.bloqueado == True,
+            CierreMes.año * 12 + CierreMes.mes - 1 < limite,
+            ~archivado,
+        ).order_by(CierreMes.año, CierreMes.mes)
+    ).all()
+
+def archivar_pendientes(engine: Engine) -> int:
+    """Archiva todos los meses pendientes. Devuelve el número de partes archivados."""
+    total = 0
+    with Session(engine) as db:
+        pendientes = [(c.company_id, c.año, c.mes) for c in meses_pendientes(db)]
+    for company_id, año, mes in pendientes:
+        with Session(engine) as db:
+            n = archivar_mes(db, company_id, año, mes)
+        if n is not None:
+            log.info("Archivado %s-%02d de la empresa %s: %s partes", año, mes, company_id, n)
+            total += n
+    return total
+
+class Archivador:
+    """Hilo que archiva los meses pendientes cada INTERVALO_HORAS"""
+
+    def __init__(self, engine: Engine):
+        self.engine = engine
+        self._parar = threading.Event()
+        self._hilo: Optional[threading.Thread] = None
+
+    def iniciar(self):
+        if pyarrow is None or INTERVALO_HORAS <= 0:
+            return
+        self._parar.clear()
+        self._hilo = threading.Thread(target=self._bucle, name="archivador", daemon=True)
+        self._hilo.start()
+
+    def parar(self):
+        self._parar.set()
+        if self._hilo is not None:
+            self._hilo.join(timeout=5)
+
+    def _bucle(self):
+        while not self._parar.wait(INTERVALO_HORAS * 3600):
+            try:
+                archivar_pendientes(self.engine)
+            except Exception:
+                log.exception("Error archivando meses antiguos")
+
+# ---------------------------------------------------------------------------
+# Lectura
+
+def _a_fecha(valor) -> date:
+    return valor if isinstance(valor, date) else date.fromisoformat(str(valor)[:10])
+
+def _meses_archivados(db: Session, company_id: int, desde: date, hasta: date) -> List[ArchivoMes]:
+    return db.exec(
+        select(ArchivoMes).where(
+            ArchivoMes.company_id == company_id,
+            ArchivoMes.estado == "archivado",
+            ArchivoMes.partes > 0,
+            ArchivoMes.año * 12 + ArchivoMes.mes >= desde.year * 12 + desde.month,
+            ArchivoMes.año * 12 + ArchivoMes.mes <= hasta.year * 12 + hasta.month,
+        )
+    ).all()
+
+def _leer(meses: List[ArchivoMes], filtros: list, columnas: Optional[List[str]] = None) -> pd.DataFrame:
+    return pd.concat([
+        pd.read_parquet(DIRECTORIO / f"{m.fichero}.parquet", engine="pyarrow", columns=columnas, filters=filtros)
+        for m in meses
+    ], ignore_index=True)
+
+def partes_archivados(db: Session, company_id: int, desde, hasta, user_id: Optional[int] = None) -> List[ParteDia]:
+    """Partes archivados en el rango, como objetos ParteDia sueltos (fuera de la sesión)"""
+    desde, hasta = _a_fecha(desde), _a_fecha(hasta)
+    meses = _meses_archivados(db, company_id, desde, hasta)
+    if not meses:
+        return []
+
+    filtros = [("fecha", ">=", desde), ("fecha", "<=", hasta)]
+    if user_id:
+        filtros.append(("user_id", "==", user_id))
+    df = _leer(meses, filtros)
+    df = df.astype(object).where(df.notna(), None)
+    return [ParteDia(**fila) for fila in df.to_dict("records")]
+
+def columnas_archivadas(db: Session, company_id: int, desde: date, hasta: date, columnas: Dict[str, str]) -> Optional[pd.DataFrame]:
+    """Solo algunas columnas (renombradas según `columnas`) de los partes archivados
+    del rango, o None si no hay ninguno"""
+    meses = _meses_archivados(db, company_id, desde, hasta)
+    if not meses:
+        return None
+    df = _leer(meses, [("fecha", ">=", desde), ("fecha", "<=", hasta)], list(columnas))
+    return df.rename(columns=columnas)
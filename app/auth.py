@@ -2,8 +2,10 @@ from __future__ import annotations
 from fastapi import Request, HTTPException
 from passlib.hash import bcrypt
 from sqlmodel import Session, select
-from .models import User, Company
-from typing import Optional
+from .models import User, Company, TokenApi
+from datetime import datetime
+from typing import Optional, Tuple
+import hashlib, secrets
 
 SESSION_KEY = "user_id"
 
@@ -33,3 +35,40 @@ def require_role(request: Request, db: Session, role: str):
         raise HTTPException(status_code=403, detail="No autorizado")
     print(f"DEBUG require_role: Acceso permitido")
     return u
+
+def require_operador(request: Request, db: Session) -> User:
+    u = get_current_user(request, db)
+    if u and u.es_operador:
+        return u
+    raise HTTPException(status_code=403, detail="Solo para operadores")
+
+# Tokens de integración: se envían como "Authorization: Bearer <token>"
+def hash_token(token: str) -> str:
+    return hashlib.sha256(token.encode()).hexdigest()
+
+def crear_token_api(db: Session, company_id: int, nombre: str, admin_id: Optional[int] = None) -> Tuple[TokenApi, str]:
+    """Crea un token y devuelve (registro, token en claro). El token solo se puede mostrar ahora."""
+    token = secrets.token_urlsafe(32)
+    registro = TokenApi(nombre=nombre, token_hash=hash_token(token), company_id=company_id, creado_por=admin_id)
+    db.add(registro)
+    return registro, token
+
+def get_token_api(request: Request, db: Session) -> Optional[TokenApi]:
+    cabecera = request.headers.get("authorization", "")
+    if not cabecera.lower().startswith("bearer "):
+        return None
+    registro = db.exec(
+        select(TokenApi).where(TokenApi.token_hash == hash_token(cabecera[7:].strip()), TokenApi.revocado == False)
+    ).first()
+    if registro:
+        registro.ultimo_uso = datetime.now()
+        db.add(registro)
+        db.commit()
+    return registro
+
+def require_integracion(request: Request, db: Session) -> int:
+    """Token de integración o sesión de administrador. Devuelve el company_id."""
+    registro = get_token_api(request, db)
+    if registro:
+        return registro.company_id
+    return require_role(request, db, "admin").company_id
@@ -0,0 +1,186 @@
+from __future__ import annotations
+import json, logging, os, queue, select, threading, time, uuid
+from abc import ABC, abstractmethod
+from typing import Iterable, List, Optional
+from sqlalchemy import text
+from sqlalchemy.engine import Engine
+from .eventos import Cambio, avisar_cambios, conectar_publicador
+
+# Bus de invalidación entre procesos.
+#
+# Con varios workers (o varias máquinas) cada proceso tiene sus propias cachés en
+# memoria. Los cambios confirmados en un proceso ("empresa X / repartidor Y /
+# mes Z") se publican en el bus y los demás procesos se los pasan a sus oyentes
+# de eventos.al_confirmar, igual que si el cambio fuera suyo.
+#
+# - PostgreSQL: LISTEN/NOTIFY, llega en milisegundos.
+# - SQLite (desarrollo y pruebas): una tabla que cada proceso consulta cada
+#   BUS_INTERVALO_SEGUNDOS.
+#
+# BUS_INVALIDACION: auto (por defecto, según la base de datos) | postgres | tabla | off
+
+CANAL = "invalidaciones"
+TABLA = "bus_invalidacion"
+INTERVALO_SONDEO = float(os.getenv("BUS_INTERVALO_SEGUNDOS", "1"))
+RETENCION_SEGUNDOS = 300
+# Por encima se publica "toda la empresa" (el mensaje de NOTIFY admite 8000 bytes)
+MAX_CAMBIOS_MENSAJE = 200
+
+log = logging.getLogger(__name__)
+
+def _compactar(cambios: Iterable[Cambio]) -> List[Cambio]:
+    cambios = set(cambios)
+    if len(cambios) > MAX_CAMBIOS_MENSAJE:
+        cambios = {Cambio(c.company_id) for c in cambios}
+    if len(cambios) > MAX_CAMBIOS_MENSAJE:
+        cambios = {Cambio(None)}
+    return list(cambios)
+
+class BusInvalidacion(ABC):
+    """Publica en segundo plano (no alarga las peticiones) y escucha en otro hilo.
+    Cada backend implementa _enviar y _bucle_escuchar."""
+
+    def __init__(self, engine: Engine):
+        self.engine = engine
+        self.origen = ""
+        self._cola: "queue.Queue[Optional[List[Cambio]]]" = queue.Queue()
+        self._parar = threading.Event()
+        self._hilos: List[threading.Thread] = []
+
+    def iniciar(self):
+        # Se genera al arrancar cada worker (con preload el objeto se crea en el maestro)
+        self.origen = uuid.uuid4().hex  # para ignorar los mensajes propios
+        self._preparar()
+        self._parar.clear()
+        self._hilos = []
+        for nombre, objetivo in (("publicar", self._bucle_publicar), ("escuchar", self._bucle_escuchar)):
+            hilo = threading.Thread(target=objetivo, name=f"bus-{nombre}", daemon=True)
+            hilo.start()
+            self._hilos.append(hilo)
+        conectar_publicador(self.publicar)
+
+    def parar(self):
+        conectar_publicador(None)
+        self._parar.set()
+        self._cola.put(None)
+        for hilo in self._hilos:
+            hilo.join(timeout=5)
+
+    def publicar(self, cambios: List[Cambio]):
+        self._cola.put(cambios)
+
+    def _bucle_publicar(self):
+        fin = False
+        while not fin:
+            cambios = self._cola.get()
+            if cambios is None:
+                return
+            # Se juntan en un solo mensaje los cambios que se hayan acumulado
+            lote = set(cambios)
+            while True:
+                try:
+                    mas = self._cola.get_nowait()
+                except queue.Empty:
+                    break
+                if mas is None:
+                    fin = True
+                    break
+                lote.update(mas)
+            mensaje = json.dumps({"o": self.origen, "c": [list(c) for c in _compactar(lote)]})
+            try:
+                self._enviar(mensaje)
+            except Exception:
+                log.exception("No se pudo publicar la invalidación")
+
+    def _recibir(self, mensaje: str):
+        try:
+            datos = json.loads(mensaje)
+            if datos["o"] == self.origen:
+                return
+            cambios = [Cambio(*c) for c in datos["c"]]
+        except Exception:
+            log.warning("Mensaje de invalidación no válido: %r", mensaje)
+            return
+        avisar_cambios(cambios)
+
+    def _preparar(self):
+        pass
+
+    @abstractmethod
+    def _enviar(self, mensaje: str):
+        """Publica un mensaje para los demás workers"""
+
+    @abstractmethod
+    def _bucle_escuchar(self):
+        """Hilo de escucha: pasa cada mensaje recibido a _recibir hasta que se pare el bus"""
+
+class BusPostgres(BusInvalidacion):
+    def _enviar(self, mensaje: str):
+        with self.engine.begin() as conn:
+            conn.execute(text("SELECT pg_notify(:canal, :mensaje)"), {"canal": CANAL, "mensaje": mensaje})
+
+    def _bucle_escuchar(self):
+        primera = True
+        while not self._parar.is_set():
+            try:
+                # Conexión propia, fuera del pool, en autocommit (LISTEN no funciona dentro de una transacción)
+                conexion = self.engine.raw_connection()
+                conexion.detach()
+                pg = conexion.driver_connection
+                pg.autocommit = True
+                try:
+                    pg.cursor().execute(f"LISTEN {CANAL}")
+                    if not primera:
+                        # Mientras no escuchábamos se han podido perder mensajes
+                        avisar_cambios([Cambio(None)])
+                    primera = False
+                    while not self._parar.is_set():
+                        if select.select([pg], [], [], 1.0) == ([], [], []):
+                            continue
+                        pg.poll()
+                        while pg.notifies:
+                            self._recibir(pg.notifies.pop(0).payload)
+                finally:
+                    conexion.close()
+            except Exception:
+                log.exception("Bus de invalidación desconectado; reintentando")
+                self._parar.wait(5)
+
+class BusTabla(BusInvalidacion):
+    def _preparar(self):
+        with self.engine.begin() as conn:
+            conn.execute(text(f"""
+                CREATE TABLE IF NOT EXISTS {TABLA} (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    fecha REAL NOT NULL,
+                    mensaje TEXT NOT NULL
+                )
+            """))
+            self._ultimo = conn.execute(text(f"SELECT coalesce(max(id), 0) FROM {TABLA}")).scalar()
+
+    def _enviar(self, mensaje: str):
+        ahora = time.time()
+        with self.engine.begin() as conn:
+            conn.execute(text(f"INSERT INTO {TABLA} (fecha, mensaje) VALUES (:fecha, :mensaje)"), {"fecha": ahora, "mensaje": mensaje})
+            conn.execute(text(f"DELETE FROM {TABLA} WHERE fecha < :limite"), {"limite": ahora - RETENCION_SEGUNDOS})
+
+    def _bucle_escuchar(self):
+        while not self._parar.wait(INTERVALO_SONDEO):
+            try:
+                with self.engine.connect() as conn:
+                    filas = conn.execute(
+                        text(f"SELECT id, mensaje FROM {TABLA} WHERE id > :ultimo ORDER BY id"), {"ultimo": self._ultimo}
+                    ).all()
+                for id_, mensaje in filas:
+                    self._ultimo = id_
+                    self._recibir(mensaje)
+            except Exception:
+                log.exception("Error leyendo el bus de invalidación")
+
+def crear_bus(engine: Engine) -> Optional[BusInvalidacion]:
+    modo = os.getenv("BUS_INVALIDACION", "auto").lower()
+    if modo == "off":
+        return None
+    if modo == "postgres" or (modo == "auto" and engine.dialect.name == "postgresql"):
+        return BusPostgres(engine)
+    return BusTabla(engine)
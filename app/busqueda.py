@@ -0,0 +1,145 @@
+from __future__ import annotations
+from typing import List, Optional, Tuple
+from sqlalchemy.engine import Engine
+from sqlmodel import Session, select, text
+from .models import ParteDia, Ruta, User
+from .eventos import al_cambiar_parte
+
+# Índice de texto completo de partes y rutas.
+# SQLite: tabla virtual FTS5 (sin acentos, "averia" encuentra "avería").
+# PostgreSQL: tabla con columna tsvector generada e índice GIN.
+TABLA = "parte_busqueda"
+
+def _es_postgres(bind) -> bool:
+    return bind.dialect.name == "postgresql"
+
+def crear_indice_busqueda(engine: Engine, recrear: bool = False):
+    """Crea la tabla del índice si no existe (o la vacía con recrear=True)"""
+    with engine.begin() as conn:
+        if recrear:
+            conn.execute(text(f"DROP TABLE IF EXISTS {TABLA}"))
+        if _es_postgres(engine):
+            conn.execute(text(f"""
+                CREATE TABLE IF NOT EXISTS {TABLA} (
+                    parte_id INTEGER PRIMARY KEY,
+                    company_id INTEGER NOT NULL,
+                    lugares TEXT,
+                    textos TEXT,
+                    documento tsvector GENERATED ALWAYS AS (
+                        setweight(to_tsvector('spanish', coalesce(lugares, '')), 'A') ||
+                        setweight(to_tsvector('spanish', coalesce(textos, '')), 'B')
+                    ) STORED
+                )
+            """))
+            conn.execute(text(f"CREATE INDEX IF NOT EXISTS ix_{TABLA}_documento ON {TABLA} USING GIN (documento)"))
+            conn.execute(text(f"CREATE INDEX IF NOT EXISTS ix_{TABLA}_company ON {TABLA} (company_id)"))
+        else:
+            conn.execute(text(f"""
+                CREATE VIRTUAL TABLE IF NOT EXISTS {TABLA} USING fts5(
+                    lugares, textos,
+                    parte_id UNINDEXED, company_id UNINDEXED,
+                    tokenize = 'unicode61 remove_diacritics 2'
+                )
+            """))
+
+def _documento(db: Session, parte: ParteDia) -> Tuple[str, str]:
+    """Devuelve (lugares, textos) de un parte y sus rutas"""
+    rutas = db.exec(select(Ruta).where(Ruta.parte_dia_id == parte.id).order_by(Ruta.orden)).all()
+    lugares = [parte.salida_lugar, parte.llegada_lugar]
+    textos = [parte.observaciones]
+    for r in rutas:
+        lugares += [r.salida_lugar, r.llegada_lugar]
+        textos += [r.descripcion, r.observaciones_ruta]
+    return (
+        " ".join(v for v in lugares if v),
+        " ".join(v for v in textos if v),
+    )
+
+@al_cambiar_parte
+def indexar_parte(db: Session, parte: ParteDia, accion: str = "actualizado"):
+    """Actualiza la entrada del índice de un parte en la transacción actual"""
+    db.exec(text(f"DELETE FROM {TABLA} WHERE parte_id = :pid"), params={"pid": parte.id})
+    if accion == "eliminado":
+        return
+    lugares, textos = _documento(db, parte)
+    db.exec(
+        text(f"INSERT INTO {TABLA} (lugares, textos, parte_id, company_id) VALUES (:lugares, :textos, :pid, :cid)"),
+        params={"lugares": lugares, "textos": textos, "pid": parte.id, "cid": parte.company_id},
+    )
+
+def reindexar(db: Session, company_id: Optional[int] = None) -> int:
+    """Reconstruye el índice completo (o el de una empresa). No hace commit."""
+    q = select(ParteDia)
+    if company_id is not None:
+        q = q.where(ParteDia.company_id == company_id)
+    total = 0
+    for parte in db.exec(q).all():
+        indexar_parte(db, parte)
+        total += 1
+    return total
+
+def _consulta_fts5(q: str) -> str:
+    """Convierte el texto del usuario en una consulta FTS5 segura (AND de términos, prefijo en el último)"""
+    terminos = ['"' + t.replace('"', '""') + '"' for t in q.split()]
+    if terminos:
+        terminos[-1] += "*"
+    return " ".join(terminos)
+
+def buscar_partes(db: Session, company_id: int, q: str, pagina: int = 1, por_pagina: int = 20) -> Tuple[int, List[dict]]:
+    """Búsqueda ordenada por relevancia y paginada. Devuelve (total, resultados)."""
+    q = (q or "").strip()
+    if not q:
+        return 0, []
+    offset = (pagina - 1) * por_pagina
+
+    if _es_postgres(db.get_bind()):
+        params = {"q": q, "cid": company_id, "lim": por_pagina, "off": offset}
+        total = db.exec(text(f"""
+            SELECT COUNT(*) FROM {TABLA}
+            WHERE company_id = :cid AND documento @@ plainto_tsquery('spanish', :q)
+        """), params=params).scalar_one()
+        filas = db.exec(text(f"""
+            SELECT parte_id, ts_rank(documento, query) AS rank,
+                   ts_headline('spanish', coalesce(lugares, '') || ' ' || coalesce(textos, ''), query,
+                               'StartSel=[, StopSel=], MaxWords=20') AS fragmento
+            FROM {TABLA}, plainto_tsquery('spanish', :q) AS query
+            WHERE company_id = :cid AND documento @@ query
+            ORDER BY rank DESC, parte_id DESC
+            LIMIT :lim OFFSET :off
+        """), params=params).all()
+    else:
+        params = {"q": _consulta_fts5(q), "cid": company_id, "lim": por_pagina, "off": offset}
+        total = db.exec(text(f"""
+            SELECT COUNT(*) FROM {TABLA} WHERE {TABLA} MATCH :q AND company_id = :cid
+        """), params=params).scalar_one()
+        # bm25 devuelve valores negativos: cuanto menor, más relevante
+        filas = db.exec(text(f"""
+            SELECT parte_id, -bm25({TABLA}, 2.0, 1.0) AS rank,
+                   snippet({TABLA}, -1, '[', ']', '…', 12) AS fragmento
+            FROM {TABLA}
+            WHERE {TABLA} MATCH :q AND company_id = :cid
+            ORDER BY bm25({TABLA}, 2.0, 1.0), parte_id DESC
+            LIMIT :lim OFFSET :off
+        """), params=params).all()
+
+    ids = [int(f.parte_id) for f in filas]
+    partes = {}
+    if ids:
+        for p, u in db.exec(
+            select(ParteDia, User).join(User, ParteDia.user_id == User.id).where(ParteDia.id.in_(ids))
+        ).all():
+            partes[p.id] = (p, u)
+
+    resultados = []
+    for f in filas:
+        if int(f.parte_id) not in partes:
+            continue
+        p, u = partes[int(f.parte_id)]
+        resultados.append({
+            "parte_id": p.id,
+            "fecha": p.fecha.isoformat(),
+            "repartidor": u.username,
+            "fragmento": f.fragmento,
+            "relevancia": round(float(f.rank), 4),
+        })
+    return total, resultados
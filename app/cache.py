@@ -0,0 +1,100 @@
+from __future__ import annotations
+import os, threading, time
+from concurrent.futures import Future
+from typing import Any, Callable, Dict, Hashable, List, Tuple
+from .eventos import Cambio, al_confirmar
+from .cancelacion import PeticionCancelada
+
+# Caché de resultados pesados (panel de administración, exportaciones).
+#
+# - Single-flight: si llegan varias peticiones idénticas a la vez, solo una hace
+#   el cálculo y las demás esperan su resultado.
+# - El resultado se guarda unos segundos (CACHE_TTL_SEGUNDOS, 0 = sin caché).
+# - Cualquier escritura confirmada de una empresa vacía sus entradas. Si el
+#   cálculo empezó antes de la escritura, su resultado no se guarda.
+
+Clave = Tuple[int, Hashable]  # (company_id, parámetros)
+
+class CacheResultados:
+    def __init__(self, ttl: float, max_entradas: int = 256):
+        self.ttl = ttl
+        self.max_entradas = max_entradas
+        self._lock = threading.Lock()
+        self._datos: Dict[Clave, Tuple[float, Any]] = {}
+        self._en_vuelo: Dict[Clave, Future] = {}
+        self._generaciones: Dict[int, int] = {}
+
+    def obtener(self, company_id: int, clave: Hashable, calcular: Callable[[], Any]) -> Any:
+        k = (company_id, clave)
+        with self._lock:
+            entrada = self._datos.get(k)
+            if entrada and entrada[0] > time.monotonic():
+                return entrada[1]
+            futuro = self._en_vuelo.get(k)
+            propio = futuro is None
+            if propio:
+                futuro = Future()
+                self._en_vuelo[k] = futuro
+                generacion = self._generaciones.get(company_id, 0)
+
+        if not propio:
+            try:
+                return futuro.result()
+            except PeticionCancelada:
+                # Quien lo calculaba se ha ido: lo calcula esta petición
+                return self.obtener(company_id, clave, calcular)
+
+        try:
+            valor = calcular()
+        except BaseException as e:
+            with self._lock:
+                if self._en_vuelo.get(k) is futuro:
+                    del self._en_vuelo[k]
+            futuro.set_exception(e)
+            raise
+
+        with self._lock:
+            if self._en_vuelo.get(k) is futuro:
+                del self._en_vuelo[k]
+            if self.ttl > 0 and self._generaciones.get(company_id, 0) == generacion:
+                self._guardar(k, valor)
+        futuro.set_result(valor)
+        return valor
+
+    def _guardar(self, k: Clave, valor: Any):
+        ahora = time.monotonic()
+        if len(self._datos) >= self.max_entradas:
+            for vieja in [c for c, (expira, _) in self._datos.items() if expira <= ahora]:
+                del self._datos[vieja]
+        if len(self._datos) >= self.max_entradas:
+            # La que caduca antes es la más antigua
+            del self._datos[min(self._datos, key=lambda c: self._datos[c][0])]
+        self._datos[k] = (ahora + self.ttl, valor)
+
+    def invalidar(self, company_id: int):
+        """Descarta las entradas de la empresa y los cálculos en curso (las peticiones
+        que lleguen a partir de ahora calcularán de nuevo)"""
+        with self._lock:
+            self._generaciones[company_id] = self._generaciones.get(company_id, 0) + 1
+            for k in [k for k in self._datos if k[0] == company_id]:
+                del self._datos[k]
+            for k in [k for k in self._en_vuelo if k[0] == company_id]:
+                del self._en_vuelo[k]
+
+    def vaciar(self):
+        with self._lock:
+            for company_id in {k[0] for k in self._datos} | {k[0] for k in self._en_vuelo}:
+                self._generaciones[company_id] = self._generaciones.get(company_id, 0) + 1
+            self._datos.clear()
+            self._en_vuelo.clear()
+
+cache_resultados = CacheResultados(ttl=float(os.getenv("CACHE_TTL_SEGUNDOS", "30")))
+
+@al_confirmar
+def _invalidar_empresas(cambios: List[Cambio]):
+    empresas = {c.company_id for c in cambios}
+    if None in empresas:
+        cache_resultados.vaciar()
+        return
+    for company_id in empresas:
+        cache_resultados.invalidar(company_id)
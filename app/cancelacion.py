@@ -0,0 +1,212 @@
+from __future__ import annotations
+import asyncio, logging, os, threading, time
+from contextvars import ContextVar
+from typing import Optional, Set
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from .admision import INTERACTIVA, PESADA, clasificar
+
+# Cancelación del trabajo abandonado y tiempo máximo de las consultas.
+#
+# Cada petición lleva una Peticion (en una ContextVar, que llega también a los
+# hilos del pool donde se ejecutan las rutas). Si el cliente de una lectura (GET)
+# se desconecta se marca como cancelada: la consulta en curso se interrumpe
+# (SQLite: progress handler; PostgreSQL: cancel() de la conexión) y las
+# generaciones largas (Excel, PDF, ZIP) se paran en el siguiente
+# comprobar_cancelacion(). Las escrituras se terminan aunque el cliente se vaya.
+#
+# Además cada consulta tiene un tiempo máximo según la clase de la ruta (ver
+# app/admision.py): SQLite lo comprueba en el progress handler y en PostgreSQL
+# se fija con SET LOCAL statement_timeout. Los hilos de fondo no tienen límite.
+
+TIEMPO_CONSULTA = {
+    INTERACTIVA: float(os.getenv("TIEMPO_CONSULTA_INTERACTIVA", "15")),  # segundos, 0 = sin límite
+    PESADA: float(os.getenv("TIEMPO_CONSULTA_PESADA", "300")),
+}
+# Cada cuántas instrucciones de la máquina virtual de SQLite se comprueba
+INSTRUCCIONES_SQLITE = 20000
+
+log = logging.getLogger(__name__)
+
+class PeticionCancelada(Exception):
+    """El cliente se ha ido: no hace falta terminar el trabajo"""
+
+class TiempoConsultaAgotado(Exception):
+    """Una consulta ha pasado del tiempo máximo de su clase de ruta"""
+
+    def __init__(self, segundos: float):
+        super().__init__(f"La consulta ha tardado más de {segundos:g} s. Prueba con un rango de fechas más corto.")
+
+class Peticion:
+    def __init__(self, tiempo_consulta: float):
+        self.tiempo_consulta = tiempo_consulta
+        self.cancelada = False
+        self.agotada = False  # la última consulta se interrumpió por tiempo
+        self._conexiones: Set = set()  # conexiones DBAPI de PostgreSQL en uso
+        self._lock = threading.Lock()
+
+    def cancelar(self):
+        self.cancelada = True
+        with self._lock:
+            conexiones = list(self._conexiones)
+        for conexion in conexiones:
+            try:
+                conexion.cancel()
+            except Exception:
+                log.debug("No se pudo cancelar la consulta", exc_info=True)
+
+    def usar(self, conexion):
+        with self._lock:
+            self._conexiones.add(conexion)
+
+    def soltar(self, conexion):
+        with self._lock:
+            self._conexiones.discard(conexion)
+
+_actual: ContextVar[Optional[Peticion]] = ContextVar("peticion", default=None)
+
+def comprobar_cancelacion():
+    """Punto de parada de los trabajos largos: lanza PeticionCancelada si el cliente se ha ido"""
+    peticion = _actual.get()
+    if peticion is not None and peticion.cancelada:
+        raise PeticionCancelada()
+
+# ---------------------------------------------------------------------------
+# Motores
+
+def instalar(engine: Engine):
+    """Aplica la cancelación y los tiempos máximos a las consultas del motor"""
+    postgres = engine.dialect.name == "postgresql"
+
+    @event.listens_for(engine, "connect")
+    def _al_conectar(dbapi_connection, registro):
+        estado = registro.info["cancelacion"] = {"peticion": None, "limite": None}
+        if hasattr(dbapi_connection, "set_progress_handler"):
+            dbapi_connection.set_progress_handler(lambda: _interrumpir(estado), INSTRUCCIONES_SQLITE)
+
+    @event.listens_for(engine, "begin")
+    def _al_empezar(conn):
+        conn.info.pop("statement_timeout", None)  # SET LOCAL dura lo que la transacción
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def _antes(conn, cursor, sentencia, parametros, contexto, executemany):
+        estado = conn.info.get("cancelacion")
+        peticion = _actual.get()
+        if estado is None:
+            return
+        if peticion is None:
+            estado["peticion"] = estado["limite"] = None
+            return
+        if peticion.cancelada:
+            raise PeticionCancelada()
+        estado["peticion"] = peticion
+        # Se cuenta desde el inicio de la consulta, también mientras se leen sus filas
+        estado["limite"] = time.monotonic() + peticion.tiempo_consulta if peticion.tiempo_consulta > 0 else None
+        if postgres:
+            peticion.usar(conn.connection.dbapi_connection)
+            milisegundos = int(peticion.tiempo_consulta * 1000)
+            if conn.info.get("statement_timeout") != milisegundos:
+                cursor.execute("SET LOCAL statement_timeout = %s" % milisegundos)
+                conn.info["statement_timeout"] = milisegundos
+
+    @event.listens_for(engine, "checkin")
+    def _al_devolver(dbapi_connection, registro):
+        estado = registro.info.get("cancelacion")
+        if estado is None:
+            return
+        peticion = estado["peticion"]
+        if peticion is not None:
+            peticion.soltar(dbapi_connection)
+        estado["peticion"] = estado["limite"] = None
+
+    @event.listens_for(engine, "handle_error")
+    def _traducir(contexto):
+        peticion = _actual.get()
+        if peticion is None:
+            return
+        if peticion.cancelada:
+            raise PeticionCancelada() from contexto.original_exception
+        cancelada_pg = getattr(contexto.original_exception, "pgcode", None) == "57014"
+        if peticion.agotada or cancelada_pg:
+            peticion.agotada = False
+            raise TiempoConsultaAgotado(peticion.tiempo_consulta) from contexto.original_exception
+
+def _interrumpir(estado: dict) -> int:
+    """Progress handler de SQLite: distinto de 0 interrumpe la consulta"""
+    peticion = estado["peticion"]
+    if peticion is None:
+        return 0
+    if peticion.cancelada:
+        return 1
+    limite = estado["limite"]
+    if limite is not None and time.monotonic() > limite:
+        peticion.agotada = True
+        return 1
+    return 0
+
+# ---------------------------------------------------------------------------
+# Middleware
+
+class CancelarAbandonadas:
+    """Middleware ASGI: crea la Peticion y, en las lecturas, vigila si el cliente se desconecta"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        clase = clasificar(scope["path"], scope.get("query_string", b""))
+        if clase is None:
+            await self.app(scope, receive, send)
+            return
+
+        peticion = Peticion(TIEMPO_CONSULTA[clase])
+        token = _actual.set(peticion)
+        try:
+            if scope["method"] in ("GET", "HEAD"):
+                await self._vigilando(peticion, scope, receive, send)
+            else:
+                await self.app(scope, receive, send)
+        finally:
+            _actual.reset(token)
+
+    async def _vigilando(self, peticion: Peticion, scope, receive, send):
+        # Solo esta tarea lee del cliente; la aplicación recibe lo mismo a través de la cola
+        mensajes: "asyncio.Queue[dict]" = asyncio.Queue()
+        terminada = False
+        iniciada = False
+
+        async def vigilar():
+            while True:
+                mensaje = await receive()
+                mensajes.put_nowait(mensaje)
+                if mensaje["type"] == "http.disconnect":
+                    if not terminada:
+                        peticion.cancelar()
+                    return
+
+        async def recibir():
+            if peticion.cancelada:
+                return {"type": "http.disconnect"}
+            return await mensajes.get()
+
+        async def enviar(mensaje):
+            nonlocal terminada, iniciada
+            if mensaje["type"] == "http.response.start":
+                iniciada = True
+            elif mensaje["type"] == "http.response.body" and not mensaje.get("more_body", False):
+                terminada = True
+            await send(mensaje)
+
+        vigilante = asyncio.create_task(vigilar())
+        try:
+            await self.app(scope, recibir, enviar)
+        except PeticionCancelada:
+            # Ya no hay nadie esperando la respuesta
+            if not iniciada:
+                await send({"type": "http.response.start", "status": 499, "headers": []})
+                await send({"type": "http.response.body", "body": b""})
+        finally:
+            vigilante.cancel()
@@ -0,0 +1,140 @@
+from __future__ import annotations
+from calendar import monthrange
+from datetime import date, datetime
+from typing import List, Optional
+from sqlalchemy import Date, DateTime, bindparam
+from sqlmodel import Session, select, text
+from .models import ArchivoMes, CierreMes, ParteDia
+from .eventos import al_cambiar_parte, anotar_cambio
+
+class MesCerrado(Exception):
+    """Se intenta modificar un parte de un mes bloqueado por el administrador"""
+
+class MesArchivado(MesCerrado):
+    """El mes está archivado (ver app/archivo.py): sus partes ya no están en
+    partedia, así que no se puede reabrir ni recalcular"""
+
+def comprobar_mes_no_archivado(db: Session, company_id: int, año: int, mes: int):
+    archivado = db.exec(
+        select(ArchivoMes.id).where(
+            ArchivoMes.company_id == company_id,
+            ArchivoMes.año == año,
+            ArchivoMes.mes == mes,
+            ArchivoMes.estado == "archivado",
+        )
+    ).first()
+    if archivado is not None:
+        raise MesArchivado(f"El mes {mes:02d}/{año} está archivado y ya no se puede reabrir ni volver a cerrar.")
+
+# Un único INSERT ... SELECT agrupado que crea o refresca el ParteMensual de
+# todos los repartidores de la empresa (también los que no tienen partes).
+_SQL_CIERRE = text("""
+    INSERT INTO partemensual (
+        "año", mes,
+        total_dias_trabajados, total_km, total_horas, total_envios,
+        total_dietas, total_alojamiento, total_transporte, total_gasolina,
+        total_comida, total_material, total_otros_gastos,
+        fecha_creacion, fecha_actualizacion, user_id, company_id
+    )
+    SELECT
+        :anio, :mes,
+        COUNT(p.id),
+        COALESCE(SUM(p.km_diferencia), 0),
+        COALESCE(SUM(p.horas), 0),
+        COALESCE(SUM(p.num_envios), 0),
+        COALESCE(SUM(p.dietas), 0),
+        COALESCE(SUM(p.alojamiento), 0),
+        COALESCE(SUM(p.transporte_billetes), 0),
+        COALESCE(SUM(p.gasolina), 0),
+        COALESCE(SUM(p.comida), 0),
+        COALESCE(SUM(p.material), 0),
+        COALESCE(SUM(p.otros_gastos), 0),
+        :ahora, :ahora, u.id, u.company_id
+    FROM "user" u
+    LEFT JOIN partedia p
+        ON p.user_id = u.id AND p.fecha >= :desde AND p.fecha <= :hasta
+    WHERE u.company_id = :cid AND u.role = 'repartidor'
+    GROUP BY u.id, u.company_id
+    ON CONFLICT (user_id, "año", mes) DO UPDATE SET
+        total_dias_trabajados = excluded.total_dias_trabajados,
+        total_km = excluded.total_km,
+        total_horas = excluded.total_horas,
+        total_envios = excluded.total_envios,
+        total_dietas = excluded.total_dietas,
+        total_alojamiento = excluded.total_alojamiento,
+        total_transporte = excluded.total_transporte,
+        total_gasolina = excluded.total_gasolina,
+        total_comida = excluded.total_comida,
+        total_material = excluded.total_material,
+        total_otros_gastos = excluded.total_otros_gastos,
+        fecha_actualizacion = excluded.fecha_actualizacion
+""").bindparams(
+    bindparam("ahora", type_=DateTime()),
+    bindparam("desde", type_=Date()),
+    bindparam("hasta", type_=Date()),
+)
+
+def cerrar_mes(db: Session, company_id: int, año: int, mes: int, bloquear: bool = False, admin_id: Optional[int] = None) -> int:
+    """Genera o refresca el ParteMensual de todos los repartidores de la empresa.
+    Devuelve el número de resúmenes escritos. No hace commit.
+    Lanza MesArchivado si el mes ya está archivado (sus resúmenes saldrían a cero)."""
+    comprobar_mes_no_archivado(db, company_id, año, mes)
+    resultado = db.exec(_SQL_CIERRE, params={
+        "anio": año,
+        "mes": mes,
+        "cid": company_id,
+        "desde": date(año, mes, 1),
+        "hasta": date(año, mes, monthrange(año, mes)[1]),
+        "ahora": datetime.now(),
+    })
+
+    cierre = db.exec(
+        select(CierreMes).where(CierreMes.company_id == company_id, CierreMes.año == año, CierreMes.mes == mes)
+    ).first()
+    if not cierre:
+        cierre = CierreMes(año=año, mes=mes, company_id=company_id)
+    cierre.bloqueado = bloquear
+    cierre.fecha_cierre = datetime.now()
+    cierre.cerrado_por = admin_id
+    db.add(cierre)
+    anotar_cambio(db, company_id, fecha=date(año, mes, 1))
+    return resultado.rowcount
+
+def reabrir_mes(db: Session, company_id: int, año: int, mes: int) -> bool:
+    """Quita el bloqueo de un mes. No hace commit. Lanza MesArchivado si el mes está archivado."""
+    comprobar_mes_no_archivado(db, company_id, año, mes)
+    cierre = db.exec(
+        select(CierreMes).where(CierreMes.company_id == company_id, CierreMes.año == año, CierreMes.mes == mes)
+    ).first()
+    if not cierre or not cierre.bloqueado:
+        return False
+    cierre.bloqueado = False
+    db.add(cierre)
+    anotar_cambio(db, company_id, fecha=date(año, mes, 1))
+    return True
+
+def mes_bloqueado(db: Session, company_id: int, fecha: date) -> bool:
+    return db.exec(
+        select(CierreMes.id).where(
+            CierreMes.company_id == company_id,
+            CierreMes.año == fecha.year,
+            CierreMes.mes == fecha.month,
+            CierreMes.bloqueado == True,  # noqa: E712
+        )
+    ).first() is not None
+
+def comprobar_mes_abierto(db: Session, company_id: int, fecha: date):
+    if mes_bloqueado(db, company_id, fecha):
+        raise MesCerrado(f"El mes {fecha.month:02d}/{fecha.year} está cerrado y no admite cambios.")
+
+@al_cambiar_parte
+def _impedir_cambios_en_mes_cerrado(db: Session, parte: ParteDia, accion: str):
+    """Red de seguridad para cualquier ruta de escritura que no compruebe el bloqueo antes"""
+    comprobar_mes_abierto(db, parte.company_id, parte.fecha)
+
+def cierres_empresa(db: Session, company_id: int) -> List[CierreMes]:
+    return db.exec(
+        select(CierreMes)
+        .where(CierreMes.company_id == company_id)
+        .order_by(CierreMes.año.desc(), CierreMes.mes.desc())
+    ).all()
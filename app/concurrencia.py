@@ -0,0 +1,40 @@
+from __future__ import annotations
+from typing import Optional
+from .models import ParteDia
+from .eventos import al_cambiar_parte
+
+# Control de concurrencia optimista de los partes.
+#
+# ParteDia.version sube cada vez que se guarda el parte (parte_cambiado) y el ORM
+# la comprueba en el UPDATE (o DELETE), así que dos escrituras simultáneas no
+# pueden pisarse: la segunda no encuentra la fila y falla con StaleDataError. Además el cliente puede enviar la
+# versión que leyó: si el parte ha cambiado desde entonces se rechaza la edición
+# (409) y se le devuelve el parte actual para que combine los cambios.
+
+class ParteModificado(Exception):
+    """El parte ha cambiado desde que el cliente lo leyó"""
+
+    def __init__(self, parte_id: int, version: Optional[int] = None):
+        super().__init__("Otra persona ha modificado este parte mientras lo editabas")
+        self.parte_id = parte_id
+        self.version = version
+
+def leer_version(valor) -> Optional[int]:
+    """Versión enviada por el cliente (formulario, JSON o query); None si no envía"""
+    if valor is None or str(valor).strip() == "":
+        return None
+    try:
+        return int(valor)
+    except (TypeError, ValueError):
+        raise ValueError("Versión del parte inválida")
+
+def comprobar_version(parte: ParteDia, esperada: Optional[int]):
+    """Lanza ParteModificado si el cliente editó una versión anterior del parte"""
+    if esperada is not None and parte.version != esperada:
+        raise ParteModificado(parte.id, parte.version)
+
+@al_cambiar_parte
+def _subir_version(db, parte: ParteDia, accion: str):
+    if accion == "actualizado":
+        parte.version = (parte.version or 1) + 1
+        db.add(parte)
@@ -0,0 +1,106 @@
+from __future__ import annotations
+import os
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional
+from sqlalchemy import DateTime, bindparam, func
+from sqlalchemy.engine import Engine
+from sqlmodel import Session, select, text
+from .models import Company, UsoEmpresa
+
+# Cuotas por empresa.
+#
+# Cada empresa puede exportar (Excel, PDF, ZIP, NDJSON) e importar como mucho un
+# número de filas por hora. El consumo se anota en UsoEmpresa (una fila por
+# empresa, recurso y hora), así las cuotas valen para todos los workers y
+# sobreviven a los reinicios. Una operación se rechaza si al empezar la empresa
+# ya ha gastado su cuota de la hora; la que la cruza se termina.
+#
+# El número de operaciones pesadas simultáneas de cada empresa y el turno entre
+# empresas se controlan en app/admision.py (CUOTA_PESADAS_EMPRESA).
+
+FILAS_EXPORTADAS, FILAS_IMPORTADAS = "filas_exportadas", "filas_importadas"
+
+LIMITES = {  # por empresa y hora, 0 = sin límite
+    FILAS_EXPORTADAS: int(os.getenv("CUOTA_FILAS_EXPORTADAS_HORA", "1000000")),
+    FILAS_IMPORTADAS: int(os.getenv("CUOTA_FILAS_IMPORTADAS_HORA", "500000")),
+}
+
+_SQL_ANOTAR = text("""
+    INSERT INTO usoempresa (hora, recurso, cantidad, company_id)
+    VALUES (:hora, :recurso, :cantidad, :cid)
+    ON CONFLICT (company_id, recurso, hora) DO UPDATE SET
+        cantidad = usoempresa.cantidad + excluded.cantidad
+""").bindparams(bindparam("hora", type_=DateTime()))
+
+class CuotaSuperada(Exception):
+    """La empresa ha gastado la cuota de la hora de un recurso"""
+
+    def __init__(self, recurso: str, limite: int, reintentar_en: int):
+        super().__init__(f"Se ha alcanzado el límite de {limite} {recurso.replace('_', ' ')} por hora. Reintenta en {reintentar_en // 60 + 1} min")
+        self.recurso = recurso
+        self.limite = limite
+        self.reintentar_en = reintentar_en
+
+def _hora(momento: datetime) -> datetime:
+    return momento.replace(minute=0, second=0, microsecond=0)
+
+class Cuotas:
+    def __init__(self):
+        self.engine: Optional[Engine] = None
+
+    def conectar(self, engine: Engine):
+        self.engine = engine
+
+    def comprobar(self, company_id: int, recurso: str):
+        """Lanza CuotaSuperada si la empresa ya ha gastado la cuota de esta hora"""
+        limite = LIMITES[recurso]
+        if limite <= 0:
+            return
+        ahora = datetime.now()
+        with Session(self.engine) as db:
+            usado = db.exec(
+                select(UsoEmpresa.cantidad).where(
+                    UsoEmpresa.company_id == company_id,
+                    UsoEmpresa.recurso == recurso,
+                    UsoEmpresa.hora == _hora(ahora),
+                )
+            ).first() or 0
+        if usado >= limite:
+            siguiente = _hora(ahora) + timedelta(hours=1)
+            raise CuotaSuperada(recurso, limite, int((siguiente - ahora).total_seconds()) + 1)
+
+    def anotar(self, company_id: int, recurso: str, cantidad: int):
+        """Suma consumo a la hora actual (en su propia transacción)"""
+        if cantidad <= 0:
+            return
+        with Session(self.engine) as db:
+            db.exec(_SQL_ANOTAR, params={
+                "hora": _hora(datetime.now()), "recurso": recurso, "cantidad": cantidad, "cid": company_id,
+            })
+            db.commit()
+
+    def uso(self, horas: int = 24) -> List[dict]:
+        """Consumo de cada empresa en la hora actual y en las últimas `horas`"""
+        actual = _hora(datetime.now())
+        desde = actual - timedelta(hours=horas - 1)
+        empresas: Dict[int, dict] = {}
+        with Session(self.engine) as db:
+            nombres = dict(db.exec(select(Company.id, Company.name)).all())
+            filas = db.exec(
+                select(UsoEmpresa.company_id, UsoEmpresa.recurso, UsoEmpresa.hora == actual, func.sum(UsoEmpresa.cantidad))
+                .where(UsoEmpresa.hora >= desde)
+                .group_by(UsoEmpresa.company_id, UsoEmpresa.recurso, UsoEmpresa.hora == actual)
+            ).all()
+        for company_id, recurso, es_actual, cantidad in filas:
+            empresa = empresas.setdefault(company_id, {
+                "company_id": company_id,
+                "nombre": nombres.get(company_id),
+                **{f"{r}_hora": 0 for r in LIMITES},
+                **{f"{r}_{horas}h": 0 for r in LIMITES},
+            })
+            if es_actual:
+                empresa[f"{recurso}_hora"] += cantidad
+            empresa[f"{recurso}_{horas}h"] += cantidad
+        return sorted(empresas.values(), key=lambda e: e["company_id"])
+
+cuotas = Cuotas()
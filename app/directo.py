@@ -0,0 +1,274 @@
+from __future__ import annotations
+import asyncio, json, logging, os, queue, threading
+from collections import defaultdict
+from datetime import date
+from typing import Dict, List, Optional, Set, Tuple
+from sqlalchemy import func
+from sqlalchemy.engine import Engine
+from sqlmodel import Session, select
+from .models import CambioParte, ParteDia, User
+from .eventos import Cambio, al_confirmar
+from .agregados import kpis
+
+# Cambios en directo para el panel de administración (Server-Sent Events).
+#
+# Cada página del panel abierta es una suscripción de su empresa con el rango de
+# fechas que está mostrando. Cuando se confirman cambios de la empresa (en este
+# proceso o, a través del bus, en otro) un hilo lee una sola vez los partes
+# cambiados (CambioParte) y los totales de los repartidores afectados en cada
+# rango (cubo de agregados) y los reparte a las suscripciones.
+#
+# Cada suscripción tiene una cola de TAMAÑO_COLA mensajes: si el navegador no
+# los consume a tiempo se le desconecta (y al reconectar recupera lo perdido
+# con Last-Event-ID). Las conexiones se cierran cada DURACION_SEGUNDOS para que
+# no retrasen el reciclado de los workers; el navegador reconecta solo.
+
+TAMAÑO_COLA = 100
+LATIDO_SEGUNDOS = 15
+DURACION_SEGUNDOS = float(os.getenv("DIRECTO_DURACION_SEGUNDOS", "60"))
+MAX_CAMBIOS = 200  # por encima se pide recargar la página
+# Con varias transacciones a la vez los ids de CambioParte pueden confirmarse
+# desordenados: se vuelven a leer los últimos y se descartan los ya enviados
+SOLAPE_IDS = 50
+
+log = logging.getLogger(__name__)
+
+class Suscripcion:
+    def __init__(self, company_id: int, desde: date, hasta: date, loop: asyncio.AbstractEventLoop):
+        self.company_id = company_id
+        self.desde = desde
+        self.hasta = hasta
+        self.loop = loop
+        self.cola: "asyncio.Queue[Optional[dict]]" = asyncio.Queue(maxsize=TAMAÑO_COLA)
+        self.cerrada = False
+
+    def interesa(self, mensaje: dict) -> bool:
+        """Los partes de fuera del rango de la página no se envían (los borrados sí: no se sabe su fecha)"""
+        fecha = mensaje.get("parte", {}).get("fecha")
+        return fecha is None or self.desde <= _fecha(fecha) <= self.hasta
+
+    def entregar(self, mensaje: dict):
+        """En el bucle de eventos de la conexión"""
+        if self.cerrada:
+            return
+        try:
+            self.cola.put_nowait(mensaje)
+        except asyncio.QueueFull:
+            # Consumidor lento: se vacía la cola y se cierra la conexión
+            self.cerrada = True
+            while not self.cola.empty():
+                self.cola.get_nowait()
+            self.cola.put_nowait(None)
+
+    def enviar(self, mensaje: dict):
+        """Desde cualquier hilo"""
+        self.loop.call_soon_threadsafe(self.entregar, mensaje)
+
+def _fecha(valor) -> date:
+    return valor if isinstance(valor, date) else date.fromisoformat(str(valor)[:10])
+
+def _mensaje_parte(cambio: CambioParte, parte: Optional[ParteDia], usernames: Dict[int, str]) -> dict:
+    datos = {"id": cambio.parte_id, "user_id": cambio.user_id, "username": usernames.get(cambio.user_id)}
+    if parte is not None:
+        datos.update({
+            "fecha": parte.fecha.isoformat(),
+            "salida_lugar": parte.salida_lugar,
+            "llegada_lugar": parte.llegada_lugar,
+            "km_diferencia": parte.km_diferencia,
+            "horas": parte.horas,
+            "num_envios": parte.num_envios,
+            "total_gastos": parte.total_gastos,
+        })
+    return {"tipo": "parte", "id": cambio.id, "accion": cambio.accion, "parte": datos}
+
+def _mensaje_totales(db: Session, company_id: int, desde: date, hasta: date, user_ids: Set[int]) -> dict:
+    def resumen(user_id: Optional[int]) -> dict:
+        k = kpis(db, company_id, desde, hasta, user_id)
+        return {"partes": k["partes"], "km": k["km"], "horas": k["horas"], "total_gastos": k["total_gastos"]}
+    return {
+        "tipo": "totales",
+        "empresa": resumen(None),
+        "repartidores": {str(u): resumen(u) for u in sorted(user_ids)},
+    }
+
+class Directo:
+    def __init__(self):
+        self.engine: Optional[Engine] = None
+        self._suscripciones: Dict[int, Set[Suscripcion]] = defaultdict(set)
+        self._ultimo: Dict[int, int] = {}  # último CambioParte leído de cada empresa
+        self._enviados: Dict[int, Set[int]] = {}
+        self._lock = threading.Lock()
+        self._cola: "queue.Queue[Optional[List[Cambio]]]" = queue.Queue()
+        self._hilo: Optional[threading.Thread] = None
+
+    def conectar(self, engine: Engine):
+        self.engine = engine
+
+    def iniciar(self):
+        self._hilo = threading.Thread(target=self._bucle, name="directo", daemon=True)
+        self._hilo.start()
+
+    def parar(self):
+        self._cola.put(None)
+        if self._hilo is not None:
+            self._hilo.join(timeout=5)
+        with self._lock:
+            for subs in self._suscripciones.values():
+                for sub in subs:
+                    sub.loop.call_soon_threadsafe(sub.entregar, None)
+
+    # -- Suscripciones
+
+    def pendientes(self, company_id: int, desde_id: Optional[int]) -> List[dict]:
+        """Al reconectar: los cambios posteriores a Last-Event-ID (en un hilo, consulta la base de datos)"""
+        if desde_id is None:
+            return []
+        with Session(self.engine) as db:
+            mensajes, _, demasiados = self._leer_cambios(db, company_id, desde_id, set())
+        return [{"tipo": "recargar"}] if demasiados else mensajes
+
+    def preparar(self, company_id: int) -> int:
+        """Antes de suscribirse (en un hilo): desde dónde hay que leer los cambios de la empresa"""
+        with self._lock:
+            if company_id in self._ultimo:
+                return self._ultimo[company_id]
+        with Session(self.engine) as db:
+            return db.exec(select(func.max(CambioParte.id)).where(CambioParte.company_id == company_id)).one() or 0
+
+    def suscribir(self, company_id: int, desde: date, hasta: date, ultimo: int) -> Suscripcion:
+        """En el bucle de eventos de la conexión; `ultimo` es lo que devolvió preparar()"""
+        sub = Suscripcion(company_id, desde, hasta, asyncio.get_running_loop())
+        with self._lock:
+            self._suscripciones[company_id].add(sub)
+            self._ultimo.setdefault(company_id, ultimo)
+            self._enviados.setdefault(company_id, set())
+        return sub
+
+    def baja(self, sub: Suscripcion):
+        with self._lock:
+            subs = self._suscripciones.get(sub.company_id)
+            if subs is None:
+                return
+            subs.discard(sub)
+            if not subs:
+                del self._suscripciones[sub.company_id]
+                self._ultimo.pop(sub.company_id, None)
+                self._enviados.pop(sub.company_id, None)
+
+    # -- Cambios
+
+    def avisar(self, cambios: List[Cambio]):
+        with self._lock:
+            if not any(c.company_id is None or c.company_id in self._suscripciones for c in cambios):
+                return
+        self._cola.put(cambios)
+
+    def _bucle(self):
+        while True:
+            cambios = self._cola.get()
+            if cambios is None:
+                return
+            # Se juntan los cambios que se hayan acumulado mientras tanto
+            lote = set(cambios)
+            while True:
+                try:
+                    mas = self._cola.get_nowait()
+                except queue.Empty:
+                    break
+                if mas is None:
+                    self._cola.put(None)
+                    break
+                lote.update(mas)
+            try:
+                self._repartir(lote)
+            except Exception:
+                log.exception("Error enviando cambios en directo")
+
+    def _repartir(self, cambios: Set[Cambio]):
+        with self._lock:
+            empresas = {c: set(s) for c, s in self._suscripciones.items()}
+        if any(c.company_id is None for c in cambios):
+            for subs in empresas.values():
+                for sub in subs:
+                    sub.enviar({"tipo": "recargar"})
+            return
+        por_empresa: Dict[int, List[Cambio]] = defaultdict(list)
+        for c in cambios:
+            if c.company_id in empresas:
+                por_empresa[c.company_id].append(c)
+        for company_id, cambios_empresa in por_empresa.items():
+            self._repartir_empresa(company_id, cambios_empresa, empresas[company_id])
+
+    def _leer_cambios(self, db: Session, company_id: int, desde_id: int, enviados: Set[int]) -> Tuple[List[dict], int, bool]:
+        """Mensajes de los partes cambiados desde `desde_id`, el último id leído y si son demasiados"""
+        filas = db.exec(
+            select(CambioParte)
+            .where(CambioParte.company_id == company_id, CambioParte.id > desde_id)
+            .order_by(CambioParte.id)
+            .limit(MAX_CAMBIOS + 1)
+        ).all()
+        filas = [f for f in filas if f.id not in enviados]
+        if len(filas) > MAX_CAMBIOS:
+            return [], filas[-1].id, True
+        partes = {}
+        if filas:
+            ids = {f.parte_id for f in filas if f.accion not in ("eliminado", "archivado")}
+            partes = {p.id: p for p in db.exec(select(ParteDia).where(ParteDia.id.in_(ids))).all()}
+        usernames = dict(db.exec(select(User.id, User.username).where(User.company_id == company_id)).all())
+        mensajes = [_mensaje_parte(f, partes.get(f.parte_id), usernames) for f in filas]
+        return mensajes, max([f.id for f in filas], default=desde_id), False
+
+    def _repartir_empresa(self, company_id: int, cambios: List[Cambio], subs: Set[Suscripcion]):
+        with self._lock:
+            ultimo = self._ultimo.get(company_id)
+            enviados = set(self._enviados.get(company_id, ()))
+        if ultimo is None:
+            return
+
+        with Session(self.engine) as db:
+            mensajes, nuevo_ultimo, demasiados = self._leer_cambios(db, company_id, max(ultimo - SOLAPE_IDS, 0), enviados)
+            # Cambios que no son de un repartidor concreto (p. ej. cerrar un mes): recargar
+            if demasiados or any(c.user_id is None for c in cambios):
+                mensajes = [{"tipo": "recargar"}]
+                afectados: Dict[int, Set[date]] = {}
+            else:
+                afectados = defaultdict(set)
+                for c in cambios:
+                    afectados[c.user_id].add(date(c.año, c.mes, 1) if c.año else date.min)
+
+            # Totales de los repartidores afectados, una vez por rango distinto
+            totales: Dict[Tuple[date, date], dict] = {}
+            for rango in {(s.desde, s.hasta) for s in subs}:
+                desde, hasta = rango
+                user_ids = {
+                    u for u, meses in afectados.items()
+                    if any(m == date.min or (m <= hasta and (m.year, m.month) >= (desde.year, desde.month)) for m in meses)
+                }
+                if user_ids:
+                    totales[rango] = _mensaje_totales(db, company_id, desde, hasta, user_ids)
+
+        with self._lock:
+            if company_id in self._ultimo:
+                self._ultimo[company_id] = max(self._ultimo[company_id], nuevo_ultimo)
+                recientes = self._enviados[company_id]
+                recientes.update(m["id"] for m in mensajes if m["tipo"] == "parte")
+                # Solo hace falta recordar los que pueden volver a leerse
+                limite = self._ultimo[company_id] - SOLAPE_IDS
+                self._enviados[company_id] = {i for i in recientes if i > limite}
+
+        for sub in subs:
+            for m in mensajes:
+                if sub.interesa(m):
+                    sub.enviar(m)
+            if (sub.desde, sub.hasta) in totales:
+                sub.enviar(totales[(sub.desde, sub.hasta)])
+
+def evento_sse(mensaje: dict) -> str:
+    id_ = f"id: {mensaje['id']}\n" if "id" in mensaje else ""
+    return f"{id_}event: {mensaje['tipo']}\ndata: {json.dumps(mensaje, ensure_ascii=False)}\n\n"
+
+directo = Directo()
+
+@al_confirmar
+def _avisar_directo(cambios: List[Cambio]):
+    directo.avisar(cambios)
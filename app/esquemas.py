@@ -0,0 +1,94 @@
+from __future__ import annotations
+from datetime import date
+from typing import Any, Dict, List, Optional
+from fastapi.responses import JSONResponse, ORJSONResponse
+from pydantic import BaseModel, ConfigDict, ValidationInfo, field_validator
+
+try:
+    import orjson
+except ImportError:  # orjson es opcional
+    orjson = None
+
+# Clase de respuesta por defecto de la aplicación
+RespuestaJSON = ORJSONResponse if orjson is not None else JSONResponse
+
+# Modelos de respuesta de la API JSON. Se construyen directamente desde los
+# objetos del ORM (from_attributes) y pydantic los serializa sin pasar por
+# jsonable_encoder.
+
+class _Esquema(BaseModel):
+    model_config = ConfigDict(from_attributes=True)
+
+class _SinNulos(_Esquema):
+    """Los None del modelo se envían con el valor por defecto del campo ("" o 0),
+    que es lo que espera el calendario"""
+
+    @field_validator("*", mode="before")
+    @classmethod
+    def _nulo_a_defecto(cls, valor: Any, info: ValidationInfo) -> Any:
+        if valor is None:
+            return cls.model_fields[info.field_name].default
+        return valor
+
+class ParteDetalle(_SinNulos):
+    """Parte completo para el formulario de edición (/api/parte/{id})"""
+    id: int
+    fecha: date
+    km_salida: float = 0
+    km_llegada: float = 0
+    km_diferencia: float = 0
+    repostaje: str = ""
+    num_factura: str = ""
+    salida_lugar: str = ""
+    salida_hora: str = ""
+    llegada_lugar: str = ""
+    llegada_hora: str = ""
+    tiempo_total: str = ""
+    observaciones: str = ""
+    dietas: float = 0
+    alojamiento: float = 0
+    transporte_billetes: float = 0
+    gasolina: float = 0
+    comida: float = 0
+    otros_consumiciones: float = 0
+    material: float = 0
+    otros_gastos: float = 0
+    num_envios: int = 0
+    horas: float = 0
+    version: int = 1  # se devuelve al guardar para detectar ediciones simultáneas
+
+class ParteResumen(_Esquema):
+    """Parte en la lista de un día del calendario (/api/partes-dia/{fecha})"""
+    id: int
+    fecha: date
+    salida_lugar: Optional[str] = None
+    salida_hora: Optional[str] = None
+    llegada_lugar: Optional[str] = None
+    llegada_hora: Optional[str] = None
+    km_diferencia: float = 0
+    num_envios: int = 0
+    horas: float = 0
+    dietas: float = 0
+    alojamiento: float = 0
+    transporte_billetes: float = 0
+    gasolina: float = 0
+    comida: float = 0
+    otros_consumiciones: float = 0
+    material: float = 0
+    otros_gastos: float = 0
+    observaciones: Optional[str] = None
+
+class Confirmacion(BaseModel):
+    success: bool = True
+    version: Optional[int] = None  # nueva versión del parte guardado
+
+class Mensaje(BaseModel):
+    message: str
+
+class CambiosSync(BaseModel):
+    cambios: List[Dict[str, Any]]
+    cursor: str
+    hay_mas: bool
+
+class ResultadoSync(CambiosSync):
+    resultados: List[Dict[str, Any]]
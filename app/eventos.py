@@ -0,0 +1,76 @@
+from __future__ import annotations
+from datetime import date
+from typing import Callable, List, NamedTuple, Optional
+from sqlalchemy import event
+from sqlalchemy.orm import Session as SessionORM
+from sqlmodel import Session
+from .models import ParteDia
+
+# Acciones posibles: 'creado' | 'actualizado' | 'eliminado'
+OyenteParte = Callable[[Session, ParteDia, str], None]
+
+_oyentes: List[OyenteParte] = []
+
+def al_cambiar_parte(func: OyenteParte) -> OyenteParte:
+    """Registra una función que se llama cada vez que se escribe un parte diario"""
+    _oyentes.append(func)
+    return func
+
+def parte_cambiado(db: Session, parte: ParteDia, accion: str):
+    """Avisa a los oyentes dentro de la transacción en curso (antes del commit)"""
+    for oyente in _oyentes:
+        oyente(db, parte, accion)
+    anotar_cambio(db, parte.company_id, parte.user_id, parte.fecha)
+
+# ---------------------------------------------------------------------------
+# Cambios confirmados: se avisa después del commit (nunca si hay rollback), para
+# que las cachés no se vacíen antes de que los datos nuevos sean visibles.
+
+class Cambio(NamedTuple):
+    """Qué ha cambiado. user_id, año y mes a None significan "toda la empresa";
+    company_id a None, "todo" (p. ej. si el bus de invalidación perdió mensajes)."""
+    company_id: Optional[int]
+    user_id: Optional[int] = None
+    año: Optional[int] = None
+    mes: Optional[int] = None
+
+OyenteConfirmado = Callable[[List[Cambio]], None]
+
+_oyentes_confirmados: List[OyenteConfirmado] = []
+
+# Reenvía los cambios confirmados en este proceso a los demás (ver app/bus.py)
+_publicador: Optional[OyenteConfirmado] = None
+
+_CLAVE_PENDIENTES = "cambios_pendientes"
+
+def al_confirmar(func: OyenteConfirmado) -> OyenteConfirmado:
+    """Registra una función que recibe los cambios de cada transacción confirmada"""
+    _oyentes_confirmados.append(func)
+    return func
+
+def anotar_cambio(db: Session, company_id: int, user_id: Optional[int] = None, fecha: Optional[date] = None):
+    """Anota un cambio para avisar cuando se confirme la transacción en curso"""
+    cambio = Cambio(company_id, user_id, fecha.year if fecha else None, fecha.month if fecha else None)
+    db.info.setdefault(_CLAVE_PENDIENTES, set()).add(cambio)
+
+def avisar_cambios(cambios: List[Cambio]):
+    """Avisa a los oyentes de este proceso (cambios propios o recibidos del bus)"""
+    for oyente in _oyentes_confirmados:
+        oyente(cambios)
+
+def conectar_publicador(func: Optional[OyenteConfirmado]):
+    global _publicador
+    _publicador = func
+
+@event.listens_for(SessionORM, "after_commit")
+def _despues_del_commit(db: SessionORM):
+    pendientes = db.info.pop(_CLAVE_PENDIENTES, None)
+    if pendientes:
+        cambios = sorted(pendientes, key=lambda c: tuple(-1 if v is None else v for v in c))
+        avisar_cambios(cambios)
+        if _publicador is not None:
+            _publicador(cambios)
+
+@event.listens_for(SessionORM, "after_rollback")
+def _despues_del_rollback(db: SessionORM):
+    db.info.pop(_CLAVE_PENDIENTES, None)
@@ -0,0 +1,511 @@
+from __future__ import annotations
+import csv, io, json
+from datetime import datetime
+from typing import Dict, Iterator, List, Optional, Set, Tuple
+import pandas as pd
+from sqlalchemy import Table, insert
+from sqlalchemy.exc import IntegrityError
+from sqlmodel import Session, select, func
+from .models import GASTOS_CAMPOS, CambioParte, ParteDia, Ruta, User
+from .busqueda import TABLA as TABLA_BUSQUEDA
+from .cierre import cierres_empresa
+from .eventos import anotar_cambio
+from .agregados import recalcular as recalcular_agregados
+from .sync import CAMPOS_FLOAT, CAMPOS_INT, CAMPOS_TEXTO, CAMPOS_RUTA_TEXTO
+from .tiempos import parse_hora, parse_duracion, minutos_entre, formatear_hora
+
+# Importación masiva de partes históricos (alta de una empresa nueva).
+#
+# Acepta NDJSON (un parte por línea, con "rutas" opcional), CSV (',' o ';') y el
+# mismo XLSX que genera /admin/export/excel. El fichero se lee en lotes, cada lote
+# se valida con pandas de forma vectorizada y se inserta con INSERT de varias filas
+# (COPY en PostgreSQL) en su propia transacción.
+#
+# Los partes no pasan por el ORM ni por parte_cambiado(): el total de gastos, las
+# horas normalizadas, el índice de búsqueda, el registro de cambios de la
+# sincronización, los agregados de KPIs y la comprobación de meses bloqueados
+# se hacen aquí en bloque.
+
+TAMAÑO_LOTE = 5000
+MAX_ERRORES_INFORME = 1000
+
+FORMATOS = ("ndjson", "csv", "xlsx")
+
+# "km" es el campo antiguo que siguen usando los informes
+COLUMNAS_FLOAT = CAMPOS_FLOAT + ("km",)
+
+class ErrorImportacion(ValueError):
+    """El fichero entero no se puede importar (formato desconocido, faltan columnas...)"""
+
+def detectar_formato(nombre: Optional[str], content_type: Optional[str] = None) -> str:
+    nombre = (nombre or "").lower()
+    content_type = (content_type or "").lower()
+    if nombre.endswith((".ndjson", ".jsonl", ".json")) or "json" in content_type:
+        return "ndjson"
+    if nombre.endswith(".csv") or "csv" in content_type:
+        return "csv"
+    if nombre.endswith(".xlsx") or "spreadsheetml" in content_type:
+        return "xlsx"
+    raise ErrorImportacion("Formato no soportado. Use NDJSON, CSV o XLSX")
+
+# ---------------------------------------------------------------------------
+# Lectura en lotes. Cada lote es un DataFrame con "_fila" (fila del fichero)
+# y "_error" (error de lectura de esa fila, si lo hay).
+
+def _lote(filas: List[dict]) -> pd.DataFrame:
+    df = pd.DataFrame(filas)
+    if "_error" not in df.columns:
+        df["_error"] = None
+    return df
+
+def _leer_ndjson(fichero) -> Iterator[pd.DataFrame]:
+    filas: List[dict] = []
+    for n, linea in enumerate(io.TextIOWrapper(fichero, encoding="utf-8-sig"), start=1):
+        linea = linea.strip()
+        if not linea:
+            continue
+        try:
+            obj = json.loads(linea)
+            if not isinstance(obj, dict):
+                raise ValueError
+            obj["_fila"] = n
+        except ValueError:
+            obj = {"_fila": n, "_error": "JSON inválido"}
+        filas.append(obj)
+        if len(filas) >= TAMAÑO_LOTE:
+            yield _lote(filas)
+            filas = []
+    if filas:
+        yield _lote(filas)
+
+def _leer_csv(fichero) -> Iterator[pd.DataFrame]:
+    # Excel en español guarda los CSV con ';'
+    cabecera = fichero.read(4096)
+    fichero.seek(0)
+    if isinstance(cabecera, bytes):
+        cabecera = cabecera.decode("utf-8", errors="ignore")
+    primera = cabecera.splitlines()[0] if cabecera else ""
+    sep = ";" if primera.count(";") > primera.count(",") else ","
+
+    inicio = 2  # la fila 1 es la cabecera
+    for df in pd.read_csv(fichero, sep=sep, dtype=str, keep_default_na=False,
+                          encoding="utf-8-sig", chunksize=TAMAÑO_LOTE):
+        df["_fila"] = range(inicio, inicio + len(df))
+        df["_error"] = None
+        inicio += len(df)
+        yield df
+
+def _leer_xlsx(fichero) -> Iterator[pd.DataFrame]:
+    from openpyxl import load_workbook
+
+    wb = load_workbook(fichero, read_only=True, data_only=True)
+    try:
+        filas = wb.active.iter_rows(values_only=True)
+        cabecera = [str(c).strip() if c is not None else "" for c in next(filas, ())]
+        lote: List[dict] = []
+        for n, valores in enumerate(filas, start=2):
+            if all(v is None or v == "" for v in valores):
+                continue
+            fila = dict(zip(cabecera, valores))
+            fila["_fila"] = n
+            lote.append(fila)
+            if len(lote) >= TAMAÑO_LOTE:
+                yield _lote(lote)
+                lote = []
+        if lote:
+            yield _lote(lote)
+    finally:
+        wb.close()
+
+_LECTORES = {"ndjson": _leer_ndjson, "csv": _leer_csv, "xlsx": _leer_xlsx}
+
+# ---------------------------------------------------------------------------
+# Validación vectorizada
+
+def _marcar(errores: pd.Series, mascara, mensaje) -> pd.Series:
+    """Anota el error en las filas marcadas que todavía no tenían ninguno"""
+    mascara = pd.Series(mascara, index=errores.index).fillna(False).astype(bool)
+    mensajes = mensaje if isinstance(mensaje, pd.Series) else pd.Series(mensaje, index=errores.index)
+    return errores.where(errores.notna() | ~mascara, mensajes)
+
+def _vacio(serie: pd.Series) -> pd.Series:
+    return serie.isna() | (serie.astype(str).str.strip() == "")
+
+def _nulos(df: pd.DataFrame) -> pd.Series:
+    return pd.Series([None] * len(df), index=df.index, dtype=object)
+
+def _texto(serie: pd.Series) -> pd.Series:
+    """Textos sin espacios sobrantes; vacío -> None"""
+    limpio = serie.where(serie.notna(), "").astype(str).str.strip()
+    return pd.Series([v or None for v in limpio], index=serie.index, dtype=object)
+
+def _numeros(serie: pd.Series) -> Tuple[pd.Series, pd.Series]:
+    """(valores, mascara_invalidos). Admite coma decimal; vacío cuenta como 0."""
+    vacios = _vacio(serie)
+    texto = serie.astype(str).str.strip().str.replace(",", ".", regex=False)
+    valores = pd.to_numeric(texto.where(~vacios, "0"), errors="coerce")
+    return valores.fillna(0), valores.isna()
+
+def _parsear_unicos(serie: pd.Series, parser) -> Tuple[pd.Series, pd.Series]:
+    """Aplica el parser una vez por valor distinto: (valores, mascara_invalidos)"""
+    texto = serie.where(serie.notna(), "").astype(str).str.strip()
+    resultados = {}
+    for valor in texto.unique():
+        try:
+            resultados[valor] = (parser(valor), False)
+        except ValueError:
+            resultados[valor] = (None, True)
+    valores = texto.map(lambda v: resultados[v][0])
+    invalidos = texto.map(lambda v: resultados[v][1]).astype(bool)
+    return valores, invalidos
+
+def _validar_rutas(valor) -> List[dict]:
+    """Rutas de un parte: lista (NDJSON) o texto JSON (CSV/XLSX). Lanza ValueError."""
+    if valor is None or (isinstance(valor, float) and pd.isna(valor)) or valor == "":
+        return []
+    if isinstance(valor, str):
+        valor = json.loads(valor)
+    if not isinstance(valor, list):
+        raise ValueError("rutas debe ser una lista")
+    rutas = []
+    for i, r in enumerate(valor, start=1):
+        if not isinstance(r, dict):
+            raise ValueError("Cada ruta debe ser un objeto")
+        ruta = {campo: (str(r.get(campo) or "")).strip() or None for campo in CAMPOS_RUTA_TEXTO}
+        salida = parse_hora(r.get("salida_hora"))
+        llegada = parse_hora(r.get("llegada_hora"))
+        ruta.update(
+            orden=int(r.get("orden") or i),
+            salida_hora=formatear_hora(salida),
+            llegada_hora=formatear_hora(llegada),
+            salida_hora_norm=salida,
+            llegada_hora_norm=llegada,
+            duracion_minutos=minutos_entre(salida, llegada),
+            km_ruta=float(r.get("km_ruta") or 0),
+            num_envios_ruta=int(r.get("num_envios_ruta") or 0),
+        )
+        rutas.append(ruta)
+    return rutas
+
+def validar_lote(
+    df: pd.DataFrame,
+    usuarios: Dict[str, int],
+    company_id: int,
+    meses_bloqueados: Set[Tuple[int, int]],
+) -> Tuple[pd.DataFrame, List[List[dict]], List[dict]]:
+    """Valida un lote. Devuelve (partes válidas, rutas de cada parte, errores)."""
+    df = df.rename(columns=lambda c: str(c).strip().lower())
+    if "fecha" not in df.columns or "repartidor" not in df.columns:
+        raise ErrorImportacion("Faltan las columnas obligatorias 'fecha' y 'repartidor'")
+    errores = df["_error"].astype(object)
+    errores = errores.where(errores.notna(), None)
+
+    fechas = pd.to_datetime(df["fecha"], errors="coerce", format="ISO8601")
+    errores = _marcar(errores, fechas.isna(), "Fecha inválida. Use YYYY-MM-DD")
+
+    usernames = df["repartidor"].where(df["repartidor"].notna(), "").astype(str).str.strip()
+    user_ids = usernames.map(usuarios)
+    errores = _marcar(errores, user_ids.isna(), "Repartidor desconocido: " + usernames)
+
+    if meses_bloqueados:
+        claves = pd.Series(list(zip(fechas.dt.year, fechas.dt.month)), index=df.index)
+        errores = _marcar(errores, claves.isin(meses_bloqueados), "El mes está cerrado")
+
+    columnas = {}
+    for campo in COLUMNAS_FLOAT + CAMPOS_INT:
+        if campo not in df.columns:
+            columnas[campo] = pd.Series(0, index=df.index, dtype=float)
+            continue
+        valores, invalidos = _numeros(df[campo])
+        if campo in CAMPOS_INT:
+            invalidos |= valores.ne(valores.round())
+        errores = _marcar(errores, invalidos, f"Valor no numérico en '{campo}'")
+        columnas[campo] = valores
+
+    for campo in CAMPOS_TEXTO:
+        if campo in df.columns:
+            columnas[campo] = _texto(df[campo])
+        else:
+            columnas[campo] = _nulos(df)
+
+    horas = {}
+    for campo in ("salida_hora", "llegada_hora"):
+        if campo in df.columns:
+            valores, invalidos = _parsear_unicos(df[campo], parse_hora)
+            errores = _marcar(errores, invalidos, f"Hora inválida en '{campo}'. Use HH:MM")
+        else:
+            valores = _nulos(df)
+        horas[campo] = valores
+    if "tiempo_total" in df.columns:
+        duraciones, invalidos = _parsear_unicos(df["tiempo_total"], parse_duracion)
+        errores = _marcar(errores, invalidos, "Tiempo total inválido. Use H:MM o minutos")
+        tiempo_total = _texto(df["tiempo_total"])
+    else:
+        duraciones = _nulos(df)
+        tiempo_total = _nulos(df)
+
+    client_ids = None
+    if "client_id" in df.columns:
+        client_ids = _texto(df["client_id"])
+        duplicados = client_ids.notna() & pd.DataFrame({"u": user_ids, "c": client_ids}).duplicated(keep="first")
+        errores = _marcar(errores, duplicados, "client_id repetido en el fichero")
+
+    rutas_por_fila = pd.Series([[] for _ in range(len(df))], index=df.index, dtype=object)
+    if "rutas" in df.columns:
+        for i in df.index[errores.isna() & ~_vacio(df["rutas"].astype(object))]:
+            try:
+                rutas_por_fila.at[i] = _validar_rutas(df.at[i, "rutas"])
+            except (TypeError, ValueError, AttributeError) as e:
+                errores.at[i] = f"Rutas inválidas: {e}"
+
+    validas = errores.isna()
+    salidas = horas["salida_hora"][validas].tolist()
+    llegadas = horas["llegada_hora"][validas].tolist()
+    duraciones_validas = [
+        minutos_entre(s, l) if d is None or pd.isna(d) else int(d)
+        for d, s, l in zip(duraciones[validas].tolist(), salidas, llegadas)
+    ]
+
+    # Filas válidas del lote, por columnas (así se insertan)
+    partes = pd.DataFrame({campo: columnas[campo][validas].astype(float) for campo in COLUMNAS_FLOAT})
+    for campo in CAMPOS_INT:
+        partes[campo] = columnas[campo][validas].astype(int)
+    for campo in CAMPOS_TEXTO:
+        partes[campo] = columnas[campo][validas]
+    partes["fecha"] = fechas[validas].dt.date
+    partes["salida_hora"] = [formatear_hora(t) for t in salidas]
+    partes["llegada_hora"] = [formatear_hora(t) for t in llegadas]
+    partes["tiempo_total"] = tiempo_total[validas]
+    partes["salida_hora_norm"] = pd.Series(salidas, index=partes.index, dtype=object)
+    partes["llegada_hora_norm"] = pd.Series(llegadas, index=partes.index, dtype=object)
+    partes["duracion_minutos"] = pd.Series(duraciones_validas, index=partes.index, dtype=object)
+    partes["total_gastos"] = sum(partes[c] for c in GASTOS_CAMPOS)
+    partes["client_id"] = _nulos(df)[validas] if client_ids is None else client_ids[validas]
+    partes["fecha_actualizacion"] = datetime.now()
+    partes["user_id"] = user_ids[validas].astype(int)
+    partes["company_id"] = company_id
+    partes["_fila"] = df["_fila"][validas].astype(int)
+    rutas = rutas_por_fila[validas].tolist()
+
+    lista_errores = [
+        {"fila": int(df.at[i, "_fila"]), "error": str(errores.at[i])}
+        for i in df.index[~validas]
+    ]
+    return partes, rutas, lista_errores
+
+# ---------------------------------------------------------------------------
+# Escritura
+
+def _client_ids_existentes(db: Session, partes: pd.DataFrame) -> Set[Tuple[int, str]]:
+    con_id = partes[partes["client_id"].notna()]
+    if con_id.empty:
+        return set()
+    pares = set(zip(con_id["user_id"].tolist(), con_id["client_id"].tolist()))
+    filas = db.exec(
+        select(ParteDia.user_id, ParteDia.client_id).where(
+            ParteDia.user_id.in_({u for u, _ in pares}),
+            ParteDia.client_id.in_({c for _, c in pares}),
+        )
+    ).all()
+    return {(u, c) for u, c in filas} & pares
+
+def _es_postgres(db: Session) -> bool:
+    return db.get_bind().dialect.name == "postgresql"
+
+def _copy_postgres(db: Session, tabla: str, columnas: Dict[str, list]):
+    """COPY ... FROM STDIN con psycopg2"""
+    buf = io.StringIO()
+    escritor = csv.writer(buf)
+    for fila in zip(*columnas.values()):
+        escritor.writerow(["\\N" if v is None else v for v in fila])
+    buf.seek(0)
+    cursor = db.connection().connection.cursor()
+    try:
+        nombres = ", ".join(f'"{c}"' for c in columnas)
+        cursor.copy_expert(f'COPY "{tabla}" ({nombres}) FROM STDIN WITH (FORMAT csv, NULL \'\\N\')', buf)
+    finally:
+        cursor.close()
+
+def _insertar_filas(db: Session, tabla: str, columnas: Dict[str, list], tipos: Optional[Table] = None):
+    """INSERT en bloque a partir de columnas (nombre -> valores): COPY en PostgreSQL y
+    executemany del driver en SQLite, sin compilar los parámetros fila a fila. Si se
+    pasa la tabla, los valores se convierten con sus procesadores de tipo (fechas, horas...)."""
+    if not columnas or not next(iter(columnas.values())):
+        return
+    if _es_postgres(db):
+        _copy_postgres(db, tabla, columnas)
+        return
+
+    dialect = db.get_bind().dialect
+    valores = []
+    for nombre, columna in columnas.items():
+        procesador = tipos.c[nombre].type.dialect_impl(dialect).bind_processor(dialect) if tipos is not None else None
+        valores.append(list(map(procesador, columna)) if procesador else columna)
+    nombres = ", ".join(f'"{c}"' for c in columnas)
+    marcas = ", ".join(["?"] * len(columnas))
+    db.connection().exec_driver_sql(f'INSERT INTO "{tabla}" ({nombres}) VALUES ({marcas})', list(zip(*valores)))
+
+def _por_columnas(filas: List[dict]) -> Dict[str, list]:
+    if not filas:
+        return {}
+    return {c: [f[c] for f in filas] for c in filas[0]}
+
+def _insertar_partes(db: Session, partes: pd.DataFrame) -> List[int]:
+    tabla = ParteDia.__table__
+    columnas = {c: partes[c].tolist() for c in partes.columns if not c.startswith("_")}
+    n = len(partes)
+    if _es_postgres(db):
+        # Se reservan los ids de la secuencia y se cargan con COPY
+        ids = [int(i) for i in db.exec(
+            select(func.nextval(func.pg_get_serial_sequence("partedia", "id")))
+            .select_from(func.generate_series(1, n))
+        ).all()]
+        columnas["id"] = ids
+        _insertar_filas(db, tabla.name, columnas, tabla)
+        return ids
+
+    # SQLite no garantiza el orden de RETURNING en un INSERT de varias filas. El primer
+    # INSERT toma el bloqueo de escritura de la base de datos hasta el commit, así que
+    # nadie más puede insertar y los ids siguientes (max + 1) se pueden asignar aquí.
+    primera = {c: v[0] for c, v in columnas.items()}
+    primero = db.execute(insert(tabla).returning(tabla.c.id), primera).scalar_one()
+    ids = list(range(primero, primero + n))
+    resto = {c: v[1:] for c, v in columnas.items()}
+    resto["id"] = ids[1:]
+    _insertar_filas(db, tabla.name, resto, tabla)
+    return ids
+
+def _registrar_cambios(db: Session, partes: pd.DataFrame, ids: List[int]):
+    """Equivale a sync.registrar_cambio para todo el lote (una consulta de secuencias)"""
+    user_ids = partes["user_id"].tolist()
+    ultimos = dict(db.exec(
+        select(CambioParte.user_id, func.max(CambioParte.seq))
+        .where(CambioParte.user_id.in_(set(user_ids)))
+        .group_by(CambioParte.user_id)
+    ).all())
+    seqs = []
+    for uid in user_ids:
+        ultimos[uid] = (ultimos.get(uid) or 0) + 1
+        seqs.append(ultimos[uid])
+    n = len(ids)
+    _insertar_filas(db, CambioParte.__table__.name, {
+        "seq": seqs,
+        "accion": ["creado"] * n,
+        "parte_id": ids,
+        "client_id": partes["client_id"].tolist(),
+        "fecha": [datetime.now()] * n,
+        "user_id": user_ids,
+        "company_id": partes["company_id"].tolist(),
+    }, CambioParte.__table__)
+
+def _documentos(partes: pd.DataFrame, rutas: List[List[dict]], ids: List[int]) -> Dict[str, list]:
+    """Columnas del índice de búsqueda (lo mismo que busqueda._documento, en bloque)"""
+    lugares, textos = [], []
+    for salida, llegada, obs, rs in zip(
+        partes["salida_lugar"].tolist(), partes["llegada_lugar"].tolist(), partes["observaciones"].tolist(), rutas
+    ):
+        l = [salida, llegada]
+        t = [obs]
+        for r in rs:
+            l += [r["salida_lugar"], r["llegada_lugar"]]
+            t += [r["descripcion"], r["observaciones_ruta"]]
+        lugares.append(" ".join(v for v in l if v))
+        textos.append(" ".join(v for v in t if v))
+    return {
+        "lugares": lugares,
+        "textos": textos,
+        "parte_id": ids,
+        "company_id": partes["company_id"].tolist(),
+    }
+
+def guardar_lote(db: Session, partes: pd.DataFrame, rutas: List[List[dict]]) -> List[int]:
+    """Inserta partes, rutas, índice de búsqueda y registro de cambios. No hace commit."""
+    # Lo más cerca posible del commit (la lectura incremental de la integración lo usa)
+    partes = partes.assign(fecha_actualizacion=datetime.now())
+    ids = _insertar_partes(db, partes)
+    filas_rutas = [
+        {**r, "parte_dia_id": pid}
+        for rs, pid in zip(rutas, ids)
+        for r in rs
+    ]
+    _insertar_filas(db, Ruta.__table__.name, _por_columnas(filas_rutas), Ruta.__table__)
+    _registrar_cambios(db, partes, ids)
+    _insertar_filas(db, TABLA_BUSQUEDA, _documentos(partes, rutas, ids))
+    for company_id, user_id, fecha in set(zip(partes["company_id"].tolist(), partes["user_id"].tolist(), partes["fecha"].tolist())):
+        anotar_cambio(db, company_id, user_id, fecha)
+    return ids
+
+# ---------------------------------------------------------------------------
+
+def importar_partes(db: Session, company_id: int, fichero, formato: str) -> dict:
+    """Importa un fichero de partes. Cada lote se confirma por separado;
+    las filas con errores se saltan y se devuelven en el informe."""
+    if formato not in FORMATOS:
+        raise ErrorImportacion("Formato no soportado. Use NDJSON, CSV o XLSX")
+
+    usuarios = {
+        u.username: u.id
+        for u in db.exec(select(User).where(User.company_id == company_id, User.role == "repartidor")).all()
+    }
+    bloqueados = {(c.año, c.mes) for c in cierres_empresa(db, company_id) if c.bloqueado}
+
+    filas = importados = num_errores = 0
+    errores: List[dict] = []
+    vistos: Set[Tuple[int, str]] = set()
+
+    def anotar(nuevos: List[dict]):
+        nonlocal num_errores
+        num_errores += len(nuevos)
+        errores.extend(nuevos[:max(MAX_ERRORES_INFORME - len(errores), 0)])
+
+    # Repartidores y fechas de lo importado: los agregados se recalculan una sola
+    # vez al final (recalcular en cada lote repetiría todo el rango cada vez)
+    tocados: Set[int] = set()
+    fechas: Set = set()
+
+    try:
+        for df in _LECTORES[formato](fichero):
+            filas += len(df)
+            partes, rutas, errores_lote = validar_lote(df, usuarios, company_id, bloqueados)
+
+            # client_id ya importado en un lote anterior o existente en la base de datos
+            repetidos = _client_ids_existentes(db, partes) | vistos
+            claves = pd.Series(list(zip(partes["user_id"], partes["client_id"])), index=partes.index, dtype=object)
+            if repetidos:
+                descartar = (partes["client_id"].notna() & claves.isin(repetidos)).tolist()
+                errores_lote += [
+                    {"fila": fila, "error": "client_id ya importado"}
+                    for fila, d in zip(partes["_fila"].tolist(), descartar) if d
+                ]
+                conservar = [not d for d in descartar]
+                partes = partes[conservar]
+                claves = claves[conservar]
+                rutas = [r for r, ok in zip(rutas, conservar) if ok]
+            vistos |= set(claves[partes["client_id"].notna()].tolist())
+
+            if len(partes):
+                try:
+                    guardar_lote(db, partes, rutas)
+                    db.commit()
+                    importados += len(partes)
+                    tocados.update(partes["user_id"].tolist())
+                    fechas.update((partes["fecha"].min(), partes["fecha"].max()))
+                except IntegrityError as e:
+                    db.rollback()
+                    motivo = f"No se pudo guardar el lote: {e.orig}"
+                    errores_lote += [{"fila": fila, "error": motivo} for fila in partes["_fila"].tolist()]
+            anotar(sorted(errores_lote, key=lambda e: e["fila"]))
+    finally:
+        if tocados:
+            db.rollback()
+            recalcular_agregados(db, company_id, tocados, min(fechas), max(fechas))
+            db.commit()
+
+    return {
+        "formato": formato,
+        "filas": filas,
+        "importados": importados,
+        "con_error": num_errores,
+        "errores": errores,
+        "errores_truncados": num_errores > len(errores),
+    }
@@ -0,0 +1,234 @@
+from __future__ import annotations
+import io, os, re, zipfile
+import multiprocessing
+from concurrent.futures import FIRST_COMPLETED, Future, ProcessPoolExecutor, wait
+from datetime import date
+from typing import Dict, Iterator, List, Optional, Tuple
+from sqlmodel import Session, select
+from .models import ParteDia, User
+from .archivo import partes_archivados
+from .cancelacion import comprobar_cancelacion
+
+# Columnas de la hoja Excel (mismo formato que /admin/export/excel)
+COLUMNAS_EXCEL = [
+    "fecha", "repartidor", "km_salida", "km_llegada", "km_diferencia",
+    "salida_lugar", "llegada_lugar", "horas", "num_envios",
+    "dietas", "gasolina", "alojamiento", "comida", "material", "otros_gastos",
+    "total_gastos", "observaciones",
+]
+
+MESES = [
+    "Enero", "Febrero", "Marzo", "Abril", "Mayo", "Junio",
+    "Julio", "Agosto", "Septiembre", "Octubre", "Noviembre", "Diciembre",
+]
+
+def fila_parte(p: ParteDia, u: User) -> dict:
+    """Convierte un parte en un dict plano (se puede enviar a otro proceso)"""
+    return {
+        "fecha": p.fecha.isoformat() if p.fecha else "",
+        "repartidor": u.username,
+        "km_salida": p.km_salida or 0,
+        "km_llegada": p.km_llegada or 0,
+        "km_diferencia": p.km_diferencia or 0,
+        "salida_lugar": p.salida_lugar or "",
+        "llegada_lugar": p.llegada_lugar or "",
+        "horas": p.horas or 0,
+        "num_envios": p.num_envios or 0,
+        "dietas": p.dietas or 0,
+        "gasolina": p.gasolina or 0,
+        "alojamiento": p.alojamiento or 0,
+        "comida": p.comida or 0,
+        "material": p.material or 0,
+        "otros_gastos": p.otros_gastos or 0,
+        "total_gastos": p.total_gastos or 0,
+        "observaciones": p.observaciones or "",
+        "km": p.km or 0,
+        "user_id": u.id,
+    }
+
+def consultar_partes(db: Session, company_id: int, desde, hasta, user_id: Optional[int] = None) -> List[dict]:
+    """Partes de la empresa en el rango (también los archivados), ordenados por fecha, como filas planas"""
+    q = (
+        select(ParteDia, User)
+        .where(
+            ParteDia.company_id == company_id,
+            ParteDia.fecha >= desde,
+            ParteDia.fecha <= hasta,
+        )
+        .join(User, ParteDia.user_id == User.id)
+        .order_by(ParteDia.fecha)
+    )
+    if user_id:
+        q = q.where(ParteDia.user_id == user_id)
+    filas = [fila_parte(p, u) for p, u in db.exec(q).all()]
+    archivados = partes_archivados(db, company_id, desde, hasta, user_id)
+    if archivados:
+        usuarios = {u.id: u for u in db.exec(select(User).where(User.company_id == company_id)).all()}
+        filas += [fila_parte(p, usuarios[p.user_id]) for p in archivados if p.user_id in usuarios]
+        filas.sort(key=lambda f: f["fecha"])
+    return filas
+
+def generar_excel(filas: List[dict]) -> bytes:
+    import pandas as pd
+
+    comprobar_cancelacion()
+    df = pd.DataFrame(filas, columns=COLUMNAS_EXCEL)
+    output = io.BytesIO()
+    with pd.ExcelWriter(output, engine="openpyxl") as writer:
+        df.to_excel(writer, index=False, sheet_name="partes_diarios")
+    return output.getvalue()
+
+def generar_pdf(filas: List[dict], titulo: str = "Partes") -> bytes:
+    """PDF con WeasyPrint si está disponible, si no con ReportLab.
+    Lanza RuntimeError si no hay ninguno de los dos instalado."""
+    try:
+        from weasyprint import HTML  # type: ignore
+
+        html = f"<h2>{titulo}</h2><table border='1' cellspacing='0' cellpadding='4'><tr><th>Fecha</th><th>Usuario</th><th>Envíos</th><th>Km</th><th>Horas</th><th>Obs.</th></tr>"
+        for f in filas:
+            html += f"<tr><td>{f['fecha']}</td><td>{f['repartidor']}</td><td>{f['num_envios']}</td><td>{f['km']}</td><td>{f['horas']}</td><td>{f['observaciones']}</td></tr>"
+        html += "</table>"
+        return HTML(string=html).write_pdf()
+    except Exception:
+        pass
+
+    try:
+        from reportlab.lib.pagesizes import A4  # type: ignore
+        from reportlab.pdfgen import canvas  # type: ignore
+        from reportlab.lib.units import mm  # type: ignore
+    except Exception:
+        raise RuntimeError("Para exportar a PDF instala 'weasyprint' o 'reportlab'")
+
+    buf = io.BytesIO()
+    c = canvas.Canvas(buf, pagesize=A4)
+    w, h = A4
+    y = h - 20 * mm
+
+    c.setFont("Helvetica-Bold", 14)
+    c.drawString(20 * mm, y, titulo)
+    y -= 10 * mm
+
+    c.setFont("Helvetica", 10)
+    for i, f in enumerate(filas):
+        if i % 500 == 0:
+            comprobar_cancelacion()
+        line = f"{f['fecha']} | {f['repartidor']} | {f['num_envios']} env | {f['km']} km | {f['horas']} h | {f['observaciones']}"
+        c.drawString(20 * mm, y, line[:120])
+        y -= 6 * mm
+        if y < 20 * mm:
+            c.showPage()
+            y = h - 20 * mm
+
+    c.showPage()
+    c.save()
+    return buf.getvalue()
+
+def _nombre_seguro(texto: str) -> str:
+    return re.sub(r"[^\w.-]+", "_", texto).strip("_") or "repartidor"
+
+def informes_repartidor(user_id: int, username: str, año: int, mes: int, filas: List[dict]) -> List[Tuple[str, bytes]]:
+    """Genera el PDF y el Excel mensual de un repartidor (se ejecuta en el pool de procesos)"""
+    # Con el id: dos nombres distintos pueden quedar iguales al limpiarlos ("a b" y "a_b")
+    base = f"{_nombre_seguro(username)}_{user_id}_{año}-{mes:02d}"
+    titulo = f"Partes de {username} - {MESES[mes - 1]} {año}"
+    return [
+        (f"{base}.pdf", generar_pdf(filas, titulo)),
+        (f"{base}.xlsx", generar_excel(filas)),
+    ]
+
+# Pool de procesos compartido: ReportLab y openpyxl usan CPU y retienen el GIL.
+# Se usa 'spawn' para no heredar hilos ni conexiones de la base de datos al hacer fork.
+_pool: Optional[ProcessPoolExecutor] = None
+
+def _num_procesos() -> int:
+    return int(os.getenv("INFORMES_PROCESOS", str(os.cpu_count() or 1)))
+
+def obtener_pool() -> Optional[ProcessPoolExecutor]:
+    """Pool de generación de informes; None si INFORMES_PROCESOS=0 (se genera en el propio hilo)"""
+    global _pool
+    if _num_procesos() <= 0:
+        return None
+    if _pool is None:
+        _pool = ProcessPoolExecutor(
+            max_workers=_num_procesos(),
+            mp_context=multiprocessing.get_context("spawn"),
+        )
+    return _pool
+
+def cerrar_pool():
+    global _pool
+    if _pool is not None:
+        _pool.shutdown(wait=True, cancel_futures=True)
+        _pool = None
+
+class _SalidaZip(io.RawIOBase):
+    """Destino no posicionable para ZipFile: acumula lo escrito hasta que se vacía"""
+
+    def __init__(self):
+        self._trozos: List[bytes] = []
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, b) -> int:
+        self._trozos.append(bytes(b))
+        return len(b)
+
+    def vaciar(self) -> bytes:
+        datos = b"".join(self._trozos)
+        self._trozos = []
+        return datos
+
+def zip_informes_mensuales(por_repartidor: Dict[Tuple[int, str], List[dict]], año: int, mes: int) -> Iterator[bytes]:
+    """Genera un ZIP en streaming con el PDF y el Excel de cada repartidor.
+
+    Los informes se reparten en el pool de procesos y cada miembro se escribe en
+    cuanto termina. Como mucho hay 2 informes por proceso en vuelo, así que los
+    informes generados (PDF y Excel) no se acumulan en memoria. Las filas del mes
+    sí se cargan enteras antes de empezar (partes_por_repartidor, y main.py las
+    guarda en la caché): son filas planas, mucho más pequeñas que los informes."""
+    salida = _SalidaZip()
+    pool = obtener_pool()
+    pendientes = list(por_repartidor.items())
+
+    with zipfile.ZipFile(salida, mode="w", compression=zipfile.ZIP_DEFLATED) as zf:
+        if pool is None:
+            for (user_id, username), filas in pendientes:
+                comprobar_cancelacion()
+                for nombre, datos in informes_repartidor(user_id, username, año, mes, filas):
+                    zf.writestr(nombre, datos)
+                yield salida.vaciar()
+        else:
+            maximo_en_vuelo = 2 * _num_procesos()
+            en_vuelo: set[Future] = set()
+            try:
+                while pendientes or en_vuelo:
+                    comprobar_cancelacion()
+                    while pendientes and len(en_vuelo) < maximo_en_vuelo:
+                        (user_id, username), filas = pendientes.pop(0)
+                        en_vuelo.add(pool.submit(informes_repartidor, user_id, username, año, mes, filas))
+                    terminados, en_vuelo = wait(en_vuelo, return_when=FIRST_COMPLETED)
+                    for futuro in terminados:
+                        for nombre, datos in futuro.result():
+                            zf.writestr(nombre, datos)
+                    yield salida.vaciar()
+            finally:
+                # Si el cliente se va a mitad de descarga no seguimos generando
+                for futuro in en_vuelo:
+                    futuro.cancel()
+    yield salida.vaciar()
+
+def partes_por_repartidor(db: Session, company_id: int, año: int, mes: int) -> Dict[Tuple[int, str], List[dict]]:
+    """Partes del mes agrupados por (user_id, username) de cada repartidor (todos, aunque no tengan partes)"""
+    from calendar import monthrange
+
+    repartidores = db.exec(
+        select(User).where(User.company_id == company_id, User.role == "repartidor").order_by(User.username)
+    ).all()
+    grupos: Dict[Tuple[int, str], List[dict]] = {(u.id, u.username): [] for u in repartidores}
+    claves = {u.id: (u.id, u.username) for u in repartidores}
+    filas = consultar_partes(db, company_id, date(año, mes, 1), date(año, mes, monthrange(año, mes)[1]))
+    for f in filas:
+        if f["user_id"] in claves:
+            grupos[claves[f["user_id"]]].append(f)
+    return grupos
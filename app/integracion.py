@@ -0,0 +1,216 @@
+from __future__ import annotations
+import base64, json, os
+from datetime import datetime, timedelta
+from typing import Dict, Iterator, List, Optional
+from sqlalchemy import and_, or_, true
+from sqlmodel import Session, select
+from .models import CambioParte, ParteDia, ParteMensual, Ruta, User
+from .eventos import al_cambiar_parte
+from .sync import parte_dict
+
+try:
+    import orjson
+except ImportError:  # orjson es opcional
+    orjson = None
+
+# Lectura masiva para integraciones (ERP, nóminas) en NDJSON.
+#
+# Cada línea es un objeto con "tipo": "parte" (con sus rutas), "eliminado" o
+# "mensual". La última línea es "fin" (con el updated_since de la siguiente
+# lectura) o "continuar" (con el token para seguir donde se cortó). Los datos se
+# leen por bloques con paginación por clave (fecha_actualizacion, id), así que la
+# memoria del servidor depende del tamaño del bloque y no del rango pedido.
+
+TAMAÑO_BLOQUE = 1000
+LIMITE_POR_DEFECTO = 50000
+LIMITE_MAXIMO = 200000
+
+# fecha_actualizacion se pone antes del commit: una transacción que tarde en
+# confirmarse puede aparecer con una fecha que un cliente ya ha dejado atrás. La
+# ventana se cierra siempre este margen antes de ahora (como en app/odometro.py)
+# y lo que se confirme dentro del margen llega en la siguiente lectura.
+MARGEN = timedelta(seconds=int(os.getenv("INTEGRACION_MARGEN_SEGUNDOS", "300")))
+
+# Etapas de la lectura, en orden
+PARTES, ELIMINADOS, MENSUALES = 0, 1, 2
+
+class ErrorIntegracion(ValueError):
+    """Parámetros o token de continuación no válidos"""
+
+@al_cambiar_parte
+def _marcar_actualizacion(db: Session, parte: ParteDia, accion: str):
+    # También cuenta como cambio del parte editar solo sus rutas
+    if accion != "eliminado":
+        parte.fecha_actualizacion = datetime.now()
+        db.add(parte)
+
+def linea_ndjson(obj: dict) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(obj) + b"\n"
+    return (json.dumps(obj, ensure_ascii=False) + "\n").encode()
+
+# ---------------------------------------------------------------------------
+# Token de continuación: base64url de JSON, opaco para el cliente
+
+def codificar_token(estado: dict) -> str:
+    return base64.urlsafe_b64encode(json.dumps(estado).encode()).decode().rstrip("=")
+
+def decodificar_token(token: str) -> dict:
+    try:
+        relleno = "=" * (-len(token) % 4)
+        estado = json.loads(base64.urlsafe_b64decode(token + relleno))
+        resultado = {
+            "e": int(estado["e"]),
+            "f": estado.get("f"),
+            "i": int(estado.get("i") or 0),
+            "d": estado.get("d"),
+            "h": estado["h"],
+        }
+        # Validar aquí las fechas y la etapa: un token manipulado no debe
+        # fallar ya con la respuesta en marcha
+        if not PARTES <= resultado["e"] <= MENSUALES or _fecha(resultado["h"]) is None:
+            raise ValueError("etapa o fecha de corte inválida")
+        _fecha(resultado["d"])
+        _fecha(resultado["f"])
+        return resultado
+    except Exception:
+        raise ErrorIntegracion("Token de continuación inválido")
+
+def _fecha(valor: Optional[str]) -> Optional[datetime]:
+    return datetime.fromisoformat(valor) if valor else None
+
+# ---------------------------------------------------------------------------
+# Lectura por bloques
+
+def _despues_de(columna_fecha, columna_id, fecha: Optional[datetime], ultimo_id: int):
+    """Condición de keyset: (fecha, id) > (fecha, ultimo_id)"""
+    if fecha is None:
+        return true()
+    return or_(columna_fecha > fecha, and_(columna_fecha == fecha, columna_id > ultimo_id))
+
+def _bloque_partes(db: Session, company_id: int, desde, hasta, fecha, ultimo_id, n) -> List[ParteDia]:
+    q = select(ParteDia).where(
+        ParteDia.company_id == company_id,
+        ParteDia.fecha_actualizacion <= hasta,
+        _despues_de(ParteDia.fecha_actualizacion, ParteDia.id, fecha, ultimo_id),
+    )
+    if desde is not None:
+        q = q.where(ParteDia.fecha_actualizacion > desde)
+    return db.exec(q.order_by(ParteDia.fecha_actualizacion, ParteDia.id).limit(n)).all()
+
+def _bloque_eliminados(db: Session, company_id: int, desde, hasta, fecha, ultimo_id, n) -> List[CambioParte]:
+    q = select(CambioParte).where(
+        CambioParte.company_id == company_id,
+        CambioParte.accion == "eliminado",
+        CambioParte.fecha > desde,
+        CambioParte.fecha <= hasta,
+        _despues_de(CambioParte.fecha, CambioParte.id, fecha, ultimo_id),
+    )
+    return db.exec(q.order_by(CambioParte.fecha, CambioParte.id).limit(n)).all()
+
+def _bloque_mensuales(db: Session, company_id: int, desde, hasta, fecha, ultimo_id, n) -> List[ParteMensual]:
+    q = select(ParteMensual).where(
+        ParteMensual.company_id == company_id,
+        ParteMensual.fecha_actualizacion <= hasta,
+        _despues_de(ParteMensual.fecha_actualizacion, ParteMensual.id, fecha, ultimo_id),
+    )
+    if desde is not None:
+        q = q.where(ParteMensual.fecha_actualizacion > desde)
+    return db.exec(q.order_by(ParteMensual.fecha_actualizacion, ParteMensual.id).limit(n)).all()
+
+def _lineas_partes(db: Session, partes: List[ParteDia], usernames: Dict[int, str]) -> Iterator[dict]:
+    rutas: Dict[int, List[Ruta]] = {}
+    for r in db.exec(
+        select(Ruta).where(Ruta.parte_dia_id.in_([p.id for p in partes])).order_by(Ruta.parte_dia_id, Ruta.orden)
+    ).all():
+        rutas.setdefault(r.parte_dia_id, []).append(r)
+    for p in partes:
+        yield {
+            "tipo": "parte",
+            **parte_dict(p, rutas.get(p.id, [])),
+            "user_id": p.user_id,
+            "repartidor": usernames.get(p.user_id),
+            "fecha_actualizacion": p.fecha_actualizacion.isoformat(),
+        }
+
+def _linea_eliminado(c: CambioParte) -> dict:
+    return {
+        "tipo": "eliminado",
+        "id": c.parte_id,
+        "client_id": c.client_id,
+        "user_id": c.user_id,
+        "fecha_actualizacion": c.fecha.isoformat(),
+    }
+
+def _linea_mensual(m: ParteMensual, usernames: Dict[int, str]) -> dict:
+    datos = m.model_dump()
+    datos["fecha_creacion"] = m.fecha_creacion.isoformat()
+    datos["fecha_actualizacion"] = m.fecha_actualizacion.isoformat()
+    return {"tipo": "mensual", **datos, "repartidor": usernames.get(m.user_id)}
+
+def estado_inicial(updated_since: Optional[str], retraso: int = 0) -> dict:
+    """Estado de una lectura nueva. El final del rango se fija ahora menos MARGEN
+    (y `retraso` segundos más si se lee de una réplica) para que la lectura y sus
+    continuaciones vean una ventana de tiempo cerrada y ya confirmada."""
+    try:
+        desde = _fecha(updated_since)
+    except ValueError:
+        raise ErrorIntegracion("updated_since inválido. Use formato ISO (YYYY-MM-DDTHH:MM:SS)")
+    hasta = datetime.now() - MARGEN - timedelta(seconds=retraso)
+    if desde is not None and hasta < desde:
+        hasta = desde  # lecturas muy seguidas: ventana vacía, sin volver atrás
+    return {
+        "e": PARTES,
+        "f": None,
+        "i": 0,
+        "d": desde.isoformat() if desde else None,
+        "h": hasta.isoformat(),
+    }
+
+def exportar_ndjson(db: Session, company_id: int, estado: dict, limite: int = LIMITE_POR_DEFECTO) -> Iterator[bytes]:
+    """Genera las líneas NDJSON a partir del estado (inicial o de un token de continuación)"""
+    usernames = {
+        u.id: u.username for u in db.exec(select(User).where(User.company_id == company_id)).all()
+    }
+    desde, hasta = _fecha(estado["d"]), _fecha(estado["h"])
+    etapa, fecha, ultimo_id = estado["e"], _fecha(estado["f"]), estado["i"]
+    enviadas = 0
+
+    while etapa <= MENSUALES:
+        if etapa == ELIMINADOS and desde is None:
+            # En una lectura completa no hay nada borrado que comunicar
+            etapa, fecha, ultimo_id = MENSUALES, None, 0
+            continue
+
+        n = min(TAMAÑO_BLOQUE, limite - enviadas)
+        if n <= 0:
+            token = codificar_token({
+                "e": etapa, "f": fecha.isoformat() if fecha else None, "i": ultimo_id,
+                "d": estado["d"], "h": estado["h"],
+            })
+            yield linea_ndjson({"tipo": "continuar", "token": token})
+            return
+
+        if etapa == PARTES:
+            filas = _bloque_partes(db, company_id, desde, hasta, fecha, ultimo_id, n)
+            lineas = _lineas_partes(db, filas, usernames) if filas else []
+            clave = lambda p: (p.fecha_actualizacion, p.id)
+        elif etapa == ELIMINADOS:
+            filas = _bloque_eliminados(db, company_id, desde, hasta, fecha, ultimo_id, n)
+            lineas = (_linea_eliminado(c) for c in filas)
+            clave = lambda c: (c.fecha, c.id)
+        else:
+            filas = _bloque_mensuales(db, company_id, desde, hasta, fecha, ultimo_id, n)
+            lineas = (_linea_mensual(m, usernames) for m in filas)
+            clave = lambda m: (m.fecha_actualizacion, m.id)
+
+        if filas:
+            yield b"".join(linea_ndjson(l) for l in lineas)
+            enviadas += len(filas)
+            fecha, ultimo_id = clave(filas[-1])
+            # Los objetos del bloque ya no hacen falta: no acumularlos en la sesión
+            db.expunge_all()
+        if len(filas) < n:
+            etapa, fecha, ultimo_id = etapa + 1, None, 0
+
+    yield linea_ndjson({"tipo": "fin", "updated_since": estado["h"]})
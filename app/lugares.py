@@ -0,0 +1,215 @@
+from __future__ import annotations
+import heapq, os, threading, time, unicodedata
+from bisect import bisect_left, insort
+from collections import OrderedDict
+from datetime import date, timedelta
+from typing import Dict, List, Optional, Tuple
+from sqlalchemy import event, func, literal, union_all
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import Session as SessionORM
+from sqlmodel import Session, select
+from .models import ParteDia, Ruta
+from .eventos import al_cambiar_parte
+
+# Autocompletado de lugares y descripciones de ruta.
+#
+# Cada empresa tiene en memoria un índice de los textos que han escrito sus
+# repartidores: una lista ordenada de claves normalizadas (sin tildes ni
+# mayúsculas, una por cada palabra del texto, para que "norte" sugiera
+# "Polígono Norte") en la que se busca el prefijo con bisect. Cada texto pesa
+# por cuántas veces se ha usado y lo reciente que es su último uso.
+#
+# El índice se construye la primera vez que se pide (con los últimos DIAS_HISTORIA
+# días), se actualiza con los partes que se guardan en este proceso y se
+# reconstruye en segundo plano cada REFRESCO_SEGUNDOS (así llegan las
+# importaciones y los partes guardados en otros workers).
+
+LUGAR, DESCRIPCION = "lugar", "descripcion"
+TIPOS = (LUGAR, DESCRIPCION)
+
+DIAS_HISTORIA = 365
+VIDA_MEDIA_DIAS = 60  # un uso de hace 60 días pesa la mitad que uno de hoy
+MAX_TEXTOS = int(os.getenv("LUGARES_MAX_TEXTOS", "5000"))  # por empresa y tipo
+MAX_EMPRESAS = 256
+REFRESCO_SEGUNDOS = float(os.getenv("LUGARES_REFRESCO_SEGUNDOS", "600"))
+MAX_CANDIDATOS = 500
+LONGITUD_MAXIMA = 120
+
+_CLAVE_PENDIENTES = "lugares_pendientes"
+
+def normalizar(texto: str) -> str:
+    sin_tildes = unicodedata.normalize("NFKD", texto).encode("ascii", "ignore").decode()
+    return " ".join(sin_tildes.lower().split())
+
+def _limpiar(texto: Optional[str]) -> Optional[str]:
+    texto = " ".join((texto or "").split())
+    return texto[:LONGITUD_MAXIMA] if texto else None
+
+class IndiceTextos:
+    """Textos de un tipo de una empresa, con su peso. No es seguro entre hilos:
+    quien lo usa (Sugerencias) lo protege con su lock."""
+
+    def __init__(self):
+        # normalizado -> [texto original más reciente, usos, último uso]
+        self.textos: Dict[str, list] = {}
+        # (clave, normalizado) ordenadas: una por cada palabra del texto
+        self.claves: List[Tuple[str, str]] = []
+
+    @staticmethod
+    def _claves(normalizado: str):
+        palabras = normalizado.split(" ")
+        return [(" ".join(palabras[i:]), normalizado) for i in range(len(palabras))]
+
+    def añadir(self, texto: str, usos: int, ultimo: date):
+        normalizado = normalizar(texto)
+        if not normalizado:
+            return
+        entrada = self.textos.get(normalizado)
+        if entrada is None:
+            self.textos[normalizado] = [texto, usos, ultimo]
+            for clave in self._claves(normalizado):
+                insort(self.claves, clave)
+            if len(self.textos) > MAX_TEXTOS:
+                self._recortar()
+            return
+        entrada[1] += usos
+        if ultimo >= entrada[2]:
+            entrada[0], entrada[2] = texto, ultimo
+
+    def _recortar(self):
+        """Se queda con el 90 % de MAX_TEXTOS de más peso"""
+        hoy = date.today()
+        quedan = heapq.nlargest(int(MAX_TEXTOS * 0.9), self.textos.items(), key=lambda kv: self._peso(kv[1], hoy))
+        self.textos = dict(quedan)
+        self.claves = sorted(c for n in self.textos for c in self._claves(n))
+
+    @staticmethod
+    def _peso(entrada: list, hoy: date) -> float:
+        return entrada[1] * 0.5 ** ((hoy - entrada[2]).days / VIDA_MEDIA_DIAS)
+
+    def sugerir(self, q: str, limite: int) -> List[str]:
+        prefijo = normalizar(q)
+        if not prefijo:
+            return []
+        candidatos = set()
+        i = bisect_left(self.claves, (prefijo, ""))
+        while i < len(self.claves) and len(candidatos) < MAX_CANDIDATOS:
+            clave, normalizado = self.claves[i]
+            if not clave.startswith(prefijo):
+                break
+            candidatos.add(normalizado)
+            i += 1
+        hoy = date.today()
+        mejores = heapq.nlargest(limite, candidatos, key=lambda n: self._peso(self.textos[n], hoy))
+        return [self.textos[n][0] for n in mejores]
+
+def _consulta(company_id: int, tipo: str, desde: date):
+    """(texto, usos, último uso) de los textos de la empresa desde `desde`"""
+    P, R = ParteDia, Ruta
+    if tipo == LUGAR:
+        columnas = [
+            (P.salida_lugar, False), (P.llegada_lugar, False),
+            (R.salida_lugar, True), (R.llegada_lugar, True),
+        ]
+    else:
+        columnas = [(R.descripcion, True)]
+    partes = []
+    for columna, de_ruta in columnas:
+        q = select(columna.label("texto"), P.fecha.label("fecha"))
+        if de_ruta:
+            q = q.select_from(R).join(P, P.id == R.parte_dia_id)
+        partes.append(q.where(P.company_id == company_id, P.fecha >= desde, columna.is_not(None), columna != literal("")))
+    textos = union_all(*partes).subquery()
+    return (
+        select(textos.c.texto, func.count(), func.max(textos.c.fecha))
+        .group_by(textos.c.texto)
+    )
+
+class Sugerencias:
+    """Índices por empresa y tipo, con las MAX_EMPRESAS usadas más recientemente"""
+
+    def __init__(self):
+        self.engine: Optional[Engine] = None
+        self._indices: "OrderedDict[Tuple[int, str], Tuple[IndiceTextos, float]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._refrescando: set = set()
+
+    def conectar(self, engine: Engine):
+        self.engine = engine
+
+    def _construir(self, company_id: int, tipo: str) -> IndiceTextos:
+        indice = IndiceTextos()
+        with Session(self.engine) as db:
+            filas = db.exec(_consulta(company_id, tipo, date.today() - timedelta(days=DIAS_HISTORIA))).all()
+        for texto, usos, ultimo in filas:
+            texto = _limpiar(texto)
+            if texto:
+                indice.añadir(texto, usos, ultimo if isinstance(ultimo, date) else date.fromisoformat(str(ultimo)[:10]))
+        return indice
+
+    def _guardar(self, clave: Tuple[int, str], indice: IndiceTextos):
+        with self._lock:
+            self._indices[clave] = (indice, time.monotonic())
+            self._indices.move_to_end(clave)
+            while len(self._indices) > MAX_EMPRESAS:
+                self._indices.popitem(last=False)
+
+    def _refrescar(self, clave: Tuple[int, str]):
+        try:
+            self._guardar(clave, self._construir(*clave))
+        finally:
+            with self._lock:
+                self._refrescando.discard(clave)
+
+    def sugerir(self, company_id: int, q: str, tipo: str = LUGAR, limite: int = 10) -> List[str]:
+        clave = (company_id, tipo)
+        with self._lock:
+            actual = self._indices.get(clave)
+            if actual is not None:
+                self._indices.move_to_end(clave)
+                indice, construido = actual
+                if time.monotonic() - construido > REFRESCO_SEGUNDOS and clave not in self._refrescando:
+                    # Se sigue respondiendo con el índice actual mientras se reconstruye
+                    self._refrescando.add(clave)
+                    threading.Thread(target=self._refrescar, args=(clave,), daemon=True).start()
+                return indice.sugerir(q, limite)
+        indice = self._construir(company_id, tipo)
+        self._guardar(clave, indice)
+        with self._lock:
+            return indice.sugerir(q, limite)
+
+    def anotar(self, company_id: int, tipo: str, texto: str, fecha: date):
+        """Suma un uso a un índice ya construido (si no lo está, ya lo leerá de la base de datos)"""
+        with self._lock:
+            actual = self._indices.get((company_id, tipo))
+            if actual is not None:
+                actual[0].añadir(texto, 1, fecha)
+
+    def vaciar(self):
+        with self._lock:
+            self._indices.clear()
+
+sugerencias = Sugerencias()
+
+@al_cambiar_parte
+def _anotar_textos(db: Session, parte: ParteDia, accion: str):
+    if accion == "eliminado":
+        return
+    rutas = db.exec(select(Ruta).where(Ruta.parte_dia_id == parte.id)).all()
+    textos = [(LUGAR, parte.salida_lugar), (LUGAR, parte.llegada_lugar)]
+    for r in rutas:
+        textos += [(LUGAR, r.salida_lugar), (LUGAR, r.llegada_lugar), (DESCRIPCION, r.descripcion)]
+    pendientes = db.info.setdefault(_CLAVE_PENDIENTES, [])
+    for tipo, texto in textos:
+        texto = _limpiar(texto)
+        if texto:
+            pendientes.append((parte.company_id, tipo, texto, parte.fecha))
+
+@event.listens_for(SessionORM, "after_commit")
+def _aplicar_pendientes(db: SessionORM):
+    for pendiente in db.info.pop(_CLAVE_PENDIENTES, ()):
+        sugerencias.anotar(*pendiente)
+
+@event.listens_for(SessionORM, "after_rollback")
+def _descartar_pendientes(db: SessionORM):
+    db.info.pop(_CLAVE_PENDIENTES, None)
@@ -1,18 +1,48 @@
 from __future__ import annotations
-from fastapi import FastAPI, Request, Form, HTTPException, Response
-from fastapi.responses import HTMLResponse, RedirectResponse, StreamingResponse, PlainTextResponse
+from fastapi import FastAPI, Request, Form, HTTPException, Response, Body, File, UploadFile
+from fastapi.responses import HTMLResponse, RedirectResponse, StreamingResponse, PlainTextResponse, FileResponse
 from fastapi.staticfiles import StaticFiles
-from sqlmodel import SQLModel, create_engine, Session, select, text
+from sqlmodel import SQLModel, create_engine, Session, select, text, func
 from starlette.templating import Jinja2Templates
 from starlette.middleware.sessions import SessionMiddleware
+from starlette.concurrency import run_in_threadpool
+from sqlalchemy.orm.exc import StaleDataError
+from sqlalchemy.exc import IntegrityError
 from datetime import date, datetime
 from pathlib import Path
-import io, os
-import pandas as pd
-from typing import Optional
+import asyncio, io, os, hashlib
+from typing import List, Optional
 
-from .models import Company, User, ParteDia, ParteMensual, Ruta
-from .auth import hash_password, verify_password, get_current_user, require_role
+from .models import Company, User, ParteDia, ParteMensual, Ruta, CambioParte, TokenApi
+from .auth import hash_password, verify_password, get_current_user, require_role, require_integracion, require_operador, crear_token_api
+from .eventos import parte_cambiado, anotar_cambio
+from .concurrencia import ParteModificado, comprobar_version, leer_version
+from .cache import cache_resultados
+from .bus import crear_bus
+from .archivo import Archivador, partes_archivados
+from .agregados import kpis, serie
+from .analitica import informe_analitica
+from .odometro import RevisorOdometro, listar_anomalias
+from .lugares import TIPOS as TIPOS_SUGERENCIA, sugerencias
+from .directo import DURACION_SEGUNDOS as DURACION_DIRECTO, LATIDO_SEGUNDOS, directo, evento_sse
+from .admision import ControlAdmision, conectar as conectar_admision, estado as estado_admision
+from .cuotas import FILAS_EXPORTADAS, FILAS_IMPORTADAS, LIMITES as LIMITES_CUOTAS, CuotaSuperada, cuotas
+from .cancelacion import CancelarAbandonadas, TiempoConsultaAgotado, instalar as instalar_cancelacion
+from . import perfilado
+from .busqueda import crear_indice_busqueda, buscar_partes
+from .tiempos import (
+    parse_hora, parse_duracion, formatear_hora, formatear_duracion, minutos_entre,
+    duraciones_por_repartidor, duraciones_por_ruta,
+)
+from .cierre import MesArchivado, MesCerrado, cerrar_mes, reabrir_mes, comprobar_mes_abierto, cierres_empresa
+from .sync import ErrorSync, aplicar_lote, cambios_desde
+from .importacion import ErrorImportacion, detectar_formato, importar_partes
+from .esquemas import RespuestaJSON, ParteDetalle, ParteResumen, Confirmacion, Mensaje, CambiosSync, ResultadoSync
+from .integracion import ErrorIntegracion, estado_inicial, decodificar_token, exportar_ndjson, LIMITE_POR_DEFECTO, LIMITE_MAXIMO
+from .informes import (
+    consultar_partes, generar_excel, generar_pdf,
+    partes_por_repartidor, zip_informes_mensuales, cerrar_pool,
+)
 
 # Funciones de Flash Messages
 def set_flash_message(request: Request, type: str, title: str, message: str):
@@ -55,27 +85,50 @@ TEMPLATES_DIR = BASE_DIR / "templates"
 # Configuración de base de datos para producción
 DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///app_nueva.db")
 
-# Para PostgreSQL en producción (Railway automáticamente provee DATABASE_URL)
-if DATABASE_URL.startswith("postgres://"):
-    DATABASE_URL = DATABASE_URL.replace("postgres://", "postgresql://", 1)
+# Réplica de solo lectura para informes (opcional). Sin ella todo va a la principal.
+READ_DATABASE_URL = os.getenv("READ_DATABASE_URL", "")
+# Retraso máximo que se asume para la réplica (ver /api/export/ndjson)
+RETRASO_REPLICA_SEGUNDOS = int(os.getenv("RETRASO_REPLICA_SEGUNDOS", "5"))
 
-engine = create_engine(
-    DATABASE_URL,
-    echo=False,  # Cambiar a False en producción
-    connect_args={"check_same_thread": False} if "sqlite" in DATABASE_URL else {}
-)
+def crear_motor(url: str):
+    # Para PostgreSQL en producción (Railway automáticamente provee DATABASE_URL)
+    if url.startswith("postgres://"):
+        url = url.replace("postgres://", "postgresql://", 1)
+    return create_engine(
+        url,
+        echo=False,  # Cambiar a False en producción
+        connect_args={"check_same_thread": False} if "sqlite" in url else {}
+    )
+
+engine = crear_motor(DATABASE_URL)
+
+# Consultas de informes (panel de admin, exportaciones, lecturas masivas). Las
+# escrituras, la autenticación y lo que el usuario acaba de escribir y espera ver
+# (leer lo propio) siguen en `engine`.
+engine_lectura = crear_motor(READ_DATABASE_URL) if READ_DATABASE_URL else engine
+
+# Tiempo máximo de las consultas y cancelación si el cliente se va (ver app/cancelacion.py)
+for _motor in {engine, engine_lectura}:
+    instalar_cancelacion(_motor)
+    perfilado.instalar(_motor)
 
 def init_db():
     # Forzar recreación de todas las tablas
     SQLModel.metadata.drop_all(engine)
     SQLModel.metadata.create_all(engine)
+    crear_indice_busqueda(engine, recrear=True)
 
-app = FastAPI(debug=True)
+app = FastAPI(debug=True, default_response_class=RespuestaJSON)
+# Las rutas se pueden perfilar en producción (ver app/perfilado.py)
+app.router.route_class = perfilado.RutaPerfilable
 
 # Montar estáticos y plantillas
 app.mount("/static", StaticFiles(directory=str(STATIC_DIR)), name="static")
 templates = Jinja2Templates(directory=str(TEMPLATES_DIR))
 
+# Cambia al desplegar plantillas nuevas (invalida las versiones cacheadas por el service worker)
+_VERSION_PLANTILLAS = int((TEMPLATES_DIR / "repartidor.html").stat().st_mtime)
+
 def render_template(template_name: str, request: Request, **context):
     """Renderiza un template incluyendo mensajes flash"""
     context.update({
@@ -84,10 +137,50 @@ def render_template(template_name: str, request: Request, **context):
     })
     return templates.TemplateResponse(template_name, context)
 
+# Bus de invalidación de cachés entre workers (ver app/bus.py)
+bus = crear_bus(engine)
+# Archivo en Parquet de los meses cerrados antiguos (ver app/archivo.py)
+archivador = Archivador(engine)
+# Revisión nocturna de los cuentakilómetros (ver app/odometro.py)
+revisor_odometro = RevisorOdometro(engine)
+# Autocompletado de lugares (ver app/lugares.py)
+sugerencias.conectar(engine_lectura)
+# Cambios en directo para el panel (ver app/directo.py); lee del primario para no ir con retraso
+directo.conectar(engine)
+# Cuotas por empresa (ver app/cuotas.py) y empresa de las peticiones pesadas (app/admision.py)
+cuotas.conectar(engine)
+conectar_admision(engine)
+perfilado.conectar(engine)
+
 # Crear tablas al arrancar
 @app.on_event("startup")
 def on_startup():
-    init_db()
+    # Con servidor.py las tablas las prepara el proceso maestro, una sola vez
+    if os.getenv("BD_INICIALIZADA") != "1":
+        init_db()
+    if bus is not None:
+        bus.iniciar()
+    archivador.iniciar()
+    revisor_odometro.iniciar()
+    directo.iniciar()
+
+@app.on_event("shutdown")
+def on_shutdown():
+    if bus is not None:
+        bus.parar()
+    archivador.parar()
+    revisor_odometro.parar()
+    directo.parar()
+    cerrar_pool()
+
+# Service worker del modo PWA: se sirve desde la raíz para que controle /repartidor
+@app.get("/sw.js")
+def service_worker():
+    return FileResponse(
+        STATIC_DIR / "sw.js",
+        media_type="application/javascript",
+        headers={"Service-Worker-Allowed": "/", "Cache-Control": "no-cache"},
+    )
 
 # Ruta simple para probar
 @app.get("/health")
@@ -107,6 +200,28 @@ async def add_user_to_request(request: Request, call_next):
     response = await call_next(request)
     return response
 
+# Perfilado a petición de los operadores y por muestreo (ver app/perfilado.py)
+app.add_middleware(perfilado.Perfilador)
+
+# Cancelación del trabajo abandonado (ver app/cancelacion.py)
+app.add_middleware(CancelarAbandonadas)
+
+# Control de admisión (ver app/admision.py): por fuera de los middlewares
+# anteriores, así una petición rechazada no llega a consultar la base de datos
+app.add_middleware(ControlAdmision)
+
+@app.exception_handler(TiempoConsultaAgotado)
+def tiempo_consulta_agotado(request: Request, exc: TiempoConsultaAgotado):
+    return RespuestaJSON(status_code=504, content={"detail": str(exc)})
+
+@app.exception_handler(CuotaSuperada)
+def cuota_superada(request: Request, exc: CuotaSuperada):
+    return RespuestaJSON(
+        status_code=429,
+        content={"detail": str(exc), "recurso": exc.recurso, "limite": exc.limite},
+        headers={"Retry-After": str(exc.reintentar_en)},
+    )
+
 # ⛳️ AÑADIR SESSION **DESPUÉS** DEL MIDDLEWARE HTTP PERSONALIZADO
 app.add_middleware(SessionMiddleware, secret_key="cambia-esta-clave-super-larga")
 
@@ -219,7 +334,9 @@ def register_post(
             
             # Crear usuario repartidor
             u = User(username=username, password_hash=hash_password(password), role="repartidor", company_id=comp.id)
-            db.add(u); db.commit()
+            db.add(u)
+            anotar_cambio(db, comp.id)  # aparece en las estadísticas del panel
+            db.commit()
             
             flash_success(request, "¡Registro exitoso!", f"Te has registrado correctamente en '{company}'. Ya puedes iniciar sesión.")
     
@@ -243,6 +360,22 @@ def repartidor_panel(request: Request, año: int | None = None, mes: int | None
         primer_dia = date(año, mes, 1)
         ultimo_dia = date(año, mes, monthrange(año, mes)[1])
         
+        # Versión del mes para las peticiones condicionales del service worker:
+        # si nada ha cambiado se responde 304 sin consultar ni renderizar el mes
+        hay_flash = bool(request.session.get("flash_messages"))
+        ultimo_cambio = db.exec(select(func.max(CambioParte.seq)).where(CambioParte.user_id == user.id)).one()
+        resumen_actualizado = db.exec(
+            select(ParteMensual.fecha_actualizacion).where(
+                ParteMensual.user_id == user.id,
+                ParteMensual.año == año,
+                ParteMensual.mes == mes
+            )
+        ).first()
+        version = f"{user.id}:{año}:{mes}:{ultimo_cambio}:{resumen_actualizado}:{today}:{_VERSION_PLANTILLAS}"
+        etag = 'W/"' + hashlib.sha1(version.encode()).hexdigest()[:20] + '"'
+        if not hay_flash and request.headers.get("if-none-match") == etag:
+            return Response(status_code=304, headers={"ETag": etag})
+        
         # Obtener todos los partes del mes
         partes_mes = db.exec(
             select(ParteDia)
@@ -253,6 +386,10 @@ def repartidor_panel(request: Request, año: int | None = None, mes: int | None
             )
             .order_by(ParteDia.fecha)
         ).all()
+        # Los meses archivados ya no están en la tabla (ver app/archivo.py)
+        archivados = partes_archivados(db, user.company_id, primer_dia, ultimo_dia, user.id)
+        if archivados:
+            partes_mes = sorted([*partes_mes, *archivados], key=lambda p: (p.fecha, p.id))
         
         # Crear diccionario de partes por día (ahora puede haber múltiples partes por día)
         partes_por_dia = {}
@@ -277,12 +414,7 @@ def repartidor_panel(request: Request, año: int | None = None, mes: int | None
                     # Calcular totales del día para mostrar en el resumen
                     total_envios_dia = sum(p.num_envios or 0 for p in partes_dia)
                     total_km_dia = sum(p.km_diferencia or 0 for p in partes_dia)
-                    total_gastos_dia = sum(
-                        (p.dietas or 0) + (p.alojamiento or 0) + (p.transporte_billetes or 0) + 
-                        (p.gasolina or 0) + (p.comida or 0) + (p.otros_consumiciones or 0) + 
-                        (p.material or 0) + (p.otros_gastos or 0)
-                        for p in partes_dia
-                    )
+                    total_gastos_dia = sum(p.total_gastos or 0 for p in partes_dia)
                     
                     dias_semana.append({
                         'dia': dia,
@@ -301,12 +433,7 @@ def repartidor_panel(request: Request, año: int | None = None, mes: int | None
         # Calcular estadísticas del mes
         total_km = sum(p.km_diferencia or 0 for p in partes_mes)
         total_horas = sum(p.horas or 0 for p in partes_mes)
-        total_gastos = sum(
-            (p.dietas or 0) + (p.alojamiento or 0) + (p.transporte_billetes or 0) + 
-            (p.gasolina or 0) + (p.comida or 0) + (p.otros_consumiciones or 0) + 
-            (p.material or 0) + (p.otros_gastos or 0)
-            for p in partes_mes
-        )
+        total_gastos = sum(p.total_gastos or 0 for p in partes_mes)
         dias_trabajados = len(partes_mes)
         
         # Verificar si existe parte mensual
@@ -318,7 +445,7 @@ def repartidor_panel(request: Request, año: int | None = None, mes: int | None
             )
         ).first()
         
-        return render_template(
+        response = render_template(
             "repartidor.html",
             request,
             title="Repartidor",
@@ -338,6 +465,10 @@ def repartidor_panel(request: Request, año: int | None = None, mes: int | None
             ],
             años=list(range(today.year - 2, today.year + 2))
         )
+        response.headers["ETag"] = etag
+        # Las páginas con mensajes flash no se guardan en la caché del service worker
+        response.headers["Cache-Control"] = "no-store" if hay_flash else "private, no-cache"
+        return response
 
 @app.post("/repartidor/parte")
 def guardar_parte(
@@ -365,6 +496,7 @@ def guardar_parte(
     num_envios: int = Form(0),
     horas: float = Form(0.0),
     observaciones: str = Form(None),
+    version: str = Form(""),  # versión del parte que se editó (vacía al crear)
 ):
     import json
     
@@ -385,6 +517,28 @@ def guardar_parte(
         except json.JSONDecodeError:
             flash_error(request, "Error en rutas", "El formato de las rutas es inválido. Por favor, revisa los datos ingresados.")
             return RedirectResponse("/repartidor", status_code=302)
+        if not isinstance(rutas_data, list) or not all(isinstance(r, dict) for r in rutas_data):
+            flash_error(request, "Error en rutas", "El formato de las rutas es inválido. Por favor, revisa los datos ingresados.")
+            return RedirectResponse("/repartidor", status_code=302)
+
+        # Validar y normalizar las horas de las rutas (HH:MM)
+        duraciones = []
+        try:
+            for ruta_data in rutas_data:
+                salida = parse_hora(ruta_data.get('salida_hora'))
+                llegada = parse_hora(ruta_data.get('llegada_hora'))
+                ruta_data['salida_hora'] = formatear_hora(salida) or ''
+                ruta_data['llegada_hora'] = formatear_hora(llegada) or ''
+                duracion = minutos_entre(salida, llegada)
+                if duracion is not None:
+                    duraciones.append(duracion)
+        except ValueError as e:
+            flash_error(request, "Hora inválida", str(e))
+            return RedirectResponse("/repartidor", status_code=302)
+        except (TypeError, AttributeError):
+            flash_error(request, "Error en rutas", "Las horas de las rutas deben tener el formato HH:MM.")
+            return RedirectResponse("/repartidor", status_code=302)
+        tiempo_total = formatear_duracion(sum(duraciones)) if duraciones else None
         
         # Convertir parte_id a entero si no está vacío
         parte_id_int = None
@@ -411,6 +565,9 @@ def guardar_parte(
                     flash_error(request, "Sin permisos", "No puedes editar un parte de otra empresa.")
                     return RedirectResponse("/repartidor", status_code=302)
                 
+                comprobar_mes_abierto(db, parte.company_id, parte.fecha)
+                comprobar_version(parte, leer_version(version))
+                
                 # Actualizar campos básicos del parte
                 parte.km_salida = float(km_salida or 0)
                 parte.km_llegada = float(km_llegada or 0)
@@ -429,9 +586,12 @@ def guardar_parte(
                 parte.otros_gastos = float(otros_gastos or 0)
                 parte.num_envios = int(num_envios or 0)
                 parte.horas = float(horas or 0)
+                if tiempo_total is not None:
+                    # Sin horas en las rutas se conserva el que hubiera (p. ej. puesto por la API)
+                    parte.tiempo_total = tiempo_total
                 
                 # Eliminar rutas existentes y crear nuevas
-                db.exec(text("DELETE FROM ruta WHERE parte_dia_id = :parte_id"), {"parte_id": parte_id_int})
+                db.exec(text("DELETE FROM ruta WHERE parte_dia_id = :parte_id"), params={"parte_id": parte_id_int})
                 
                 # Crear nuevas rutas
                 for ruta_data in rutas_data:
@@ -449,6 +609,7 @@ def guardar_parte(
                     )
                     db.add(nueva_ruta)
                 
+                parte_cambiado(db, parte, "actualizado")
                 flash_success(request, "¡Parte actualizado!", f"El parte del {fecha} ha sido actualizado correctamente.")
                 
             else:
@@ -456,6 +617,8 @@ def guardar_parte(
                 user_id_for_parte = user.id
                 if user.role == "admin":
                     user_id_for_parte = user.id
+                
+                comprobar_mes_abierto(db, user.company_id, date.fromisoformat(fecha))
                     
                 p = ParteDia(
                     fecha=date.fromisoformat(fecha),
@@ -479,13 +642,13 @@ def guardar_parte(
                     # Campos originales
                     num_envios=int(num_envios or 0),
                     horas=float(horas or 0),
+                    tiempo_total=tiempo_total,
                     # IDs
                     user_id=user_id_for_parte,
                     company_id=user.company_id,
                 )
                 db.add(p)
-                db.commit()
-                db.refresh(p)
+                db.flush()  # para tener el id; parte y rutas se confirman juntos
                 
                 # Crear rutas asociadas al nuevo parte
                 for ruta_data in rutas_data:
@@ -503,10 +666,21 @@ def guardar_parte(
                     )
                     db.add(nueva_ruta)
                 
+                parte_cambiado(db, p, "creado")
                 flash_success(request, "¡Parte creado!", f"El parte del {fecha} ha sido creado correctamente.")
             
             db.commit()
             
+        except MesCerrado as e:
+            db.rollback()
+            flash_error(request, "Mes cerrado", str(e))
+        except (ParteModificado, StaleDataError):
+            db.rollback()
+            flash_error(
+                request,
+                "Parte modificado",
+                "Otra persona ha cambiado este parte mientras lo editabas. Ábrelo de nuevo para ver los datos actuales y repite tus cambios.",
+            )
         except Exception as e:
             db.rollback()
             flash_error(request, "Error al guardar", f"No se pudo guardar el parte: {str(e)}")
@@ -514,7 +688,14 @@ def guardar_parte(
     return RedirectResponse("/repartidor", status_code=302)
 
 @app.get("/admin", response_class=HTMLResponse)
-def admin_panel(request: Request, user_id: str = "", desde: str | None = None, hasta: str | None = None):
+def admin_panel(
+    request: Request,
+    user_id: str = "",
+    desde: str | None = None,
+    hasta: str | None = None,
+    gastos_min: str = "",
+    orden: str = "fecha",
+):
     with Session(engine) as db:
         admin = require_role(request, db, "admin")
         company = db.get(Company, admin.company_id)
@@ -555,68 +736,95 @@ def admin_panel(request: Request, user_id: str = "", desde: str | None = None, h
         )
         if user_id_int:
             q = q.where(ParteDia.user_id == user_id_int)
-        resultados = db.exec(q.order_by(ParteDia.fecha.desc())).all()
         
-        # Crear lista de partes con información del usuario incluida
-        partes_con_usuario = []
-        for parte_dia, user_info in resultados:
-            # Crear un objeto con toda la información necesaria
-            parte_completo = {
-                'id': parte_dia.id,
-                'fecha': parte_dia.fecha,
-                'username': user_info.username,
-                'km_salida': parte_dia.km_salida,
-                'km_llegada': parte_dia.km_llegada,
-                'km_diferencia': parte_dia.km_diferencia,
-                'salida_lugar': parte_dia.salida_lugar,
-                'llegada_lugar': parte_dia.llegada_lugar,
-                'horas': parte_dia.horas,
-                'num_envios': parte_dia.num_envios,
-                'dietas': parte_dia.dietas,
-                'alojamiento': parte_dia.alojamiento,
-                'transporte_billetes': parte_dia.transporte_billetes,
-                'gasolina': parte_dia.gasolina,
-                'comida': parte_dia.comida,
-                'otros_consumiciones': parte_dia.otros_consumiciones,
-                'material': parte_dia.material,
-                'otros_gastos': parte_dia.otros_gastos,
-                'observaciones': parte_dia.observaciones
-            }
-            partes_con_usuario.append(parte_completo)
+        # Filtro por gasto mínimo (usa el índice company_id + total_gastos)
+        gastos_min_float = None
+        if gastos_min and gastos_min.strip():
+            try:
+                gastos_min_float = float(gastos_min.replace(",", "."))
+            except ValueError:
+                gastos_min_float = None
+        if gastos_min_float is not None:
+            q = q.where(ParteDia.total_gastos >= gastos_min_float)
         
-        # Para cálculos, usar solo los objetos ParteDia
-        partes_solo = [parte for parte, _ in resultados]
+        if orden == "gastos":
+            # Partes más caros primero
+            q = q.order_by(ParteDia.total_gastos.desc(), ParteDia.fecha.desc())
+        else:
+            orden = "fecha"
+            q = q.order_by(ParteDia.fecha.desc())
+        def calcular_panel():
+            with Session(engine_lectura) as lectura:
+                resultados = lectura.exec(q).all()
+                archivados = partes_archivados(lectura, company.id, desde, hasta, user_id_int)
+                if archivados:
+                    usuarios = {u.id: u for u in lectura.exec(select(User).where(User.company_id == company.id)).all()}
+                    resultados += [
+                        (p, usuarios[p.user_id]) for p in archivados
+                        if p.user_id in usuarios and (gastos_min_float is None or (p.total_gastos or 0) >= gastos_min_float)
+                    ]
+                    if orden == "gastos":
+                        resultados.sort(key=lambda r: (r[0].total_gastos or 0, r[0].fecha), reverse=True)
+                    else:
+                        resultados.sort(key=lambda r: r[0].fecha, reverse=True)
         
-        # Calcular estadísticas
-        total_km = sum((p.km_diferencia or 0) for p in partes_solo)
-        total_horas = sum((p.horas or 0) for p in partes_solo)
-        total_gastos = sum(
-            (p.dietas or 0) + (p.alojamiento or 0) + (p.transporte_billetes or 0) + 
-            (p.gasolina or 0) + (p.comida or 0) + (p.otros_consumiciones or 0) + 
-            (p.material or 0) + (p.otros_gastos or 0)
-            for p in partes_solo
-        )
+            # Crear lista de partes con información del usuario incluida
+            partes_con_usuario = []
+            for parte_dia, user_info in resultados:
+                # Crear un objeto con toda la información necesaria
+                parte_completo = {
+                    'id': parte_dia.id,
+                    'fecha': parte_dia.fecha,
+                    'username': user_info.username,
+                    'km_salida': parte_dia.km_salida,
+                    'km_llegada': parte_dia.km_llegada,
+                    'km_diferencia': parte_dia.km_diferencia,
+                    'salida_lugar': parte_dia.salida_lugar,
+                    'llegada_lugar': parte_dia.llegada_lugar,
+                    'horas': parte_dia.horas,
+                    'num_envios': parte_dia.num_envios,
+                    'dietas': parte_dia.dietas,
+                    'alojamiento': parte_dia.alojamiento,
+                    'transporte_billetes': parte_dia.transporte_billetes,
+                    'gasolina': parte_dia.gasolina,
+                    'comida': parte_dia.comida,
+                    'otros_consumiciones': parte_dia.otros_consumiciones,
+                    'material': parte_dia.material,
+                    'otros_gastos': parte_dia.otros_gastos,
+                    'total_gastos': parte_dia.total_gastos,
+                    'observaciones': parte_dia.observaciones
+                }
+                partes_con_usuario.append(parte_completo)
         
-        # Estadísticas por usuario
-        users_with_stats = []
-        for user in users:
-            user_partes = [p for p in partes_solo if p.user_id == user.id]
-            user_km = sum((p.km_diferencia or 0) for p in user_partes)
-            user_gastos = sum(
-                (p.dietas or 0) + (p.alojamiento or 0) + (p.transporte_billetes or 0) + 
-                (p.gasolina or 0) + (p.comida or 0) + (p.otros_consumiciones or 0) + 
-                (p.material or 0) + (p.otros_gastos or 0)
-                for p in user_partes
-            )
-            ultimo_parte = max([p.fecha for p in user_partes], default=None)
-            users_with_stats.append({
-                "id": user.id,
-                "username": user.username,
-                "partes_count": len(user_partes),
-                "total_km": user_km,
-                "total_gastos": user_gastos,
-                "ultimo_parte": ultimo_parte.strftime('%d/%m/%Y') if ultimo_parte else 'Nunca'
-            })
+            # Para cálculos, usar solo los objetos ParteDia
+            partes_solo = [parte for parte, _ in resultados]
+        
+            # Calcular estadísticas
+            total_km = sum((p.km_diferencia or 0) for p in partes_solo)
+            total_horas = sum((p.horas or 0) for p in partes_solo)
+            total_gastos = sum((p.total_gastos or 0) for p in partes_solo)
+        
+            # Estadísticas por usuario
+            users_with_stats = []
+            for user in users:
+                user_partes = [p for p in partes_solo if p.user_id == user.id]
+                user_km = sum((p.km_diferencia or 0) for p in user_partes)
+                user_gastos = sum((p.total_gastos or 0) for p in user_partes)
+                ultimo_parte = max([p.fecha for p in user_partes], default=None)
+                users_with_stats.append({
+                    "id": user.id,
+                    "username": user.username,
+                    "partes_count": len(user_partes),
+                    "total_km": user_km,
+                    "total_gastos": user_gastos,
+                    "ultimo_parte": ultimo_parte.strftime('%d/%m/%Y') if ultimo_parte else 'Nunca'
+                })
+            return users_with_stats, partes_con_usuario, total_km, total_horas, total_gastos
+
+        # Peticiones idénticas simultáneas comparten un único cálculo (ver app/cache.py)
+        users_with_stats, partes_con_usuario, total_km, total_horas, total_gastos = cache_resultados.obtener(
+            company.id, ("admin", user_id_int, desde, hasta, gastos_min_float, orden), calcular_panel
+        )
         
         # Comprobar si PDF está disponible
         try:
@@ -642,9 +850,31 @@ def admin_panel(request: Request, user_id: str = "", desde: str | None = None, h
             pdf_enabled=pdf_enabled,
             total_km=total_km,
             total_horas=total_horas,
-            total_gastos=total_gastos
+            total_gastos=total_gastos,
+            gastos_min=gastos_min,
+            orden=orden,
+            cierres=cierres_empresa(db, company.id),
+            tokens=db.exec(
+                select(TokenApi).where(TokenApi.company_id == company.id, TokenApi.revocado == False).order_by(TokenApi.fecha_creacion)
+            ).all(),
+            hoy=today,
         )
 
+# Las filas exportadas cuentan para la cuota de la empresa (las que salen de la caché no)
+def informe_partes(company_id: int, desde, hasta, user_id: Optional[int]) -> List[dict]:
+    cuotas.comprobar(company_id, FILAS_EXPORTADAS)
+    with Session(engine_lectura) as lectura:
+        filas = consultar_partes(lectura, company_id, desde, hasta, user_id)
+    cuotas.anotar(company_id, FILAS_EXPORTADAS, len(filas))
+    return filas
+
+def partes_del_mes(company_id: int, año: int, mes: int):
+    cuotas.comprobar(company_id, FILAS_EXPORTADAS)
+    with Session(engine_lectura) as lectura:
+        por_repartidor = partes_por_repartidor(lectura, company_id, año, mes)
+    cuotas.anotar(company_id, FILAS_EXPORTADAS, sum(len(filas) for filas in por_repartidor.values()))
+    return por_repartidor
+
 @app.get("/admin/export/excel")
 def export_excel(request: Request, user_id: str = "", desde: str | None = None, hasta: str | None = None):
     with Session(engine) as db:
@@ -668,50 +898,11 @@ def export_excel(request: Request, user_id: str = "", desde: str | None = None,
         except ValueError:
             raise HTTPException(400, "Formato de fecha inválido. Use YYYY-MM-DD")
             
-        q = (
-            select(ParteDia, User)
-            .where(
-                ParteDia.company_id == admin.company_id,
-                ParteDia.fecha >= desde,
-                ParteDia.fecha <= hasta,
-            )
-            .join(User, ParteDia.user_id == User.id)
+        contenido = cache_resultados.obtener(
+            admin.company_id, ("excel", desde, hasta, user_id_int),
+            lambda: generar_excel(informe_partes(admin.company_id, desde, hasta, user_id_int)),
         )
-        if user_id_int:
-            q = q.where(ParteDia.user_id == user_id_int)
-        rows = db.exec(q).all()
-        
-        data = []
-        for p, u in rows:
-            total_gastos = (
-                (p.dietas or 0) + (p.alojamiento or 0) + (p.transporte_billetes or 0) + 
-                (p.gasolina or 0) + (p.comida or 0) + (p.otros_consumiciones or 0) + 
-                (p.material or 0) + (p.otros_gastos or 0)
-            )
-            data.append({
-                "fecha": p.fecha.isoformat() if p.fecha else "",
-                "repartidor": u.username,
-                "km_salida": p.km_salida or 0,
-                "km_llegada": p.km_llegada or 0,
-                "km_diferencia": p.km_diferencia or 0,
-                "salida_lugar": p.salida_lugar or "",
-                "llegada_lugar": p.llegada_lugar or "",
-                "horas": p.horas or 0,
-                "num_envios": p.num_envios or 0,
-                "dietas": p.dietas or 0,
-                "gasolina": p.gasolina or 0,
-                "alojamiento": p.alojamiento or 0,
-                "comida": p.comida or 0,
-                "material": p.material or 0,
-                "otros_gastos": p.otros_gastos or 0,
-                "total_gastos": total_gastos,
-                "observaciones": p.observaciones or "",
-            })
-        
-        df = pd.DataFrame(data)
-        output = io.BytesIO()
-        with pd.ExcelWriter(output, engine="openpyxl") as writer:
-            df.to_excel(writer, index=False, sheet_name="partes_diarios")
+        output = io.BytesIO(contenido)
         output.seek(0)
         filename = f"partes_{desde}_a_{hasta}" + (f"_user{user_id}" if user_id else "") + ".xlsx"
         headers = {"Content-Disposition": f'attachment; filename="{filename}"'}
@@ -744,69 +935,405 @@ def export_pdf(request: Request, user_id: str = "", desde: str | None = None, ha
         except ValueError:
             raise HTTPException(400, "Formato de fecha inválido. Use YYYY-MM-DD")
             
-        q = (
-            select(ParteDia, User)
-            .where(
-                ParteDia.company_id == admin.company_id,
-                ParteDia.fecha >= desde,
-                ParteDia.fecha <= hasta,
+        try:
+            pdf_bytes = cache_resultados.obtener(
+                admin.company_id, ("pdf", desde, hasta, user_id_int),
+                lambda: generar_pdf(informe_partes(admin.company_id, desde, hasta, user_id_int)),
             )
-            .join(User, ParteDia.user_id == User.id)
-            .order_by(ParteDia.fecha)
+        except RuntimeError as e:
+            raise HTTPException(500, str(e))
+        return Response(
+            content=pdf_bytes,
+            media_type="application/pdf",
+            headers={"Content-Disposition": 'attachment; filename="export.pdf"'},
         )
-        if user_id_int:
-            q = q.where(ParteDia.user_id == user_id_int)
-        rows = db.exec(q).all()
 
-        # HTML simple para exportar
-        html = "<h2>Partes</h2><table border='1' cellspacing='0' cellpadding='4'><tr><th>Fecha</th><th>Usuario</th><th>Envíos</th><th>Km</th><th>Horas</th><th>Obs.</th></tr>"
-        for p, u in rows:
-            html += f"<tr><td>{p.fecha}</td><td>{u.username}</td><td>{p.num_envios}</td><td>{p.km}</td><td>{p.horas}</td><td>{p.observaciones or ''}</td></tr>"
-        html += "</table>"
+# ZIP con el PDF y el Excel mensual de cada repartidor (para nóminas)
+@app.get("/admin/export/bundle")
+def export_bundle(request: Request, año: int | None = None, mes: int | None = None):
+    with Session(engine) as db:
+        admin = require_role(request, db, "admin")
+        today = date.today()
+        año = año or today.year
+        mes = mes or today.month
+        if not 1 <= mes <= 12:
+            raise HTTPException(400, "El mes debe estar entre 1 y 12")
+        por_repartidor = cache_resultados.obtener(
+            admin.company_id, ("bundle", año, mes),
+            lambda: partes_del_mes(admin.company_id, año, mes),
+        )
+    
+    filename = f"informes_{año}-{mes:02d}.zip"
+    return StreamingResponse(
+        zip_informes_mensuales(por_repartidor, año, mes),
+        media_type="application/zip",
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'},
+    )
 
-        # WeasyPrint si está disponible, si no ReportLab
+# Importación masiva de partes históricos (NDJSON, CSV o el XLSX de la exportación)
+@app.post("/admin/import")
+def admin_import(request: Request, archivo: UploadFile = File(...)):
+    with Session(engine) as db:
+        admin = require_role(request, db, "admin")
         try:
-            from weasyprint import HTML  # type: ignore
-            pdf_bytes = HTML(string=html).write_pdf()
-            return Response(
-                content=pdf_bytes,
-                media_type="application/pdf",
-                headers={"Content-Disposition": 'attachment; filename="export.pdf"'},
-            )
-        except Exception:
-            try:
-                from reportlab.lib.pagesizes import A4  # type: ignore
-                from reportlab.pdfgen import canvas  # type: ignore
-                from reportlab.lib.units import mm  # type: ignore
-
-                buf = io.BytesIO()
-                c = canvas.Canvas(buf, pagesize=A4)
-                w, h = A4
-                y = h - 20 * mm
-
-                c.setFont("Helvetica-Bold", 14)
-                c.drawString(20 * mm, y, "Partes")
-                y -= 10 * mm
-
-                c.setFont("Helvetica", 10)
-                for p, u in rows:
-                    line = f"{p.fecha} | {u.username} | {p.num_envios} env | {p.km} km | {p.horas} h | {p.observaciones or ''}"
-                    c.drawString(20 * mm, y, line[:120])
-                    y -= 6 * mm
-                    if y < 20 * mm:
-                        c.showPage()
-                        y = h - 20 * mm
-
-                c.showPage()
-                c.save()
-                buf.seek(0)
-                return StreamingResponse(
-                    buf,
-                    media_type="application/pdf",
-                    headers={"Content-Disposition": 'attachment; filename="export.pdf"'},
-                )
-            except Exception:
-                raise HTTPException(500, "Para exportar a PDF instala 'weasyprint' o 'reportlab'")
+            cuotas.comprobar(admin.company_id, FILAS_IMPORTADAS)
+            formato = detectar_formato(archivo.filename, archivo.content_type)
+            informe = importar_partes(db, admin.company_id, archivo.file, formato)
+        except CuotaSuperada as e:
+            if "text/html" in request.headers.get("accept", ""):
+                flash_error(request, "Límite de importación", str(e))
+                return RedirectResponse("/admin", status_code=302)
+            raise
+        except ErrorImportacion as e:
+            if "text/html" in request.headers.get("accept", ""):
+                flash_error(request, "Importación fallida", str(e))
+                return RedirectResponse("/admin", status_code=302)
+            raise HTTPException(status_code=400, detail=str(e))
+        cuotas.anotar(admin.company_id, FILAS_IMPORTADAS, informe["importados"])
+    
+    # Desde el formulario del panel se muestra un resumen; desde la API, el informe completo
+    if "text/html" in request.headers.get("accept", ""):
+        resumen = f"{informe['importados']} de {informe['filas']} partes importados."
+        if informe["con_error"]:
+            primeros = "; ".join(f"fila {e['fila']}: {e['error']}" for e in informe["errores"][:5])
+            flash_warning(request, "Importación con errores", f"{resumen} {informe['con_error']} filas con errores ({primeros}).")
+        else:
+            flash_success(request, "¡Importación completada!", resumen)
+        return RedirectResponse("/admin", status_code=302)
+    return informe
+
+# Tokens de acceso para integraciones (ERP, nóminas)
+@app.post("/admin/tokens")
+def admin_crear_token(request: Request, nombre: str = Form(...)):
+    with Session(engine) as db:
+        admin = require_role(request, db, "admin")
+        nombre = nombre.strip()
+        if not nombre:
+            flash_error(request, "Nombre requerido", "Indica para qué integración es el token.")
+            return RedirectResponse("/admin", status_code=302)
+        _, token = crear_token_api(db, admin.company_id, nombre, admin.id)
+        db.commit()
+        flash_success(request, "Token creado", f"Cópialo ahora, no se volverá a mostrar: {token}")
+    return RedirectResponse("/admin", status_code=302)
+
+@app.post("/admin/tokens/{token_id}/revocar")
+def admin_revocar_token(request: Request, token_id: int):
+    with Session(engine) as db:
+        admin = require_role(request, db, "admin")
+        registro = db.get(TokenApi, token_id)
+        if not registro or registro.company_id != admin.company_id:
+            raise HTTPException(status_code=404, detail="Token no encontrado")
+        registro.revocado = True
+        db.add(registro)
+        db.commit()
+        flash_info(request, "Token revocado", f"El token '{registro.nombre}' ya no da acceso.")
+    return RedirectResponse("/admin", status_code=302)
+
+# Lectura masiva en NDJSON para integraciones: partes con rutas, borrados y partes mensuales
+@app.get("/api/export/ndjson")
+def export_ndjson(request: Request, updated_since: str | None = None, token: str | None = None, limite: int = LIMITE_POR_DEFECTO):
+    with Session(engine) as db:
+        company_id = require_integracion(request, db)
+    try:
+        # Con réplica, la ventana se cierra un poco antes para no saltarse lo que aún no le ha llegado
+        retraso = RETRASO_REPLICA_SEGUNDOS if engine_lectura is not engine else 0
+        estado = decodificar_token(token) if token else estado_inicial(updated_since, retraso)
+    except ErrorIntegracion as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    limite = min(max(limite, 1), LIMITE_MAXIMO)
+    cuotas.comprobar(company_id, FILAS_EXPORTADAS)
+    
+    def generar():
+        # Sesión propia: la respuesta se sigue enviando después de salir del endpoint
+        lineas = 0
+        try:
+            with Session(engine_lectura) as db:
+                for bloque in exportar_ndjson(db, company_id, estado, limite):
+                    lineas += bloque.count(b"\n")
+                    yield bloque
+        finally:
+            cuotas.anotar(company_id, FILAS_EXPORTADAS, lineas)
+    
+    return StreamingResponse(generar(), media_type="application/x-ndjson")
+
+# Cierre de mes: genera los partes mensuales de todos los repartidores de una vez
+@app.post("/admin/cierre-mes")
+def admin_cierre_mes(
+    request: Request,
+    año: int = Form(...),
+    mes: int = Form(...),
+    bloquear: bool = Form(False),
+):
+    with Session(engine) as db:
+        admin = require_role(request, db, "admin")
+        if not 1 <= mes <= 12:
+            flash_error(request, "Mes inválido", "El mes debe estar entre 1 y 12.")
+            return RedirectResponse("/admin", status_code=302)
+        try:
+            escritos = cerrar_mes(db, admin.company_id, año, mes, bloquear=bloquear, admin_id=admin.id)
+            db.commit()
+        except Exception as e:
+            db.rollback()
+            flash_error(request, "Error en el cierre", f"No se pudo cerrar el mes: {str(e)}")
+            return RedirectResponse("/admin", status_code=302)
+        
+        estado = " y bloqueado" if bloquear else ""
+        flash_success(request, "¡Mes cerrado!", f"{mes:02d}/{año} cerrado{estado}: {escritos} partes mensuales generados.")
+    return RedirectResponse("/admin", status_code=302)
+
+@app.post("/admin/cierre-mes/reabrir")
+def admin_reabrir_mes(request: Request, año: int = Form(...), mes: int = Form(...)):
+    with Session(engine) as db:
+        admin = require_role(request, db, "admin")
+        try:
+            reabierto = reabrir_mes(db, admin.company_id, año, mes)
+        except MesArchivado as e:
+            flash_error(request, "Mes archivado", str(e))
+            return RedirectResponse("/admin", status_code=302)
+        if reabierto:
+            db.commit()
+            flash_info(request, "Mes reabierto", f"Los partes de {mes:02d}/{año} vuelven a poder editarse.")
+        else:
+            flash_warning(request, "Sin cambios", f"El mes {mes:02d}/{año} no estaba bloqueado.")
+    return RedirectResponse("/admin", status_code=302)
+
+# Estadísticas de duración por repartidor y por ruta (agregadas en SQL)
+@app.get("/admin/duraciones")
+def admin_duraciones(request: Request, desde: str | None = None, hasta: str | None = None):
+    with Session(engine) as db:
+        admin = require_role(request, db, "admin")
+        today = date.today()
+        try:
+            desde_d = date.fromisoformat(desde) if desde else date(today.year, today.month, 1)
+            hasta_d = date.fromisoformat(hasta) if hasta else today
+        except ValueError:
+            raise HTTPException(400, "Formato de fecha inválido. Use YYYY-MM-DD")
+    with Session(engine_lectura) as lectura:
+        return {
+            "desde": desde_d.isoformat(),
+            "hasta": hasta_d.isoformat(),
+            "repartidores": duraciones_por_repartidor(lectura, admin.company_id, desde_d, hasta_d),
+            "rutas": duraciones_por_ruta(lectura, admin.company_id, desde_d, hasta_d),
+        }
+
+# KPIs de la flota a partir del cubo de agregados (ver app/agregados.py)
+def _rango_fechas(desde: str | None, hasta: str | None):
+    today = date.today()
+    try:
+        desde_d = date.fromisoformat(desde) if desde else date(today.year, today.month, 1)
+        hasta_d = date.fromisoformat(hasta) if hasta else today
+    except ValueError:
+        raise HTTPException(400, "Formato de fecha inválido. Use YYYY-MM-DD")
+    if desde_d > hasta_d:
+        raise HTTPException(400, "La fecha 'desde' es posterior a 'hasta'")
+    return desde_d, hasta_d
+
+@app.get("/admin/kpis")
+def admin_kpis(request: Request, desde: str | None = None, hasta: str | None = None, user_id: int | None = None):
+    with Session(engine) as db:
+        admin = require_role(request, db, "admin")
+    desde_d, hasta_d = _rango_fechas(desde, hasta)
+    with Session(engine_lectura) as lectura:
+        return kpis(lectura, admin.company_id, desde_d, hasta_d, user_id)
+
+@app.get("/admin/kpis/serie")
+def admin_kpis_serie(
+    request: Request,
+    granularidad: str = "m",
+    desde: str | None = None,
+    hasta: str | None = None,
+    user_id: int | None = None,
+):
+    with Session(engine) as db:
+        admin = require_role(request, db, "admin")
+    desde_d, hasta_d = _rango_fechas(desde, hasta)
+    with Session(engine_lectura) as lectura:
+        try:
+            puntos = serie(lectura, admin.company_id, desde_d, hasta_d, granularidad, user_id)
+        except ValueError as e:
+            raise HTTPException(400, str(e))
+    return {"granularidad": granularidad, "desde": desde_d.isoformat(), "hasta": hasta_d.isoformat(), "puntos": puntos}
+
+# Percentiles por repartidor, MoM/YoY y medias móviles (ver app/analitica.py)
+@app.get("/admin/analytics")
+def admin_analytics(request: Request, desde: str | None = None, hasta: str | None = None):
+    with Session(engine) as db:
+        admin = require_role(request, db, "admin")
+    desde_d, hasta_d = _rango_fechas(desde, hasta)
+
+    def calcular():
+        with Session(engine_lectura) as lectura:
+            return informe_analitica(lectura, admin.company_id, desde_d, hasta_d)
+
+    return cache_resultados.obtener(admin.company_id, ("analitica", desde_d, hasta_d), calcular)
+
+# Cambios en directo para el panel (Server-Sent Events)
+@app.get("/admin/directo")
+async def admin_directo(request: Request, desde: str | None = None, hasta: str | None = None):
+    def autorizar():
+        with Session(engine) as db:
+            return require_role(request, db, "admin")
+    admin = await run_in_threadpool(autorizar)
+    desde_d, hasta_d = _rango_fechas(desde, hasta)
+    ultimo_visto = request.headers.get("last-event-id", "")
+
+    ultimo = await run_in_threadpool(directo.preparar, admin.company_id)
+    sub = directo.suscribir(admin.company_id, desde_d, hasta_d, ultimo)
+    try:
+        # Al reconectar, lo que se perdió mientras tanto
+        pendientes = await run_in_threadpool(
+            directo.pendientes, admin.company_id, int(ultimo_visto) if ultimo_visto.isdigit() else None
+        )
+    except Exception:
+        directo.baja(sub)
+        raise
+
+    async def flujo():
+        loop = asyncio.get_running_loop()
+        fin = loop.time() + DURACION_DIRECTO
+        ya_enviados = {m["id"] for m in pendientes if "id" in m}
+        try:
+            yield "retry: 3000\n\n"
+            for m in pendientes:
+                if sub.interesa(m):
+                    yield evento_sse(m)
+            while True:
+                restante = fin - loop.time()
+                if restante <= 0:
+                    return
+                try:
+                    m = await asyncio.wait_for(sub.cola.get(), min(LATIDO_SEGUNDOS, restante))
+                except asyncio.TimeoutError:
+                    yield ": latido\n\n"
+                    continue
+                if m is None:
+                    yield evento_sse({"tipo": "desconectado"})
+                    return
+                if m.get("id") in ya_enviados:
+                    continue
+                yield evento_sse(m)
+        finally:
+            directo.baja(sub)
+
+    return StreamingResponse(
+        flujo(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+# Consumo de las empresas frente a sus cuotas, para los operadores de la plataforma
+@app.get("/operador/uso")
+def operador_uso(request: Request, horas: int = 24):
+    with Session(engine) as db:
+        require_operador(request, db)
+    horas = min(max(horas, 1), 24 * 31)
+    return {
+        "limites_por_hora": LIMITES_CUOTAS,
+        "horas": horas,
+        "empresas": cuotas.uso(horas),
+        "admision": estado_admision(),
+    }
+
+# Capturas de perfilado (ver app/perfilado.py)
+@app.get("/operador/perfiles")
+def operador_perfiles(request: Request):
+    with Session(engine) as db:
+        require_operador(request, db)
+    return {"capturas": perfilado.listar(), "muestreo": perfilado.config_muestreo()}
+
+@app.get("/operador/perfiles/{id_captura}")
+def operador_perfil(request: Request, id_captura: str):
+    with Session(engine) as db:
+        require_operador(request, db)
+    datos = perfilado.leer(id_captura)
+    if datos is None:
+        raise HTTPException(status_code=404, detail="Captura no encontrada")
+    return datos
+
+# .prof para pstats/snakeviz o pilas plegadas (.folded) para flamegraph.pl/speedscope
+@app.get("/operador/perfiles/{id_captura}/descargar")
+def operador_perfil_descargar(request: Request, id_captura: str):
+    with Session(engine) as db:
+        require_operador(request, db)
+    fichero = perfilado.fichero_perfil(id_captura)
+    if fichero is None or not fichero.exists():
+        raise HTTPException(status_code=404, detail="Captura sin fichero de perfil")
+    return FileResponse(fichero, media_type="application/octet-stream", filename=fichero.name)
+
+@app.get("/operador/perfilado")
+def operador_perfilado(request: Request):
+    with Session(engine) as db:
+        require_operador(request, db)
+    return perfilado.config_muestreo()
+
+# Muestreo: {"porcentaje": 5, "ruta": "/admin", "company_id": 3, "modo": "muestreo", "memoria": false, "capturas": 20}
+@app.post("/operador/perfilado")
+def operador_perfilado_cambiar(request: Request, datos: dict = Body(...)):
+    with Session(engine) as db:
+        require_operador(request, db)
+    try:
+        config = perfilado.validar_config(datos)
+    except (TypeError, ValueError) as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    perfilado.guardar_config_muestreo(config)
+    return config
+
+# Plazas, colas y rechazos del control de admisión de este worker
+@app.get("/admin/admision")
+def admin_admision(request: Request):
+    with Session(engine) as db:
+        require_role(request, db, "admin")
+    return estado_admision()
+
+# Anomalías de cuentakilómetros y gasolina detectadas por la revisión nocturna
+@app.get("/admin/anomalias")
+def admin_anomalias(
+    request: Request,
+    desde: str | None = None,
+    hasta: str | None = None,
+    user_id: int | None = None,
+    tipo: str | None = None,
+):
+    with Session(engine) as db:
+        admin = require_role(request, db, "admin")
+    desde_d, hasta_d = _rango_fechas(desde, hasta)
+    with Session(engine_lectura) as lectura:
+        usernames = dict(lectura.exec(select(User.id, User.username).where(User.company_id == admin.company_id)).all())
+        filas = listar_anomalias(lectura, admin.company_id, desde_d, hasta_d, user_id, tipo)
+        return {
+            "desde": desde_d.isoformat(),
+            "hasta": hasta_d.isoformat(),
+            "total": len(filas),
+            "anomalias": [
+                {
+                    "parte_id": a.parte_id,
+                    "fecha": a.fecha.isoformat(),
+                    "user_id": a.user_id,
+                    "username": usernames.get(a.user_id),
+                    "tipo": a.tipo,
+                    "valor": a.valor,
+                    "esperado": a.esperado,
+                    "fecha_deteccion": a.fecha_deteccion.isoformat(),
+                }
+                for a in filas
+            ],
+        }
+
+# Búsqueda de texto completo en partes y rutas de la empresa
+@app.get("/admin/search")
+def admin_search(request: Request, q: str = "", pagina: int = 1, por_pagina: int = 20):
+    with Session(engine) as db:
+        admin = require_role(request, db, "admin")
+        pagina = max(pagina, 1)
+        por_pagina = min(max(por_pagina, 1), 100)
+        total, resultados = buscar_partes(db, admin.company_id, q, pagina, por_pagina)
+        return {
+            "q": q,
+            "pagina": pagina,
+            "por_pagina": por_pagina,
+            "total": total,
+            "resultados": resultados,
+        }
 
 @app.post("/repartidor/parte-mensual")
 def guardar_parte_mensual(
@@ -819,6 +1346,7 @@ def guardar_parte_mensual(
     with Session(engine) as db:
         try:
             user = require_role(request, db, "repartidor")
+            comprobar_mes_abierto(db, user.company_id, date(año, mes, 1))
             
             # Verificar si ya existe un parte mensual
             parte_existente = db.exec(
@@ -904,6 +1432,9 @@ def guardar_parte_mensual(
                 
             db.commit()
             
+        except MesCerrado as e:
+            db.rollback()
+            flash_error(request, "Mes cerrado", str(e))
         except Exception as e:
             db.rollback()
             flash_error(request, "Error al guardar", f"No se pudo guardar el parte mensual: {str(e)}")
@@ -911,7 +1442,7 @@ def guardar_parte_mensual(
     return RedirectResponse(f"/repartidor?año={año}&mes={mes}", status_code=302)
 
 # API para obtener datos de un parte específico
-@app.get("/api/parte/{parte_id}")
+@app.get("/api/parte/{parte_id}", response_model=ParteDetalle)
 def get_parte_api(request: Request, parte_id: int):
     with Session(engine) as db:
         user = get_current_user(request, db)
@@ -929,34 +1460,18 @@ def get_parte_api(request: Request, parte_id: int):
         elif user.role == "admin" and parte.company_id != user.company_id:
             raise HTTPException(status_code=403, detail="No puedes acceder a este parte")
         
-        return {
-            "id": parte.id,
-            "fecha": parte.fecha.isoformat(),
-            "km_salida": parte.km_salida or 0,
-            "km_llegada": parte.km_llegada or 0,
-            "km_diferencia": parte.km_diferencia or 0,
-            "repostaje": parte.repostaje or "",
-            "num_factura": parte.num_factura or "",
-            "salida_lugar": parte.salida_lugar or "",
-            "salida_hora": parte.salida_hora or "",
-            "llegada_lugar": parte.llegada_lugar or "",
-            "llegada_hora": parte.llegada_hora or "",
-            "tiempo_total": parte.tiempo_total or "",
-            "observaciones": parte.observaciones or "",
-            "dietas": parte.dietas or 0,
-            "alojamiento": parte.alojamiento or 0,
-            "transporte_billetes": parte.transporte_billetes or 0,
-            "gasolina": parte.gasolina or 0,
-            "comida": parte.comida or 0,
-            "otros_consumiciones": parte.otros_consumiciones or 0,
-            "material": parte.material or 0,
-            "otros_gastos": parte.otros_gastos or 0,
-            "num_envios": parte.num_envios or 0,
-            "horas": parte.horas or 0,
-        }
+        return ParteDetalle.model_validate(parte)
+
+def conflicto_parte(db: Session, parte: Optional[ParteDia]) -> HTTPException:
+    """409 con el parte tal como está ahora (None si se ha borrado), para que el
+    cliente combine sus cambios y vuelva a enviarlos con la versión nueva"""
+    return HTTPException(status_code=409, detail={
+        "mensaje": "Otra persona ha modificado este parte mientras lo editabas",
+        "parte": ParteDetalle.model_validate(parte).model_dump(mode="json") if parte else None,
+    })
 
 # Ruta para actualizar un parte existente
-@app.put("/api/parte/{parte_id}")
+@app.put("/api/parte/{parte_id}", response_model=Confirmacion)
 def update_parte_api(
     request: Request,
     parte_id: int,
@@ -985,6 +1500,8 @@ def update_parte_api(
     # Campos originales
     num_envios: int = Form(0),
     horas: float = Form(0.0),
+    # Versión leída por el cliente (opcional): si el parte ha cambiado se responde 409
+    version: str = Form(None),
 ):
     with Session(engine) as db:
         user = get_current_user(request, db)
@@ -1002,6 +1519,24 @@ def update_parte_api(
         elif user.role == "admin" and parte.company_id != user.company_id:
             raise HTTPException(status_code=403, detail="No puedes editar este parte")
         
+        try:
+            comprobar_mes_abierto(db, parte.company_id, parte.fecha)
+            comprobar_version(parte, leer_version(version))
+        except MesCerrado as e:
+            raise HTTPException(status_code=423, detail=str(e))
+        except ParteModificado:
+            raise conflicto_parte(db, parte)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        
+        # Validar horas y tiempo total antes de escribir nada
+        try:
+            salida_hora = formatear_hora(parse_hora(salida_hora))
+            llegada_hora = formatear_hora(parse_hora(llegada_hora))
+            tiempo_total = formatear_duracion(parse_duracion(tiempo_total))
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        
         # Actualizar campos
         parte.km_salida = float(km_salida or 0)
         parte.km_llegada = float(km_llegada or 0)
@@ -1025,11 +1560,28 @@ def update_parte_api(
         parte.num_envios = int(num_envios or 0)
         parte.horas = float(horas or 0)
         
-        db.commit()
-        return {"success": True}
+        try:
+            parte_cambiado(db, parte, "actualizado")
+            db.commit()
+        except StaleDataError:
+            db.rollback()
+            raise conflicto_parte(db, db.get(ParteDia, parte_id))
+        return Confirmacion(version=parte.version)
+
+# Autocompletado de lugares y descripciones de ruta de la empresa
+@app.get("/api/lugares/suggest")
+def sugerir_lugares(request: Request, q: str = "", tipo: str = "lugar", limite: int = 10):
+    if tipo not in TIPOS_SUGERENCIA:
+        raise HTTPException(status_code=400, detail="Tipo inválido: use lugar o descripcion")
+    with Session(engine) as db:
+        user = get_current_user(request, db)
+        if not user:
+            raise HTTPException(status_code=403, detail="No autorizado")
+    limite = min(max(limite, 1), 50)
+    return {"q": q, "tipo": tipo, "sugerencias": sugerencias.sugerir(user.company_id, q, tipo, limite)}
 
 # API para obtener múltiples partes de un día específico
-@app.get("/api/partes-dia/{fecha_str}")
+@app.get("/api/partes-dia/{fecha_str}", response_model=List[ParteResumen])
 def get_partes_dia(fecha_str: str, request: Request):
     with Session(engine) as db:
         user = get_current_user(request, db)
@@ -1049,34 +1601,13 @@ def get_partes_dia(fecha_str: str, request: Request):
             )
             .order_by(ParteDia.id)
         ).all()
+        archivados = partes_archivados(db, user.company_id, fecha, fecha, user.id)
         
-        return [
-            {
-                "id": parte.id,
-                "fecha": parte.fecha.strftime("%Y-%m-%d"),
-                "salida_lugar": parte.salida_lugar,
-                "salida_hora": parte.salida_hora,
-                "llegada_lugar": parte.llegada_lugar,
-                "llegada_hora": parte.llegada_hora,
-                "km_diferencia": parte.km_diferencia,
-                "num_envios": parte.num_envios,
-                "horas": parte.horas,
-                "dietas": parte.dietas,
-                "alojamiento": parte.alojamiento,
-                "transporte_billetes": parte.transporte_billetes,
-                "gasolina": parte.gasolina,
-                "comida": parte.comida,
-                "otros_consumiciones": parte.otros_consumiciones,
-                "material": parte.material,
-                "otros_gastos": parte.otros_gastos,
-                "observaciones": parte.observaciones
-            }
-            for parte in partes
-        ]
+        return [ParteResumen.model_validate(parte) for parte in sorted([*partes, *archivados], key=lambda p: p.id)]
 
 # API para eliminar un parte específico
-@app.delete("/api/parte/{parte_id}")
-def eliminar_parte(parte_id: int, request: Request):
+@app.delete("/api/parte/{parte_id}", response_model=Mensaje)
+def eliminar_parte(parte_id: int, request: Request, version: str | None = None):
     with Session(engine) as db:
         user = get_current_user(request, db)
         if not user:
@@ -1092,7 +1623,72 @@ def eliminar_parte(parte_id: int, request: Request):
         elif user.role == "admin" and parte.company_id != user.company_id:
             raise HTTPException(status_code=403, detail="No puedes eliminar este parte")
         
-        db.delete(parte)
-        db.commit()
+        try:
+            comprobar_mes_abierto(db, parte.company_id, parte.fecha)
+            comprobar_version(parte, leer_version(version))
+        except MesCerrado as e:
+            raise HTTPException(status_code=423, detail=str(e))
+        except ParteModificado:
+            raise conflicto_parte(db, parte)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
         
-        return {"message": "Parte eliminado correctamente"}
+        try:
+            parte_cambiado(db, parte, "eliminado")
+            db.delete(parte)
+            db.commit()
+        except StaleDataError:
+            db.rollback()
+            raise conflicto_parte(db, db.get(ParteDia, parte_id))
+        
+        return Mensaje(message="Parte eliminado correctamente")
+
+# Sincronización offline de la app del repartidor
+@app.get("/api/sync", response_model=CambiosSync)
+def sync_pull(request: Request, cursor: str = "", limite: int = 500):
+    with Session(engine) as db:
+        user = get_current_user(request, db)
+        if not user:
+            raise HTTPException(status_code=403, detail="No autorizado")
+        try:
+            cambios, nuevo_cursor, hay_mas = cambios_desde(db, user.id, cursor, min(max(limite, 1), 500))
+        except ErrorSync as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        return {"cambios": cambios, "cursor": nuevo_cursor, "hay_mas": hay_mas}
+
+@app.post("/api/sync", response_model=ResultadoSync)
+def sync_push(request: Request, payload: dict = Body(...)):
+    operaciones = payload.get("operaciones") or []
+    if not isinstance(operaciones, list):
+        raise HTTPException(status_code=422, detail="operaciones debe ser una lista")
+    if len(operaciones) > 500:
+        raise HTTPException(status_code=400, detail="Se esperan como máximo 500 operaciones")
+    with Session(engine) as db:
+        user = get_current_user(request, db)
+        if not user:
+            raise HTTPException(status_code=403, detail="No autorizado")
+        for intento in range(2):
+            try:
+                resultados = aplicar_lote(db, user, operaciones)
+                db.commit()
+                break
+            except IntegrityError:
+                # Otra petición guardó a la vez la misma clave o el mismo client_id.
+                # Al repetir el lote, lo ya guardado sale como "repetido" o se actualiza
+                db.rollback()
+                if intento:
+                    raise HTTPException(status_code=409, detail="El lote ha coincidido con otra sincronización; reintenta")
+            except StaleDataError:
+                # Otra escritura del mismo parte a la vez: el lote entero se puede reintentar
+                db.rollback()
+                raise HTTPException(status_code=409, detail="Un parte del lote se ha modificado a la vez; reintenta")
+            except Exception:
+                db.rollback()
+                raise
+        
+        # Devolver también los cambios pendientes: un solo viaje para subir y bajar
+        try:
+            cambios, nuevo_cursor, hay_mas = cambios_desde(db, user.id, payload.get("cursor"))
+        except ErrorSync as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        return {"resultados": resultados, "cambios": cambios, "cursor": nuevo_cursor, "hay_mas": hay_mas}
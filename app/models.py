@@ -1,11 +1,19 @@
 from __future__ import annotations
 from typing import Optional, List, TYPE_CHECKING
-from datetime import date, datetime
+from datetime import date, datetime, time
+from sqlalchemy import Column, Index, Integer, event, text
 from sqlmodel import SQLModel, Field, Relationship
+from .tiempos import normalizar_tiempos
 
 if TYPE_CHECKING:
     pass
 
+# Conceptos que suman en el total de gastos de un parte diario
+GASTOS_CAMPOS = (
+    "dietas", "alojamiento", "transporte_billetes", "gasolina",
+    "comida", "otros_consumiciones", "material", "otros_gastos",
+)
+
 class Company(SQLModel, table=True):
     id: Optional[int] = Field(default=None, primary_key=True)
     name: str = Field(index=True, unique=True)
@@ -17,8 +25,26 @@ class User(SQLModel, table=True):
     password_hash: str
     role: str = Field(index=True)  # 'admin' | 'repartidor'
     company_id: int = Field(foreign_key="company.id")
+    # Operador de la plataforma (ve datos de todas las empresas). No se puede
+    # conseguir registrándose: se marca aparte con actualizar_bd_operadores.py
+    es_operador: bool = Field(default=False)
+
+# Control de concurrencia optimista: el ORM comprueba la versión en el WHERE
+# (UPDATE/DELETE ... WHERE id = ? AND version = ?). La sube app/concurrencia.py,
+# una vez por guardado aunque el parte se escriba en varios flush.
+_VERSION_PARTE = Column("version", Integer, nullable=False, server_default=text("1"))
 
 class ParteDia(SQLModel, table=True):
+    __mapper_args__ = {"version_id_col": _VERSION_PARTE, "version_id_generator": False}
+    __table_args__ = (
+        # Permite ordenar y filtrar por gasto dentro de una empresa con un range scan
+        Index("ix_partedia_company_total_gastos", "company_id", "total_gastos"),
+        # Identificador generado por la app del repartidor (sincronización offline)
+        Index("uq_partedia_user_client_id", "user_id", "client_id", unique=True),
+        # Lectura incremental de la integración (updated_since + keyset)
+        Index("ix_partedia_company_actualizacion", "company_id", "fecha_actualizacion", "id"),
+    )
+
     id: Optional[int] = Field(default=None, primary_key=True)
     fecha: date = Field(index=True)
     
@@ -37,6 +63,11 @@ class ParteDia(SQLModel, table=True):
     tiempo_total: Optional[str] = None
     observaciones: Optional[str] = None
     
+    # Horas normalizadas a partir de los textos anteriores (para agregar en SQL)
+    salida_hora_norm: Optional[time] = None
+    llegada_hora_norm: Optional[time] = None
+    duracion_minutos: Optional[int] = Field(default=None, index=True)
+    
     # Gastos
     dietas: float = 0.0
     alojamiento: float = 0.0
@@ -47,16 +78,41 @@ class ParteDia(SQLModel, table=True):
     otros_consumiciones: float = 0.0
     material: float = 0.0
     otros_gastos: float = 0.0
+    total_gastos: float = Field(default=0.0, index=True)  # suma de GASTOS_CAMPOS, se mantiene al guardar
     
     # Campos originales (mantener compatibilidad)
     num_envios: int = 0
     km: float = 0.0
     horas: float = 0.0
 
+    client_id: Optional[str] = None  # id generado en el cliente al crear el parte sin conexión
+    fecha_actualizacion: datetime = Field(default_factory=datetime.now)  # última escritura (parte o rutas)
+    version: int = Field(default=1, sa_column=_VERSION_PARTE)  # ver app/concurrencia.py
+
     user_id: int = Field(foreign_key="user.id")
     company_id: int = Field(foreign_key="company.id")
 
+    def calcular_total_gastos(self) -> float:
+        return sum(float(getattr(self, campo) or 0) for campo in GASTOS_CAMPOS)
+
+@event.listens_for(ParteDia, "before_insert")
+@event.listens_for(ParteDia, "before_update")
+def _actualizar_total_gastos(mapper, connection, parte: ParteDia):
+    """Mantiene total_gastos coherente en cualquier escritura vía ORM"""
+    parte.total_gastos = parte.calcular_total_gastos()
+
+@event.listens_for(ParteDia, "before_insert")
+@event.listens_for(ParteDia, "before_update")
+def _actualizar_tiempos_parte(mapper, connection, parte: ParteDia):
+    normalizar_tiempos(parte, parte.tiempo_total)
+
 class ParteMensual(SQLModel, table=True):
+    __table_args__ = (
+        # Un resumen por repartidor y mes (necesario para el upsert del cierre de mes)
+        Index("uq_partemensual_user_mes", "user_id", "año", "mes", unique=True),
+        Index("ix_partemensual_company_actualizacion", "company_id", "fecha_actualizacion", "id"),
+    )
+
     id: Optional[int] = Field(default=None, primary_key=True)
     año: int = Field(index=True)
     mes: int = Field(index=True)  # 1-12
@@ -86,6 +142,141 @@ class ParteMensual(SQLModel, table=True):
     user_id: int = Field(foreign_key="user.id")
     company_id: int = Field(foreign_key="company.id")
 
+class CierreMes(SQLModel, table=True):
+    __table_args__ = (
+        Index("uq_cierremes_company_mes", "company_id", "año", "mes", unique=True),
+    )
+
+    id: Optional[int] = Field(default=None, primary_key=True)
+    año: int
+    mes: int  # 1-12
+    bloqueado: bool = False  # si es True no se pueden crear, editar ni borrar partes del mes
+    fecha_cierre: datetime = Field(default_factory=datetime.now)
+    cerrado_por: Optional[int] = Field(default=None, foreign_key="user.id")
+    company_id: int = Field(foreign_key="company.id")
+
+class AgregadoPartes(SQLModel, table=True):
+    """Totales de partes por día, semana ISO o mes, por repartidor y de toda la
+    empresa (user_id = 0). Se mantienen al escribir partes (ver app/agregados.py)."""
+    __table_args__ = (
+        Index("uq_agregadopartes_periodo", "company_id", "granularidad", "user_id", "inicio", unique=True),
+    )
+
+    id: Optional[int] = Field(default=None, primary_key=True)
+    granularidad: str  # 'd' | 's' | 'm'
+    inicio: date  # primer día del periodo (el lunes en las semanas)
+    user_id: int = 0  # sin foreign key: 0 es la empresa
+    company_id: int = Field(foreign_key="company.id")
+
+    partes: int = 0
+    repartidores: int = 0  # repartidores con algún parte en el periodo
+    km: float = 0.0
+    envios: int = 0
+    horas: float = 0.0
+    dietas: float = 0.0
+    alojamiento: float = 0.0
+    transporte_billetes: float = 0.0
+    gasolina: float = 0.0
+    comida: float = 0.0
+    otros_consumiciones: float = 0.0
+    material: float = 0.0
+    otros_gastos: float = 0.0
+    total_gastos: float = 0.0
+
+class ArchivoMes(SQLModel, table=True):
+    """Mes de partes movido a ficheros Parquet (ver app/archivo.py)"""
+    __table_args__ = (
+        Index("uq_archivomes_company_mes", "company_id", "año", "mes", unique=True),
+    )
+
+    id: Optional[int] = Field(default=None, primary_key=True)
+    año: int
+    mes: int  # 1-12
+    estado: str = "en_curso"  # 'en_curso' | 'archivado'
+    fichero: Optional[str] = None  # ruta relativa al directorio de archivo (sin extensión)
+    partes: int = 0
+    rutas: int = 0
+    fecha_archivo: datetime = Field(default_factory=datetime.now)
+    company_id: int = Field(foreign_key="company.id")
+
+class AnomaliaParte(SQLModel, table=True):
+    """Incidencia detectada en los kilómetros o la gasolina de un parte (ver app/odometro.py)"""
+    __table_args__ = (
+        Index("uq_anomaliaparte_parte_tipo", "parte_id", "tipo", unique=True),
+        Index("ix_anomaliaparte_company_user_fecha", "company_id", "user_id", "fecha"),
+    )
+
+    id: Optional[int] = Field(default=None, primary_key=True)
+    parte_id: int  # sin foreign key: se recalculan al borrar partes
+    fecha: date
+    # 'hueco' | 'solape' | 'negativo' | 'descuadre' | 'atipico_km' | 'atipico_gasolina'
+    tipo: str
+    valor: float  # lo observado (km de salida, diferencia, gasolina...)
+    esperado: Optional[float] = None  # lo que cabía esperar (llegada anterior, límite...)
+    fecha_deteccion: datetime = Field(default_factory=datetime.now)
+    user_id: int = Field(foreign_key="user.id")
+    company_id: int = Field(foreign_key="company.id")
+
+class RevisionOdometro(SQLModel, table=True):
+    """Hasta dónde (fecha_actualizacion de los partes) se ha revisado cada empresa"""
+    id: Optional[int] = Field(default=None, primary_key=True)
+    revisado_hasta: datetime
+    company_id: int = Field(foreign_key="company.id", unique=True)
+
+class UsoEmpresa(SQLModel, table=True):
+    """Consumo de cada empresa por hora, para las cuotas (ver app/cuotas.py)"""
+    __table_args__ = (
+        Index("uq_usoempresa_company_recurso_hora", "company_id", "recurso", "hora", unique=True),
+    )
+
+    id: Optional[int] = Field(default=None, primary_key=True)
+    hora: datetime  # inicio de la hora
+    recurso: str  # 'filas_exportadas' | 'filas_importadas'
+    cantidad: int = 0
+    company_id: int = Field(foreign_key="company.id")
+
+class CambioParte(SQLModel, table=True):
+    """Registro de cambios de partes para la sincronización incremental"""
+    __table_args__ = (
+        # seq es una secuencia monótona por usuario: dos escrituras simultáneas
+        # del mismo usuario no pueden confirmarse con números desordenados
+        Index("uq_cambioparte_user_seq", "user_id", "seq", unique=True),
+        # Borrados por empresa para la lectura incremental de la integración
+        Index("ix_cambioparte_company_fecha", "company_id", "fecha", "id"),
+    )
+
+    id: Optional[int] = Field(default=None, primary_key=True)
+    seq: int
+    accion: str  # 'creado' | 'actualizado' | 'eliminado' | 'archivado' (ver app/archivo.py)
+    parte_id: int  # sin foreign key: el parte puede haberse borrado
+    client_id: Optional[str] = None
+    fecha: datetime = Field(default_factory=datetime.now)
+    user_id: int = Field(foreign_key="user.id")
+    company_id: int = Field(foreign_key="company.id")
+
+class ClaveIdempotencia(SQLModel, table=True):
+    """Operaciones de sincronización ya aplicadas, para no duplicarlas en reintentos"""
+    __table_args__ = (
+        Index("uq_claveidempotencia_user_clave", "user_id", "clave", unique=True),
+    )
+
+    id: Optional[int] = Field(default=None, primary_key=True)
+    clave: str
+    resultado: str  # JSON con la respuesta que se dio la primera vez
+    fecha: datetime = Field(default_factory=datetime.now)
+    user_id: int = Field(foreign_key="user.id")
+
+class TokenApi(SQLModel, table=True):
+    """Token de acceso para integraciones (ERP, nóminas). Solo se guarda su hash."""
+    id: Optional[int] = Field(default=None, primary_key=True)
+    nombre: str
+    token_hash: str = Field(index=True, unique=True)
+    revocado: bool = False
+    fecha_creacion: datetime = Field(default_factory=datetime.now)
+    ultimo_uso: Optional[datetime] = None
+    creado_por: Optional[int] = Field(default=None, foreign_key="user.id")
+    company_id: int = Field(foreign_key="company.id")
+
 class Ruta(SQLModel, table=True):
     id: Optional[int] = Field(default=None, primary_key=True)
     parte_dia_id: int = Field(foreign_key="partedia.id")
@@ -100,6 +291,15 @@ class Ruta(SQLModel, table=True):
     km_ruta: float = 0.0
     num_envios_ruta: int = 0
     observaciones_ruta: Optional[str] = None
+    
+    salida_hora_norm: Optional[time] = None
+    llegada_hora_norm: Optional[time] = None
+    duracion_minutos: Optional[int] = Field(default=None, index=True)
+
+@event.listens_for(Ruta, "before_insert")
+@event.listens_for(Ruta, "before_update")
+def _actualizar_tiempos_ruta(mapper, connection, ruta: Ruta):
+    normalizar_tiempos(ruta)
 
 class FotoEntrega(SQLModel, table=True):
     id: Optional[int] = Field(default=None, primary_key=True)
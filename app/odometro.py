@@ -0,0 +1,237 @@
+from __future__ import annotations
+import logging, os, threading
+from datetime import date, datetime, timedelta
+from typing import Dict, List, Optional
+import numpy as np
+import pandas as pd
+from sqlalchemy import and_, delete, func, insert, or_, update
+from sqlalchemy.engine import Engine
+from sqlalchemy.exc import IntegrityError
+from sqlmodel import Session, select
+from .models import AnomaliaParte, CambioParte, Company, ParteDia, RevisionOdometro
+
+# Revisión nocturna de los cuentakilómetros.
+#
+# Por repartidor y en orden de fecha se comprueba que cada parte empieza donde
+# acabó el anterior y que sus kilómetros cuadran:
+#   hueco      km_salida mayor que la llegada del parte anterior
+#   solape     km_salida menor que la llegada del parte anterior
+#   negativo   km_llegada menor que km_salida
+#   descuadre  km_diferencia distinto de km_llegada - km_salida
+#   atipico_*  km o gasolina muy por encima de lo habitual del repartidor
+#              (más de FACTOR_ATIPICO rangos intercuartílicos sobre el tercer
+#              cuartil de sus VENTANA_PARTES partes anteriores)
+#
+# Es incremental: solo se revisan los repartidores con partes escritos (o
+# borrados) desde la última revisión de la empresa, y solo desde el primer día
+# que ha cambiado. Los meses archivados no se revisan (están cerrados).
+
+TOLERANCIA_KM = 1.0
+VENTANA_PARTES = 60
+MINIMO_PARTES = 10
+FACTOR_ATIPICO = 3.0
+# Días anteriores al primer cambio que se cargan para la ventana de los atípicos
+DIAS_HISTORIA = 120
+# Las escrituras de los últimos minutos pueden no estar confirmadas aún
+MARGEN = timedelta(minutes=5)
+INTERVALO_HORAS = float(os.getenv("ODOMETRO_INTERVALO_HORAS", "24"))  # 0 = sin revisión automática
+REPARTIDORES_POR_CONSULTA = 200
+
+log = logging.getLogger(__name__)
+
+def _primer_cambio(db: Session, company_id: int, desde: Optional[datetime], hasta: datetime) -> Dict[int, date]:
+    """Primer día que hay que revisar de cada repartidor con cambios"""
+    q = (
+        select(ParteDia.user_id, func.min(ParteDia.fecha))
+        .where(ParteDia.company_id == company_id, ParteDia.fecha_actualizacion <= hasta)
+        .group_by(ParteDia.user_id)
+    )
+    if desde is not None:
+        q = q.where(ParteDia.fecha_actualizacion > desde)
+    inicio = dict(db.exec(q).all())
+    if desde is not None:
+        # De un parte borrado no se sabe la fecha: se revisa entero el repartidor
+        borrados = db.exec(
+            select(CambioParte.user_id).distinct().where(
+                CambioParte.company_id == company_id,
+                CambioParte.accion == "eliminado",
+                CambioParte.fecha > desde,
+                CambioParte.fecha <= hasta,
+            )
+        ).all()
+        for user_id in borrados:
+            inicio[user_id] = date.min
+    return inicio
+
+def _restar_dias(fecha: date, dias: int) -> date:
+    return fecha - timedelta(days=dias) if fecha > date.min + timedelta(days=dias) else date.min
+
+def _por_repartidor(inicio: Dict[int, date], columna_user, columna_fecha, dias: int = 0):
+    """Condiciones (user_id, fecha >= inicio - dias) en bloques, para no pasar el límite de SQLite"""
+    items = list(inicio.items())
+    for i in range(0, len(items), REPARTIDORES_POR_CONSULTA):
+        yield or_(*[
+            and_(columna_user == user_id, columna_fecha >= _restar_dias(fecha, dias))
+            for user_id, fecha in items[i:i + REPARTIDORES_POR_CONSULTA]
+        ])
+
+def _cargar(db: Session, company_id: int, inicio: Dict[int, date]) -> pd.DataFrame:
+    P = ParteDia
+    columnas = [P.id, P.user_id, P.fecha, P.km_salida, P.km_llegada, P.km_diferencia, P.gasolina]
+    bloques = [
+        pd.read_sql(select(*columnas).where(P.company_id == company_id, condicion), db.connection())
+        for condicion in _por_repartidor(inicio, P.user_id, P.fecha, DIAS_HISTORIA)
+    ]
+    df = pd.concat(bloques, ignore_index=True) if bloques else pd.DataFrame(columns=[c.key for c in columnas])
+    df["fecha"] = pd.to_datetime(df["fecha"], format="ISO8601")
+    return df
+
+def _atipicos(df: pd.DataFrame, columna: str) -> pd.Series:
+    """Límite por encima del cual el valor es atípico para ese repartidor (NaN si
+    no hay historia). df tiene que estar ordenado por repartidor."""
+    # Los días sin km o sin repostaje no dicen nada de lo habitual
+    valores = df[columna].where(df[columna] > 0).to_numpy()
+    # En vez de groupby().rolling() (lento con muchos repartidores) se deja un
+    # hueco de VENTANA_PARTES valores vacíos entre repartidores y se hace una sola
+    # ventana móvil: ninguna ventana llega a los partes de otro repartidor
+    grupo = (df["user_id"] != df["user_id"].shift()).cumsum().to_numpy() - 1
+    posiciones = np.arange(len(df)) + grupo * VENTANA_PARTES
+    serie = np.full(len(df) + (grupo[-1] + 1) * VENTANA_PARTES, np.nan)
+    serie[posiciones] = valores
+    ventana = pd.Series(serie).shift(1).rolling(VENTANA_PARTES, min_periods=MINIMO_PARTES)
+    q1, q2, q3 = (ventana.quantile(q).to_numpy()[posiciones] for q in (0.25, 0.5, 0.75))
+    # Con valores casi constantes el rango intercuartílico es ~0
+    rango = np.maximum(q3 - q1, q2 * 0.1)
+    return pd.Series(q3 + FACTOR_ATIPICO * rango, index=df.index)
+
+def detectar(df: pd.DataFrame) -> pd.DataFrame:
+    """Anomalías (parte_id, user_id, fecha, tipo, valor, esperado) de los partes cargados"""
+    if df.empty:
+        return pd.DataFrame(columns=["parte_id", "user_id", "fecha", "tipo", "valor", "esperado"])
+    df = df.sort_values(["user_id", "fecha", "km_salida", "id"], ignore_index=True)
+    usuario = df["user_id"]
+    con_odometro = (df["km_salida"] > 0) & (df["km_llegada"] > 0)
+    # Llegada del último parte anterior con cuentakilómetros
+    llegada = df["km_llegada"].where(con_odometro)
+    anterior = llegada.groupby(usuario).shift(1).groupby(usuario).ffill()
+    salto = df["km_salida"] - anterior
+    recorrido = df["km_llegada"] - df["km_salida"]
+
+    limite_km = _atipicos(df, "km_diferencia")
+    limite_gasolina = _atipicos(df, "gasolina")
+
+    reglas = [
+        ("hueco", con_odometro & (salto > TOLERANCIA_KM), df["km_salida"], anterior),
+        ("solape", con_odometro & (salto < -TOLERANCIA_KM), df["km_salida"], anterior),
+        ("negativo", con_odometro & (recorrido < 0), df["km_llegada"], df["km_salida"]),
+        ("descuadre", con_odometro & ((df["km_diferencia"] - recorrido).abs() > TOLERANCIA_KM), df["km_diferencia"], recorrido),
+        ("atipico_km", df["km_diferencia"] > limite_km, df["km_diferencia"], limite_km),
+        ("atipico_gasolina", df["gasolina"] > limite_gasolina, df["gasolina"], limite_gasolina),
+    ]
+    return pd.concat([
+        pd.DataFrame({
+            "parte_id": df["id"][marca],
+            "user_id": usuario[marca],
+            "fecha": df["fecha"][marca],
+            "tipo": tipo,
+            "valor": valor[marca],
+            "esperado": esperado[marca].round(2),
+        })
+        for tipo, marca, valor, esperado in reglas
+    ], ignore_index=True)
+
+def revisar_empresa(db: Session, company_id: int, hasta: Optional[datetime] = None) -> Optional[int]:
+    """Revisa los partes escritos desde la última revisión. Devuelve cuántas
+    anomalías hay ahora en lo revisado, o None si otro proceso se ha adelantado."""
+    hasta = hasta or datetime.now() - MARGEN
+    estado = db.exec(select(RevisionOdometro).where(RevisionOdometro.company_id == company_id)).first()
+    desde = estado.revisado_hasta if estado else None
+
+    inicio = _primer_cambio(db, company_id, desde, hasta)
+    anomalias = detectar(_cargar(db, company_id, inicio))
+    if not anomalias.empty:
+        # Los partes anteriores solo se cargan como contexto
+        anomalias = anomalias[anomalias["fecha"].dt.date >= anomalias["user_id"].map(inicio)]
+
+    A = AnomaliaParte
+    for condicion in _por_repartidor(inicio, A.user_id, A.fecha):
+        db.execute(delete(A).where(A.company_id == company_id, condicion))
+    if not anomalias.empty:
+        filas = anomalias.assign(
+            fecha=anomalias["fecha"].dt.date,
+            company_id=company_id,
+            fecha_deteccion=datetime.now(),
+        )
+        filas = filas.astype(object).where(filas.notna(), None).to_dict("records")
+        db.execute(insert(A.__table__), filas)
+
+    # Avanzar la marca solo si nadie la ha movido mientras tanto
+    if estado is None:
+        db.add(RevisionOdometro(company_id=company_id, revisado_hasta=hasta))
+    else:
+        resultado = db.execute(
+            update(RevisionOdometro)
+            .where(RevisionOdometro.id == estado.id, RevisionOdometro.revisado_hasta == desde)
+            .values(revisado_hasta=hasta)
+        )
+        if resultado.rowcount == 0:
+            db.rollback()
+            return None
+    try:
+        db.commit()
+    except IntegrityError:
+        db.rollback()
+        return None
+    return len(anomalias)
+
+def revisar_todas(engine: Engine) -> int:
+    """Revisa todas las empresas. Devuelve el número de anomalías en lo revisado."""
+    total = 0
+    with Session(engine) as db:
+        empresas = db.exec(select(Company.id)).all()
+    for company_id in empresas:
+        with Session(engine) as db:
+            n = revisar_empresa(db, company_id)
+        if n:
+            log.info("Revisión de cuentakilómetros de la empresa %s: %s anomalías", company_id, n)
+            total += n
+    return total
+
+def listar_anomalias(db: Session, company_id: int, desde: date, hasta: date, user_id: Optional[int] = None, tipo: Optional[str] = None) -> List[AnomaliaParte]:
+    q = select(AnomaliaParte).where(
+        AnomaliaParte.company_id == company_id,
+        AnomaliaParte.fecha >= desde,
+        AnomaliaParte.fecha <= hasta,
+    )
+    if user_id:
+        q = q.where(AnomaliaParte.user_id == user_id)
+    if tipo:
+        q = q.where(AnomaliaParte.tipo == tipo)
+    return db.exec(q.order_by(AnomaliaParte.user_id, AnomaliaParte.fecha, AnomaliaParte.tipo)).all()
+
+class RevisorOdometro:
+    """Hilo que revisa los cuentakilómetros cada INTERVALO_HORAS"""
+
+    def __init__(self, engine: Engine):
+        self.engine = engine
+        self._parar = threading.Event()
+        self._hilo: Optional[threading.Thread] = None
+
+    def iniciar(self):
+        if INTERVALO_HORAS <= 0:
+            return
+        self._parar.clear()
+        self._hilo = threading.Thread(target=self._bucle, name="revisor-odometro", daemon=True)
+        self._hilo.start()
+
+    def parar(self):
+        self._parar.set()
+        if self._hilo is not None:
+            self._hilo.join(timeout=5)
+
+    def _bucle(self):
+        while not self._parar.wait(INTERVALO_HORAS * 3600):
+            try:
+                revisar_todas(self.engine)
+            except Exception:
+                log.exception("Error revisando los cuentakilómetros")
@@ -0,0 +1,386 @@
+from __future__ import annotations
+import asyncio, cProfile, functools, json, logging, os, pstats, random, sys, threading, time, tracemalloc, uuid
+from collections import Counter
+from datetime import datetime
+from pathlib import Path
+from typing import List, Optional, Tuple
+from urllib.parse import parse_qs
+from contextvars import ContextVar
+from fastapi.routing import APIRoute
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlmodel import Session, select
+from starlette.concurrency import run_in_threadpool
+from .models import User
+from .auth import SESSION_KEY
+from .admision import empresa_de
+
+# Perfilado de peticiones en producción, para los operadores.
+#
+# Se captura una petición si:
+#   - la hace un operador con ?perfilar=cprofile|muestreo (y &memoria=1), o
+#   - la elige el muestreo configurado en /operador/perfilado: un porcentaje de
+#     las peticiones de una ruta (prefijo), opcionalmente de una sola empresa,
+#     hasta un número máximo de capturas.
+#
+# Modos: 'cprofile' (determinista, se guarda el .prof de pstats) o 'muestreo'
+# (un hilo lee la pila cada INTERVALO_MUESTREO y se guardan las pilas plegadas
+# para un flamegraph). Los dos perfilan la función de la ruta en el hilo donde
+# se ejecuta (RutaPerfilable); lo que se genera después en streaming no entra.
+# Además se guardan las consultas SQL con su duración y, con memoria=1, el pico
+# de memoria de tracemalloc (de todo el proceso durante la petición).
+#
+# Las capturas van a PERFILES_DIR (compartido por los workers de la máquina,
+# como la configuración del muestreo) y se borran las más antiguas a partir de
+# PERFILES_MAX. Cada worker hace como mucho una captura a la vez.
+
+DIRECTORIO = Path(os.getenv("PERFILES_DIR", str(Path(__file__).parent.parent / "perfiles")))
+MAX_CAPTURAS = int(os.getenv("PERFILES_MAX", "100"))
+INTERVALO_MUESTREO = 0.005
+MAX_SQL = 2000
+LONGITUD_SQL = 2000
+PROFUNDIDAD_PILA = 150
+
+MODOS = ("cprofile", "muestreo")
+_CONFIG = "muestreo.json"
+
+log = logging.getLogger(__name__)
+
+class Captura:
+    def __init__(self, modo: str, memoria: bool, metodo: str, ruta: str, consulta: str, motivo: str):
+        self.id = datetime.now().strftime("%Y%m%d-%H%M%S-%f-") + uuid.uuid4().hex[:6]
+        self.modo = modo
+        self.memoria = memoria
+        self.datos = {
+            "id": self.id,
+            "modo": modo,
+            "motivo": motivo,  # 'operador' | 'muestreo'
+            "metodo": metodo,
+            "ruta": ruta,
+            "consulta": consulta,
+            "fecha": datetime.now().isoformat(timespec="seconds"),
+            "pid": os.getpid(),
+        }
+        self.sql: List[dict] = []
+        self.perfil: Optional[cProfile.Profile] = None
+        self.pilas: Counter = Counter()
+        self.hilos: set = set()
+        self._parar = threading.Event()
+        self._muestreador: Optional[threading.Thread] = None
+        self._inicio = 0.0
+        self._tracemalloc_propio = False
+
+    # -- Ciclo de vida (en el middleware)
+
+    def empezar(self):
+        if self.memoria:
+            self._tracemalloc_propio = not tracemalloc.is_tracing()
+            if self._tracemalloc_propio:
+                tracemalloc.start()
+            else:
+                tracemalloc.reset_peak()
+        if self.modo == "muestreo":
+            self._muestreador = threading.Thread(target=self._muestrear, name="perfilado", daemon=True)
+            self._muestreador.start()
+        self._inicio = time.perf_counter()
+
+    def terminar(self, estado: Optional[int]):
+        self.datos["duracion_ms"] = round((time.perf_counter() - self._inicio) * 1000, 1)
+        self.datos["estado"] = estado
+        self._parar.set()
+        if self._muestreador is not None:
+            self._muestreador.join(timeout=1)
+        if self.memoria:
+            actual, pico = tracemalloc.get_traced_memory()
+            instantanea = tracemalloc.take_snapshot()
+            if self._tracemalloc_propio:
+                tracemalloc.stop()
+            self.datos["memoria"] = {
+                "pico_kb": round(pico / 1024, 1),
+                "final_kb": round(actual / 1024, 1),
+                "lineas": [
+                    {"linea": str(e.traceback), "kb": round(e.size / 1024, 1), "bloques": e.count}
+                    for e in instantanea.statistics("lineno")[:20]
+                ],
+            }
+
+    # -- Función de la ruta (en su hilo)
+
+    def ejecutar(self, funcion, args, kwargs):
+        self.hilos.add(threading.get_ident())
+        try:
+            if self.modo == "cprofile":
+                self.perfil = self.perfil or cProfile.Profile()
+                return self.perfil.runcall(funcion, *args, **kwargs)
+            return funcion(*args, **kwargs)
+        finally:
+            self.hilos.discard(threading.get_ident())
+
+    def _muestrear(self):
+        while not self._parar.wait(INTERVALO_MUESTREO):
+            marcos = sys._current_frames()
+            for hilo in list(self.hilos):
+                marco = marcos.get(hilo)
+                if marco is not None:
+                    self.pilas[_pila(marco)] += 1
+
+    # -- SQL
+
+    def anotar_sql(self, sentencia: str, segundos: float, filas: int):
+        if len(self.sql) < MAX_SQL:
+            # rowcount es -1 en los SELECT de algunos drivers
+            self.sql.append({"sql": sentencia[:LONGITUD_SQL], "ms": round(segundos * 1000, 2), "filas": filas if filas >= 0 else None})
+
+    # -- Guardar
+
+    def guardar(self):
+        DIRECTORIO.mkdir(parents=True, exist_ok=True)
+        self.datos["sql_total"] = len(self.sql)
+        self.datos["sql_ms"] = round(sum(s["ms"] for s in self.sql), 1)
+        self.datos["sql"] = sorted(self.sql, key=lambda s: -s["ms"])
+        if self.perfil is not None:
+            self.perfil.dump_stats(DIRECTORIO / f"{self.id}.prof")
+            self.datos["fichero"] = f"{self.id}.prof"
+            self.datos["funciones"] = _funciones(self.perfil)
+        elif self.pilas:
+            with open(DIRECTORIO / f"{self.id}.folded", "w") as f:
+                for pila, n in self.pilas.most_common():
+                    f.write(f"{pila} {n}\n")
+            self.datos["fichero"] = f"{self.id}.folded"
+            self.datos["muestras"] = sum(self.pilas.values())
+        temporal = DIRECTORIO / f"{self.id}.json.tmp"
+        temporal.write_text(json.dumps(self.datos, ensure_ascii=False, default=str))
+        os.replace(temporal, DIRECTORIO / f"{self.id}.json")
+        _recortar()
+
+def _pila(marco) -> str:
+    """Pila plegada (de la raíz a la hoja) para flamegraph.pl / speedscope"""
+    partes = []
+    while marco is not None and len(partes) < PROFUNDIDAD_PILA:
+        codigo = marco.f_code
+        partes.append(f"{Path(codigo.co_filename).stem}:{codigo.co_name}")
+        marco = marco.f_back
+    return ";".join(reversed(partes))
+
+def _funciones(perfil: cProfile.Profile, n: int = 30) -> List[dict]:
+    estadisticas = pstats.Stats(perfil).stats
+    mejores = sorted(estadisticas.items(), key=lambda kv: -kv[1][3])[:n]
+    return [
+        {"funcion": f"{Path(fichero).name}:{linea}({nombre})", "llamadas": nc, "propio_ms": round(tt * 1000, 2), "acumulado_ms": round(ct * 1000, 2)}
+        for (fichero, linea, nombre), (cc, nc, tt, ct, _) in mejores
+    ]
+
+def _capturas() -> List[Path]:
+    """Ficheros .json de las capturas, de la más antigua a la más reciente"""
+    return sorted(f for f in DIRECTORIO.glob("*.json") if f.name != _CONFIG)
+
+def _recortar():
+    capturas = _capturas()
+    for viejo in capturas[:max(len(capturas) - MAX_CAPTURAS, 0)]:
+        for fichero in DIRECTORIO.glob(f"{viejo.stem}.*"):
+            fichero.unlink(missing_ok=True)
+
+_actual: ContextVar[Optional[Captura]] = ContextVar("captura", default=None)
+_ocupado = threading.Lock()  # una captura a la vez por worker
+
+# ---------------------------------------------------------------------------
+# Consultas de las capturas
+
+def listar() -> List[dict]:
+    resumen = ("id", "modo", "motivo", "metodo", "ruta", "consulta", "fecha", "estado", "duracion_ms", "sql_total", "sql_ms", "fichero")
+    capturas = []
+    for fichero in reversed(_capturas()):
+        try:
+            datos = json.loads(fichero.read_text())
+        except (OSError, ValueError):
+            continue
+        capturas.append({k: datos.get(k) for k in resumen})
+    return capturas
+
+def _valido(id_: str) -> bool:
+    return bool(id_) and all(c.isalnum() or c == "-" for c in id_)
+
+def leer(id_: str) -> Optional[dict]:
+    fichero = DIRECTORIO / f"{id_}.json"
+    if not _valido(id_) or not fichero.exists():
+        return None
+    return json.loads(fichero.read_text())
+
+def fichero_perfil(id_: str) -> Optional[Path]:
+    datos = leer(id_)
+    if not datos or not datos.get("fichero"):
+        return None
+    return DIRECTORIO / datos["fichero"]
+
+# ---------------------------------------------------------------------------
+# Configuración del muestreo (fichero compartido por los workers)
+
+_config_cache: Tuple[float, dict] = (0.0, {})
+
+def config_muestreo() -> dict:
+    global _config_cache
+    fichero = DIRECTORIO / _CONFIG
+    try:
+        mtime = fichero.stat().st_mtime
+    except OSError:
+        return {}
+    if mtime != _config_cache[0]:
+        try:
+            _config_cache = (mtime, json.loads(fichero.read_text()))
+        except ValueError:
+            return {}
+    return _config_cache[1]
+
+def guardar_config_muestreo(config: dict):
+    DIRECTORIO.mkdir(parents=True, exist_ok=True)
+    temporal = DIRECTORIO / f"{_CONFIG}.tmp"
+    temporal.write_text(json.dumps(config))
+    os.replace(temporal, DIRECTORIO / _CONFIG)
+
+def validar_config(datos: dict) -> dict:
+    """Configuración del muestreo a partir del JSON del operador. Lanza ValueError."""
+    porcentaje = float(datos.get("porcentaje", 0))
+    if not 0 <= porcentaje <= 100:
+        raise ValueError("El porcentaje debe estar entre 0 y 100")
+    modo = datos.get("modo", "muestreo")
+    if modo not in MODOS:
+        raise ValueError(f"Modo desconocido: {modo!r}")
+    ruta = str(datos.get("ruta") or "/")
+    if not ruta.startswith("/"):
+        raise ValueError("La ruta tiene que empezar por /")
+    company_id = datos.get("company_id")
+    return {
+        "porcentaje": porcentaje,
+        "modo": modo,
+        "ruta": ruta,
+        "company_id": int(company_id) if company_id not in (None, "") else None,
+        "memoria": bool(datos.get("memoria", False)),
+        "capturas": max(int(datos.get("capturas", 20)), 0),  # como mucho, entre todos los workers
+        "desde": datetime.now().isoformat(timespec="microseconds"),
+    }
+
+def _capturas_desde(desde: str) -> int:
+    """Capturas del muestreo hechas con la configuración actual"""
+    # Los ids empiezan por la fecha: 20260101-093000-123456-...
+    prefijo = datetime.fromisoformat(desde).strftime("%Y%m%d-%H%M%S-%f")
+    n = 0
+    for fichero in _capturas():
+        if fichero.stem < prefijo:
+            continue
+        try:
+            n += json.loads(fichero.read_text()).get("motivo") == "muestreo"
+        except (OSError, ValueError):
+            pass
+    return n
+
+# ---------------------------------------------------------------------------
+# Rutas y motores
+
+def envolver(funcion):
+    @functools.wraps(funcion)
+    def llamada(*args, **kwargs):
+        captura = _actual.get()
+        if captura is None:
+            return funcion(*args, **kwargs)
+        return captura.ejecutar(funcion, args, kwargs)
+    return llamada
+
+class RutaPerfilable(APIRoute):
+    """Las rutas síncronas se perfilan en el hilo del pool donde se ejecutan"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        if not asyncio.iscoroutinefunction(self.dependant.call):
+            self.dependant.call = envolver(self.dependant.call)
+
+def instalar(engine: Engine):
+    """Anota en la captura en curso las consultas del motor y su duración"""
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def _antes(conn, cursor, sentencia, parametros, contexto, executemany):
+        if _actual.get() is not None:
+            conn.info.setdefault("perfilado_inicio", []).append(time.perf_counter())
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def _despues(conn, cursor, sentencia, parametros, contexto, executemany):
+        captura = _actual.get()
+        inicios = conn.info.get("perfilado_inicio")
+        if captura is not None and inicios:
+            captura.anotar_sql(sentencia, time.perf_counter() - inicios.pop(), cursor.rowcount)
+
+# ---------------------------------------------------------------------------
+# Middleware
+
+_motor: Optional[Engine] = None
+
+def conectar(engine: Engine):
+    global _motor
+    _motor = engine
+
+def _buscar_operador(user_id: int) -> bool:
+    with Session(_motor) as db:
+        return bool(db.exec(select(User.es_operador).where(User.id == user_id)).first())
+
+async def _es_operador(scope) -> bool:
+    # Sin caché: solo se consulta en las peticiones con ?perfilar= y así
+    # quitar el permiso tiene efecto enseguida
+    user_id = (scope.get("session") or {}).get(SESSION_KEY)
+    if not user_id or _motor is None:
+        return False
+    return await run_in_threadpool(_buscar_operador, user_id)
+
+class Perfilador:
+    """Middleware ASGI: decide si la petición se captura y guarda el resultado"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def _elegir(self, scope) -> Optional[Captura]:
+        consulta = scope.get("query_string", b"").decode("latin-1")
+        datos = dict(metodo=scope["method"], ruta=scope["path"], consulta=consulta)
+        if b"perfilar=" in scope.get("query_string", b""):
+            params = parse_qs(consulta)
+            modo = params.get("perfilar", [""])[0]
+            if modo in MODOS and await _es_operador(scope):
+                return Captura(modo, params.get("memoria", [""])[0] == "1", motivo="operador", **datos)
+        config = config_muestreo()
+        if not config.get("porcentaje") or not scope["path"].startswith(config["ruta"]):
+            return None
+        if random.random() * 100 >= config["porcentaje"]:
+            return None
+        if config.get("company_id") is not None and await empresa_de(scope) != config["company_id"]:
+            return None
+        if _capturas_desde(config["desde"]) >= config["capturas"]:
+            return None
+        return Captura(config["modo"], config["memoria"], motivo="muestreo", **datos)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"].startswith(("/static/", "/operador/perfil")):
+            await self.app(scope, receive, send)
+            return
+        captura = await self._elegir(scope)
+        if captura is None or not _ocupado.acquire(blocking=False):
+            await self.app(scope, receive, send)
+            return
+
+        estado = None
+
+        async def enviar(mensaje):
+            nonlocal estado
+            if mensaje["type"] == "http.response.start":
+                estado = mensaje["status"]
+            await send(mensaje)
+
+        token = _actual.set(captura)
+        try:
+            captura.empezar()
+            await self.app(scope, receive, enviar)
+        finally:
+            _actual.reset(token)
+            try:
+                captura.terminar(estado)
+                await run_in_threadpool(captura.guardar)
+            except Exception:
+                log.exception("No se pudo guardar la captura de perfilado")
+            finally:
+                _ocupado.release()
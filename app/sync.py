@@ -0,0 +1,313 @@
+from __future__ import annotations
+import base64, json
+from datetime import date
+from typing import List, Optional, Tuple
+from sqlalchemy import delete, func
+from sqlmodel import Session, select
+from .models import CambioParte, ClaveIdempotencia, ParteDia, Ruta, User
+from .eventos import al_cambiar_parte, parte_cambiado
+from .cierre import MesCerrado, comprobar_mes_abierto
+from .concurrencia import ParteModificado, comprobar_version, leer_version
+from .tiempos import parse_hora, parse_duracion, formatear_hora, formatear_duracion
+
+# Sincronización offline de la app del repartidor.
+#
+# push: el cliente envía un lote de operaciones ('guardar' / 'eliminar'), cada una
+#       con una clave de idempotencia generada en el cliente. El lote se aplica en
+#       una sola transacción y las claves repetidas devuelven el resultado original.
+# pull: el cliente pide los cambios posteriores a un cursor opaco, que codifica la
+#       secuencia de cambios del usuario (CambioParte.seq).
+
+CAMPOS_FLOAT = (
+    "km_salida", "km_llegada", "km_diferencia", "km_recorridos",
+    "dietas", "alojamiento", "transporte_billetes", "gasolina", "comida",
+    "otros_consumiciones", "material", "otros_gastos", "horas",
+)
+CAMPOS_INT = ("num_envios",)
+CAMPOS_TEXTO = ("repostaje", "num_factura", "salida_lugar", "llegada_lugar", "observaciones")
+CAMPOS_RUTA_TEXTO = ("descripcion", "salida_lugar", "llegada_lugar", "observaciones_ruta")
+
+LIMITE_CAMBIOS = 500
+
+class ErrorSync(ValueError):
+    """Operación del lote que no se puede aplicar (se informa en su resultado)"""
+
+class ConflictoSync(ErrorSync):
+    """El parte ha cambiado en el servidor desde la versión que editó el cliente"""
+
+    def __init__(self, parte: ParteDia):
+        super().__init__("El parte se ha modificado en el servidor")
+        self.parte = parte
+
+# ---------------------------------------------------------------------------
+# Registro de cambios
+
+@al_cambiar_parte
+def registrar_cambio(db: Session, parte: ParteDia, accion: str):
+    """Anota el cambio con la siguiente secuencia del usuario"""
+    ultimo = db.exec(select(func.max(CambioParte.seq)).where(CambioParte.user_id == parte.user_id)).one()
+    db.add(CambioParte(
+        seq=(ultimo or 0) + 1,
+        accion=accion,
+        parte_id=parte.id,
+        client_id=parte.client_id,
+        user_id=parte.user_id,
+        company_id=parte.company_id,
+    ))
+
+def codificar_cursor(seq: int) -> str:
+    return base64.urlsafe_b64encode(json.dumps({"s": seq}).encode()).decode().rstrip("=")
+
+def decodificar_cursor(cursor: Optional[str]) -> int:
+    if not cursor:
+        return 0
+    try:
+        relleno = "=" * (-len(cursor) % 4)
+        return int(json.loads(base64.urlsafe_b64decode(cursor + relleno))["s"])
+    except Exception:
+        raise ErrorSync("Cursor inválido")
+
+# ---------------------------------------------------------------------------
+# Serialización
+
+def _ruta_dict(r: Ruta) -> dict:
+    return {
+        "orden": r.orden,
+        "descripcion": r.descripcion,
+        "salida_lugar": r.salida_lugar,
+        "salida_hora": r.salida_hora,
+        "llegada_lugar": r.llegada_lugar,
+        "llegada_hora": r.llegada_hora,
+        "km_ruta": r.km_ruta,
+        "num_envios_ruta": r.num_envios_ruta,
+        "observaciones_ruta": r.observaciones_ruta,
+    }
+
+def parte_dict(p: ParteDia, rutas: List[Ruta]) -> dict:
+    datos = {
+        "id": p.id,
+        "client_id": p.client_id,
+        "fecha": p.fecha.isoformat(),
+        "salida_hora": p.salida_hora,
+        "llegada_hora": p.llegada_hora,
+        "tiempo_total": p.tiempo_total,
+        "duracion_minutos": p.duracion_minutos,
+        "total_gastos": p.total_gastos,
+        "version": p.version,
+    }
+    for campo in CAMPOS_FLOAT + CAMPOS_INT + CAMPOS_TEXTO:
+        datos[campo] = getattr(p, campo)
+    datos["rutas"] = [_ruta_dict(r) for r in rutas]
+    return datos
+
+# ---------------------------------------------------------------------------
+# push
+
+def _validar_datos(datos: dict) -> dict:
+    """Comprueba y normaliza los campos de un parte. Lanza ErrorSync si algo no es válido."""
+    limpio = {}
+    try:
+        for campo in CAMPOS_FLOAT:
+            if campo in datos:
+                limpio[campo] = float(datos[campo] or 0)
+        for campo in CAMPOS_INT:
+            if campo in datos:
+                limpio[campo] = int(datos[campo] or 0)
+        for campo in CAMPOS_TEXTO:
+            if campo in datos:
+                limpio[campo] = (datos[campo] or "").strip() or None
+        for campo in ("salida_hora", "llegada_hora"):
+            if campo in datos:
+                limpio[campo] = formatear_hora(parse_hora(datos[campo]))
+        if "tiempo_total" in datos:
+            limpio["tiempo_total"] = formatear_duracion(parse_duracion(datos["tiempo_total"]))
+
+        if "rutas" in datos:
+            rutas = []
+            for i, r in enumerate(datos["rutas"] or [], start=1):
+                ruta = {campo: (r.get(campo) or "").strip() or None for campo in CAMPOS_RUTA_TEXTO}
+                ruta["orden"] = int(r.get("orden") or i)
+                ruta["salida_hora"] = formatear_hora(parse_hora(r.get("salida_hora")))
+                ruta["llegada_hora"] = formatear_hora(parse_hora(r.get("llegada_hora")))
+                ruta["km_ruta"] = float(r.get("km_ruta") or 0)
+                ruta["num_envios_ruta"] = int(r.get("num_envios_ruta") or 0)
+                rutas.append(ruta)
+            limpio["rutas"] = rutas
+    except (TypeError, ValueError, AttributeError) as e:
+        raise ErrorSync(str(e))
+    return limpio
+
+def _validar_operacion(op: dict):
+    """Forma de la operación (lo que no se comprueba campo a campo al aplicarla)"""
+    if op.get("id") not in (None, ""):
+        try:
+            int(op["id"])
+        except (TypeError, ValueError):
+            raise ErrorSync(f"id inválido: {op['id']!r}")
+    if not isinstance(op.get("client_id"), (str, type(None))):
+        raise ErrorSync("client_id debe ser un texto")
+    if not isinstance(op.get("parte"), (dict, type(None))):
+        raise ErrorSync("parte debe ser un objeto")
+    rutas = (op.get("parte") or {}).get("rutas")
+    if rutas is not None and not (isinstance(rutas, list) and all(isinstance(r, dict) for r in rutas)):
+        raise ErrorSync("rutas debe ser una lista de objetos")
+
+def _buscar_parte(db: Session, user: User, op: dict) -> Optional[ParteDia]:
+    if op.get("id"):
+        parte = db.get(ParteDia, int(op["id"]))
+        if parte and parte.user_id != user.id:
+            raise ErrorSync("El parte no te pertenece")
+        return parte
+    if op.get("client_id"):
+        return db.exec(
+            select(ParteDia).where(ParteDia.user_id == user.id, ParteDia.client_id == op["client_id"])
+        ).first()
+    return None
+
+def _comprobar_version(parte: ParteDia, op: dict):
+    """Si la operación trae la versión que editó el cliente, tiene que ser la actual"""
+    try:
+        comprobar_version(parte, leer_version(op.get("version")))
+    except ParteModificado:
+        raise ConflictoSync(parte)
+    except ValueError as e:
+        raise ErrorSync(str(e))
+
+def _aplicar_operacion(db: Session, user: User, op: dict) -> dict:
+    """Valida primero y escribe después, para que un error no deje la operación a medias"""
+    tipo = op.get("tipo")
+    _validar_operacion(op)
+    parte = _buscar_parte(db, user, op)
+
+    if tipo == "eliminar":
+        if parte is None:
+            # Ya estaba borrado: la operación es idempotente
+            return {"id": op.get("id"), "client_id": op.get("client_id")}
+        comprobar_mes_abierto(db, parte.company_id, parte.fecha)
+        _comprobar_version(parte, op)
+        resultado = {"id": parte.id, "client_id": parte.client_id}
+        parte_cambiado(db, parte, "eliminado")
+        db.exec(delete(Ruta).where(Ruta.parte_dia_id == parte.id))
+        db.delete(parte)
+        return resultado
+
+    if tipo != "guardar":
+        raise ErrorSync(f"Tipo de operación desconocido: {tipo!r}")
+
+    datos = _validar_datos(op.get("parte") or {})
+    rutas = datos.pop("rutas", None)
+
+    if parte is None:
+        try:
+            fecha = date.fromisoformat((op.get("parte") or {}).get("fecha") or "")
+        except ValueError:
+            raise ErrorSync("Fecha inválida. Use YYYY-MM-DD")
+        comprobar_mes_abierto(db, user.company_id, fecha)
+        parte = ParteDia(
+            fecha=fecha,
+            client_id=op.get("client_id"),
+            user_id=user.id,
+            company_id=user.company_id,
+            **datos,
+        )
+        db.add(parte)
+        db.flush()
+        accion = "creado"
+    else:
+        comprobar_mes_abierto(db, parte.company_id, parte.fecha)
+        _comprobar_version(parte, op)
+        for campo, valor in datos.items():
+            setattr(parte, campo, valor)
+        accion = "actualizado"
+
+    if rutas is not None:
+        db.exec(delete(Ruta).where(Ruta.parte_dia_id == parte.id))
+        for ruta in rutas:
+            db.add(Ruta(parte_dia_id=parte.id, **ruta))
+    db.flush()
+    parte_cambiado(db, parte, accion)
+    db.flush()  # la versión que se devuelve es la que queda escrita
+    return {"id": parte.id, "client_id": parte.client_id, "version": parte.version}
+
+def aplicar_lote(db: Session, user: User, operaciones: List[dict]) -> List[dict]:
+    """Aplica un lote de operaciones. No hace commit: el lote entero va en una transacción."""
+    claves = [op["clave"] for op in operaciones if isinstance(op, dict) and isinstance(op.get("clave"), str) and op["clave"]]
+    previas = {}
+    if claves:
+        previas = {
+            c.clave: json.loads(c.resultado)
+            for c in db.exec(
+                select(ClaveIdempotencia).where(
+                    ClaveIdempotencia.user_id == user.id,
+                    ClaveIdempotencia.clave.in_(claves),
+                )
+            ).all()
+        }
+
+    resultados = []
+    for op in operaciones:
+        if not isinstance(op, dict):
+            resultados.append({"clave": None, "estado": "error", "error": "La operación debe ser un objeto"})
+            continue
+        clave = op.get("clave")
+        if not clave or not isinstance(clave, str):
+            resultados.append({"clave": None, "estado": "error", "error": "Falta la clave de idempotencia"})
+            continue
+        if clave in previas:
+            resultados.append({**previas[clave], "estado": "repetido"})
+            continue
+        try:
+            resultado = {"clave": clave, **_aplicar_operacion(db, user, op)}
+        except ConflictoSync as e:
+            # No se guarda la clave: el cliente combina y reenvía con la versión actual
+            rutas = db.exec(select(Ruta).where(Ruta.parte_dia_id == e.parte.id).order_by(Ruta.orden)).all()
+            resultados.append({"clave": clave, "estado": "conflicto", "error": str(e), "parte": parte_dict(e.parte, rutas)})
+            continue
+        except (ErrorSync, MesCerrado) as e:
+            resultados.append({"clave": clave, "estado": "error", "error": str(e)})
+            continue
+        db.add(ClaveIdempotencia(clave=clave, resultado=json.dumps(resultado), user_id=user.id))
+        previas[clave] = resultado
+        resultados.append({**resultado, "estado": "aplicado"})
+    return resultados
+
+# ---------------------------------------------------------------------------
+# pull
+
+def cambios_desde(db: Session, user_id: int, cursor: Optional[str], limite: int = LIMITE_CAMBIOS) -> Tuple[List[dict], str, bool]:
+    """Cambios del usuario posteriores al cursor: (cambios, nuevo_cursor, hay_mas)"""
+    desde = decodificar_cursor(cursor)
+    filas = db.exec(
+        select(CambioParte)
+        .where(CambioParte.user_id == user_id, CambioParte.seq > desde)
+        .order_by(CambioParte.seq)
+        .limit(limite + 1)
+    ).all()
+    hay_mas = len(filas) > limite
+    filas = filas[:limite]
+    if not filas:
+        return [], codificar_cursor(desde), False
+
+    # Solo interesa el último cambio de cada parte dentro de la página
+    ultimos = {}
+    for c in filas:
+        ultimos.pop(c.parte_id, None)
+        ultimos[c.parte_id] = c
+
+    # Los partes archivados (ver app/archivo.py) salen de la sincronización como borrados
+    vivos = [pid for pid, c in ultimos.items() if c.accion not in ("eliminado", "archivado")]
+    partes = {}
+    rutas = {}
+    if vivos:
+        partes = {p.id: p for p in db.exec(select(ParteDia).where(ParteDia.id.in_(vivos))).all()}
+        for r in db.exec(select(Ruta).where(Ruta.parte_dia_id.in_(vivos)).order_by(Ruta.orden)).all():
+            rutas.setdefault(r.parte_dia_id, []).append(r)
+
+    cambios = []
+    for pid, c in ultimos.items():
+        if c.accion in ("eliminado", "archivado"):
+            cambios.append({"seq": c.seq, "accion": "eliminado", "id": pid, "client_id": c.client_id})
+        elif pid in partes:
+            cambios.append({"seq": c.seq, "accion": c.accion, "parte": parte_dict(partes[pid], rutas.get(pid, []))})
+        # Si el parte ya no existe, su borrado llegará en una página posterior
+    return cambios, codificar_cursor(filas[-1].seq), hay_mas
@@ -0,0 +1,141 @@
+from __future__ import annotations
+import math, re
+from datetime import date, time
+from typing import List, Optional
+from sqlmodel import Session, text
+
+# Formatos de hora aceptados: "8:05", "08:05:30", "8.05", "8h05", "8h", "0805"
+_HORA_RE = re.compile(r"^(\d{1,2})(?:\s*[:.hH]\s*(\d{2})?)?(?:[:.](\d{2}))?\s*h?$")
+_HORA_COMPACTA_RE = re.compile(r"^(\d{1,2})(\d{2})$")
+# Duraciones: "2:30", "2h30", "2h 30m", "2h", "150min", "45 m", "2.5" / "2,5" (horas)
+_DURACION_HM_RE = re.compile(r"^(?:(\d+)\s*h(?:oras?)?)?\s*(?:(\d+)\s*(?:m(?:in(?:utos)?)?)?)?$", re.IGNORECASE)
+_DURACION_RELOJ_RE = re.compile(r"^(\d+):(\d{2})(?::\d{2})?$")
+
+def parse_hora(valor: Optional[str]) -> Optional[time]:
+    """Convierte una hora escrita a mano en time. Vacío -> None, inválida -> ValueError"""
+    valor = (valor or "").strip()
+    if not valor:
+        return None
+    m = _HORA_COMPACTA_RE.match(valor) or _HORA_RE.match(valor)
+    if not m:
+        raise ValueError(f"Hora inválida: '{valor}'. Use HH:MM")
+    horas = int(m.group(1))
+    minutos = int(m.group(2) or 0)
+    segundos = int(m.group(3) or 0) if m.re is _HORA_RE else 0
+    if horas > 23 or minutos > 59 or segundos > 59:
+        raise ValueError(f"Hora inválida: '{valor}'. Use HH:MM")
+    return time(horas, minutos, segundos)
+
+def parse_duracion(valor: Optional[str]) -> Optional[int]:
+    """Convierte un tiempo total escrito a mano en minutos. Vacío -> None, inválido -> ValueError"""
+    valor = (valor or "").strip()
+    if not valor:
+        return None
+    m = _DURACION_RELOJ_RE.match(valor)
+    if m:
+        return int(m.group(1)) * 60 + int(m.group(2))
+    try:
+        # Número suelto: horas con decimales
+        horas = float(valor.replace(",", "."))
+    except ValueError:
+        horas = None
+    if horas is not None:
+        # float() también acepta "inf", "nan" y negativos
+        if not math.isfinite(horas) or horas < 0:
+            raise ValueError(f"Tiempo total inválido: '{valor}'. Use un número de horas mayor o igual que 0")
+        return round(horas * 60)
+    m = _DURACION_HM_RE.match(valor)
+    if m and (m.group(1) or m.group(2)):
+        return int(m.group(1) or 0) * 60 + int(m.group(2) or 0)
+    raise ValueError(f"Tiempo total inválido: '{valor}'. Use H:MM o minutos (ej. 150min)")
+
+def minutos_entre(salida: Optional[time], llegada: Optional[time]) -> Optional[int]:
+    """Minutos entre dos horas; si la llegada es anterior se asume que cruza la medianoche"""
+    if salida is None or llegada is None:
+        return None
+    minutos = (llegada.hour * 60 + llegada.minute) - (salida.hour * 60 + salida.minute)
+    if minutos < 0:
+        minutos += 24 * 60
+    return minutos
+
+def formatear_hora(t: Optional[time]) -> Optional[str]:
+    return t.strftime("%H:%M") if t else None
+
+def formatear_duracion(minutos: Optional[int]) -> Optional[str]:
+    if minutos is None:
+        return None
+    return f"{minutos // 60}:{minutos % 60:02d}"
+
+def _intentar(func, valor):
+    try:
+        return func(valor)
+    except ValueError:
+        return None
+
+def normalizar_tiempos(obj, tiempo_total: Optional[str] = None):
+    """Rellena salida/llegada_hora_norm y duracion_minutos a partir de los textos.
+    No falla con datos antiguos mal escritos: lo que no se entiende queda a None."""
+    obj.salida_hora_norm = _intentar(parse_hora, obj.salida_hora)
+    obj.llegada_hora_norm = _intentar(parse_hora, obj.llegada_hora)
+    duracion = _intentar(parse_duracion, tiempo_total)
+    if duracion is None:
+        duracion = minutos_entre(obj.salida_hora_norm, obj.llegada_hora_norm)
+    obj.duracion_minutos = duracion
+
+# Percentil por rango más cercano con funciones ventana (funciona igual en SQLite y PostgreSQL)
+_SQL_DURACIONES_REPARTIDOR = """
+    WITH d AS (
+        SELECT p.user_id, p.duracion_minutos AS minutos,
+               ROW_NUMBER() OVER (PARTITION BY p.user_id ORDER BY p.duracion_minutos) AS n,
+               COUNT(*) OVER (PARTITION BY p.user_id) AS total
+        FROM partedia p
+        WHERE p.company_id = :cid AND p.fecha >= :desde AND p.fecha <= :hasta
+          AND p.duracion_minutos IS NOT NULL
+    )
+    SELECT d.user_id, u.username,
+           COUNT(*) AS partes,
+           SUM(d.minutos) AS total_minutos,
+           AVG(d.minutos) AS media_minutos,
+           MIN(d.minutos) AS min_minutos,
+           MAX(d.minutos) AS max_minutos,
+           MIN(CASE WHEN d.n >= d.total * 0.5 THEN d.minutos END) AS p50_minutos,
+           MIN(CASE WHEN d.n >= d.total * 0.9 THEN d.minutos END) AS p90_minutos
+    FROM d JOIN "user" u ON u.id = d.user_id
+    GROUP BY d.user_id, u.username
+    ORDER BY u.username
+"""
+
+_SQL_DURACIONES_RUTA = """
+    WITH d AS (
+        SELECT COALESCE(r.descripcion, '') AS ruta, r.duracion_minutos AS minutos,
+               ROW_NUMBER() OVER (PARTITION BY COALESCE(r.descripcion, '') ORDER BY r.duracion_minutos) AS n,
+               COUNT(*) OVER (PARTITION BY COALESCE(r.descripcion, '')) AS total
+        FROM ruta r JOIN partedia p ON p.id = r.parte_dia_id
+        WHERE p.company_id = :cid AND p.fecha >= :desde AND p.fecha <= :hasta
+          AND r.duracion_minutos IS NOT NULL
+    )
+    SELECT ruta,
+           COUNT(*) AS viajes,
+           SUM(minutos) AS total_minutos,
+           AVG(minutos) AS media_minutos,
+           MIN(CASE WHEN n >= total * 0.5 THEN minutos END) AS p50_minutos,
+           MIN(CASE WHEN n >= total * 0.9 THEN minutos END) AS p90_minutos
+    FROM d
+    GROUP BY ruta
+    ORDER BY viajes DESC, ruta
+"""
+
+def _filas(db: Session, sql: str, params: dict) -> List[dict]:
+    filas = []
+    for fila in db.exec(text(sql), params=params).mappings():
+        fila = dict(fila)
+        if fila.get("media_minutos") is not None:
+            fila["media_minutos"] = round(float(fila["media_minutos"]), 1)
+        filas.append(fila)
+    return filas
+
+def duraciones_por_repartidor(db: Session, company_id: int, desde: date, hasta: date) -> List[dict]:
+    return _filas(db, _SQL_DURACIONES_REPARTIDOR, {"cid": company_id, "desde": desde, "hasta": hasta})
+
+def duraciones_por_ruta(db: Session, company_id: int, desde: date, hasta: date) -> List[dict]:
+    return _filas(db, _SQL_DURACIONES_RUTA, {"cid": company_id, "desde": desde, "hasta": hasta})
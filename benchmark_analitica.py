@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmark del motor de analítica (/admin/analytics).
+
+Genera N partes sintéticos en memoria (300 repartidores, ~4 años) y mide el
+cálculo vectorizado: percentiles por repartidor, MoM/YoY y medias móviles.
+No incluye la lectura de la base de datos, que depende del motor y del disco.
+
+Uso: python benchmark_analitica.py [num_partes]
+"""
+
+import sys
+import time
+from datetime import date
+from pathlib import Path
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, str(Path(__file__).parent))
+
+from app.analitica import analizar, inicio_carga
+
+def crear_partes(n: int, desde: date, hasta: date) -> pd.DataFrame:
+    rng = np.random.default_rng(0)
+    dias = (pd.Timestamp(hasta) - pd.Timestamp(inicio_carga(desde))).days + 1
+    return pd.DataFrame({
+        "user_id": rng.integers(1, 301, n),
+        "fecha": pd.Timestamp(inicio_carga(desde)) + pd.to_timedelta(rng.integers(0, dias, n), unit="D"),
+        "km": rng.uniform(0, 300, n),
+        "envios": rng.integers(0, 40, n).astype("float64"),
+        "gastos": rng.uniform(0, 120, n),
+    })
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 1_000_000
+    desde, hasta = date(2022, 1, 1), date(2025, 12, 31)
+    df = crear_partes(n, desde, hasta)
+    usernames = {i: f"repartidor{i}" for i in range(1, 301)}
+
+    analizar(df, desde, hasta, usernames)  # calentamiento
+    tiempos = []
+    for _ in range(5):
+        inicio = time.perf_counter()
+        informe = analizar(df, desde, hasta, usernames)
+        tiempos.append(time.perf_counter() - inicio)
+
+    print(f"📊 Analítica de {n} partes ({desde} a {hasta}, mejor de 5)")
+    print(f"  {min(tiempos) * 1000:7.1f} ms   "
+          f"{len(informe['repartidores'])} repartidores, {len(informe['meses'])} meses, {len(informe['dias'])} días")
+
+if __name__ == "__main__":
+    main()
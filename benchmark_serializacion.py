@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmark del coste de serializar partes en la API JSON.
+
+Compara, por parte:
+  1. dict a mano + jsonable_encoder + json.dumps (como respondía /api/parte antes)
+  2. modelo pydantic + json.dumps               (response_model con JSONResponse)
+  3. modelo pydantic + orjson                   (response_model con ORJSONResponse, lo actual)
+
+Uso: python benchmark_serializacion.py [num_partes]
+"""
+
+import json
+import sys
+import timeit
+from datetime import date, timedelta
+from pathlib import Path
+from typing import List
+
+sys.path.insert(0, str(Path(__file__).parent))
+
+from fastapi.encoders import jsonable_encoder
+from pydantic import TypeAdapter
+
+from app.models import ParteDia
+from app.esquemas import ParteDetalle
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+def crear_partes(n: int) -> List[ParteDia]:
+    inicio = date(2025, 1, 1)
+    return [
+        ParteDia(
+            id=i,
+            fecha=inicio + timedelta(days=i % 365),
+            km_salida=1000 + i, km_llegada=1100 + i, km_diferencia=100,
+            salida_lugar="Almacén", salida_hora="08:00",
+            llegada_lugar="Polígono Norte", llegada_hora="17:30", tiempo_total="9:30",
+            observaciones="Entrega sin incidencias" if i % 3 else None,
+            dietas=12.5, gasolina=40.0, comida=9.9,
+            num_envios=25, horas=8.5,
+            user_id=1, company_id=1,
+        )
+        for i in range(n)
+    ]
+
+def dict_a_mano(parte: ParteDia) -> dict:
+    return {
+        "id": parte.id,
+        "fecha": parte.fecha.isoformat(),
+        "km_salida": parte.km_salida or 0,
+        "km_llegada": parte.km_llegada or 0,
+        "km_diferencia": parte.km_diferencia or 0,
+        "repostaje": parte.repostaje or "",
+        "num_factura": parte.num_factura or "",
+        "salida_lugar": parte.salida_lugar or "",
+        "salida_hora": parte.salida_hora or "",
+        "llegada_lugar": parte.llegada_lugar or "",
+        "llegada_hora": parte.llegada_hora or "",
+        "tiempo_total": parte.tiempo_total or "",
+        "observaciones": parte.observaciones or "",
+        "dietas": parte.dietas or 0,
+        "alojamiento": parte.alojamiento or 0,
+        "transporte_billetes": parte.transporte_billetes or 0,
+        "gasolina": parte.gasolina or 0,
+        "comida": parte.comida or 0,
+        "otros_consumiciones": parte.otros_consumiciones or 0,
+        "material": parte.material or 0,
+        "otros_gastos": parte.otros_gastos or 0,
+        "num_envios": parte.num_envios or 0,
+        "horas": parte.horas or 0,
+    }
+
+def json_starlette(contenido) -> bytes:
+    # Igual que JSONResponse.render
+    return json.dumps(contenido, ensure_ascii=False, allow_nan=False, indent=None, separators=(",", ":")).encode("utf-8")
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    partes = crear_partes(n)
+    lista = TypeAdapter(List[ParteDetalle])
+
+    casos = {
+        "dict a mano + jsonable_encoder + json": lambda: json_starlette(jsonable_encoder([dict_a_mano(p) for p in partes])),
+        "pydantic + json": lambda: json_starlette(lista.dump_python([ParteDetalle.model_validate(p) for p in partes], mode="json")),
+    }
+    if orjson is not None:
+        casos["pydantic + orjson"] = lambda: orjson.dumps(lista.dump_python([ParteDetalle.model_validate(p) for p in partes], mode="json"))
+    else:
+        print("⚠️  orjson no está instalado: se omite el caso con orjson")
+
+    # Las tres variantes deben producir el mismo JSON
+    referencia = json.loads(list(casos.values())[0]())
+    for nombre, funcion in casos.items():
+        assert json.loads(funcion()) == referencia, f"{nombre} produce otro resultado"
+
+    print(f"📊 Serialización de {n} partes (mejor de 5 repeticiones)")
+    base = None
+    for nombre, funcion in casos.items():
+        repeticiones = max(1, 20000 // n)
+        mejor = min(timeit.repeat(funcion, number=repeticiones, repeat=5)) / repeticiones
+        por_parte = mejor / n * 1e6
+        base = base or por_parte
+        print(f"  {nombre:<40} {por_parte:7.2f} µs/parte   x{base / por_parte:4.1f}")
+
+if __name__ == "__main__":
+    main()
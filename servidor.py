@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+"""
+Servidor de producción: varios workers de uvicorn gestionados por gunicorn.
+
+- WEB_CONCURRENCY workers (por defecto, uno por CPU), con la aplicación
+  precargada en el proceso maestro.
+- Las tablas se preparan una sola vez, en el maestro, antes de arrancar los
+  workers (init_db() borra y crea las tablas: no puede ejecutarse en cada worker).
+- Cada worker se recicla tras MAX_PETICIONES peticiones o si su memoria pasa de
+  MEMORIA_MAX_MB. Al reciclar o parar se espera a que terminen las peticiones en
+  curso (exportaciones incluidas) hasta TIEMPO_APAGADO segundos.
+
+Uso: python servidor.py   (escucha en 0.0.0.0:$PORT)
+"""
+
+import logging
+import os
+import signal
+import sys
+import threading
+import time
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).parent))
+
+log = logging.getLogger("servidor")
+
+WORKERS = int(os.getenv("WEB_CONCURRENCY", str(os.cpu_count() or 1)))
+MAX_PETICIONES = int(os.getenv("MAX_PETICIONES", "2000"))
+MEMORIA_MAX_MB = int(os.getenv("MEMORIA_MAX_MB", "512"))  # 0 = sin límite
+TIEMPO_APAGADO = int(os.getenv("TIEMPO_APAGADO", "120"))
+INTERVALO_MEMORIA = 10
+
+def memoria_mb() -> float:
+    """Memoria residente del proceso actual"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20
+    except OSError:
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+def inicializar_bd():
+    """Prepara la base de datos una vez y avisa a los workers de que ya está hecho"""
+    from app.main import init_db
+    init_db()
+    os.environ["BD_INICIALIZADA"] = "1"
+
+def tras_fork():
+    # Las conexiones que abrió el maestro no se comparten con los workers
+    from app.main import engine, engine_lectura
+    engine.dispose(close=False)
+    engine_lectura.dispose(close=False)
+
+def vigilar_memoria():
+    """En cada worker: si crece por encima del límite se pide a sí mismo un apagado
+    ordenado (SIGTERM) y gunicorn arranca otro en su lugar"""
+    def bucle():
+        while True:
+            time.sleep(INTERVALO_MEMORIA)
+            mb = memoria_mb()
+            if mb > MEMORIA_MAX_MB:
+                log.warning("Worker %s usa %.0f MB (límite %s MB): reciclando", os.getpid(), mb, MEMORIA_MAX_MB)
+                os.kill(os.getpid(), signal.SIGTERM)
+                return
+    threading.Thread(target=bucle, name="vigilar-memoria", daemon=True).start()
+
+def con_gunicorn(host: str, port: int):
+    from gunicorn.app.base import BaseApplication
+
+    class Aplicacion(BaseApplication):
+        def load_config(self):
+            ajustes = {
+                "bind": f"{host}:{port}",
+                "workers": WORKERS,
+                "worker_class": "uvicorn.workers.UvicornWorker",
+                "preload_app": True,
+                "max_requests": MAX_PETICIONES,
+                "max_requests_jitter": MAX_PETICIONES // 10,
+                "graceful_timeout": TIEMPO_APAGADO,
+                "timeout": TIEMPO_APAGADO,
+                "keepalive": 5,
+                "accesslog": "-",
+                "on_starting": lambda arbiter: inicializar_bd(),
+                "post_fork": lambda arbiter, worker: tras_fork(),
+                "post_worker_init": lambda worker: vigilar_memoria() if MEMORIA_MAX_MB else None,
+            }
+            for clave, valor in ajustes.items():
+                self.cfg.set(clave, valor)
+
+        def load(self):
+            from app.main import app
+            return app
+
+    Aplicacion().run()
+
+def con_uvicorn(host: str, port: int):
+    """Sin gunicorn (p. ej. en Windows): varios workers, pero sin reciclado"""
+    import uvicorn
+    log.warning("gunicorn no está instalado: se usa uvicorn --workers sin reciclado de workers")
+    inicializar_bd()
+    uvicorn.run(
+        "app.main:app",
+        host=host,
+        port=port,
+        workers=WORKERS,
+        timeout_graceful_shutdown=TIEMPO_APAGADO,
+    )
+
+def main():
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(name)s %(levelname)s %(message)s")
+    host = os.getenv("HOST", "0.0.0.0")
+    port = int(os.getenv("PORT", "8000"))
+    try:
+        import gunicorn  # noqa: F401
+    except ImportError:
+        con_uvicorn(host, port)
+    else:
+        con_gunicorn(host, port)
+
+if __name__ == "__main__":
+    main()
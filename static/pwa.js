@@ -0,0 +1,48 @@
+// Registro del service worker y precarga de meses del calendario del repartidor
+
+(function () {
+  if (!('serviceWorker' in navigator)) {
+    return;
+  }
+
+  function urlMes(año, mes) {
+    return '/repartidor?año=' + año + '&mes=' + mes;
+  }
+
+  // Igual que claveMes() en sw.js
+  function claveMes(url) {
+    const año = url.searchParams.get('año');
+    const mes = url.searchParams.get('mes');
+    return año && mes ? urlMes(año, mes) : '/repartidor';
+  }
+
+  function mesesContiguos() {
+    const datos = document.getElementById('calendario-mes');
+    if (!datos) {
+      return [];
+    }
+    const año = parseInt(datos.dataset.anio, 10);
+    const mes = parseInt(datos.dataset.mes, 10);
+    const anterior = mes === 1 ? [año - 1, 12] : [año, mes - 1];
+    const siguiente = mes === 12 ? [año + 1, 1] : [año, mes + 1];
+    return [urlMes(anterior[0], anterior[1]), urlMes(siguiente[0], siguiente[1])];
+  }
+
+  navigator.serviceWorker.register('/sw.js', { scope: '/' }).catch(function (error) {
+    console.error('No se pudo registrar el service worker:', error);
+  });
+
+  // Si el servidor tenía una versión más nueva del mes que estamos viendo, recargar
+  navigator.serviceWorker.addEventListener('message', function (event) {
+    const datos = event.data || {};
+    if (datos.tipo === 'mes-actualizado' && datos.url === claveMes(new URL(location.href))) {
+      location.reload();
+    }
+  });
+
+  navigator.serviceWorker.ready.then(function (registro) {
+    if (registro.active) {
+      registro.active.postMessage({ tipo: 'precargar', urls: mesesContiguos() });
+    }
+  });
+})();
@@ -0,0 +1,201 @@
+// Service worker del panel del repartidor (modo PWA)
+//
+// - App shell (CSS y scripts) en Cache Storage, servidos desde caché.
+// - Meses del calendario (/repartidor?año=&mes=) en IndexedDB: se muestran al
+//   instante desde local y se revalidan en segundo plano con If-None-Match.
+// - Cualquier escritura (POST/PUT/DELETE) o el logout vacían los meses guardados.
+
+const VERSION_SHELL = 'fichajes-shell-v1';
+const APP_SHELL = [
+  '/static/style.css',
+  '/static/pwa.js',
+  '/static/manifest.webmanifest',
+];
+
+const DB_NOMBRE = 'fichajes';
+const DB_STORE = 'meses';
+const MAX_MESES = 12;
+
+// ---------------------------------------------------------------------------
+// IndexedDB
+
+function abrirDB() {
+  return new Promise((resolve, reject) => {
+    const req = indexedDB.open(DB_NOMBRE, 1);
+    req.onupgradeneeded = () => {
+      req.result.createObjectStore(DB_STORE, { keyPath: 'url' });
+    };
+    req.onsuccess = () => resolve(req.result);
+    req.onerror = () => reject(req.error);
+  });
+}
+
+async function operacionDB(modo, fn) {
+  const db = await abrirDB();
+  return new Promise((resolve, reject) => {
+    const tx = db.transaction(DB_STORE, modo);
+    const resultado = fn(tx.objectStore(DB_STORE));
+    tx.oncomplete = () => resolve(resultado && resultado.result);
+    tx.onerror = () => reject(tx.error);
+  });
+}
+
+const leerMes = (url) => operacionDB('readonly', (store) => store.get(url));
+const vaciarMeses = () => operacionDB('readwrite', (store) => store.clear());
+
+async function guardarMes(entrada) {
+  await operacionDB('readwrite', (store) => store.put(entrada));
+  // Conservar solo los meses vistos más recientemente
+  const todas = await operacionDB('readonly', (store) => store.getAll());
+  if (todas.length > MAX_MESES) {
+    todas.sort((a, b) => a.visto - b.visto);
+    const sobrantes = todas.slice(0, todas.length - MAX_MESES);
+    await operacionDB('readwrite', (store) => sobrantes.forEach((e) => store.delete(e.url)));
+  }
+}
+
+// ---------------------------------------------------------------------------
+// Ciclo de vida
+
+self.addEventListener('install', (event) => {
+  event.waitUntil(
+    caches.open(VERSION_SHELL).then((cache) => cache.addAll(APP_SHELL)).then(() => self.skipWaiting())
+  );
+});
+
+self.addEventListener('activate', (event) => {
+  event.waitUntil(
+    caches.keys()
+      .then((nombres) => Promise.all(nombres.filter((n) => n !== VERSION_SHELL).map((n) => caches.delete(n))))
+      .then(() => self.clients.claim())
+  );
+});
+
+// ---------------------------------------------------------------------------
+// Peticiones
+
+function esMesCalendario(url) {
+  return url.origin === self.location.origin && url.pathname === '/repartidor';
+}
+
+// Misma clave para /repartidor?mes=5&a%C3%B1o=2025 (formulario) y /repartidor?año=2025&mes=5 (precarga)
+function claveMes(url) {
+  const año = url.searchParams.get('año');
+  const mes = url.searchParams.get('mes');
+  return año && mes ? '/repartidor?año=' + año + '&mes=' + mes : '/repartidor';
+}
+
+function sePuedeGuardar(response) {
+  // El servidor marca con no-store las páginas que llevan mensajes flash
+  return response.ok && !(response.headers.get('Cache-Control') || '').includes('no-store');
+}
+
+async function avisarClientes(url) {
+  const clientes = await self.clients.matchAll({ type: 'window' });
+  clientes.forEach((c) => c.postMessage({ tipo: 'mes-actualizado', url }));
+}
+
+async function descargarMes(url, entrada) {
+  const headers = {};
+  if (entrada && entrada.etag) {
+    headers['If-None-Match'] = entrada.etag;
+  }
+  const response = await fetch(url, { headers, credentials: 'same-origin', cache: 'no-store' });
+  if (response.status === 304 && entrada) {
+    entrada.visto = Date.now();
+    await guardarMes(entrada);
+    return null;
+  }
+  if (sePuedeGuardar(response)) {
+    const html = await response.clone().text();
+    await guardarMes({ url, html, etag: response.headers.get('ETag'), visto: Date.now() });
+  }
+  return response;
+}
+
+function respuestaHTML(html) {
+  return new Response(html, { headers: { 'Content-Type': 'text/html; charset=utf-8' } });
+}
+
+async function servirMes(event, url) {
+  let entrada = null;
+  try {
+    entrada = await leerMes(url);
+  } catch (e) {
+    entrada = null;
+  }
+
+  if (entrada) {
+    // Stale-while-revalidate: se muestra lo guardado y se comprueba en segundo plano
+    event.waitUntil(
+      descargarMes(url, entrada)
+        .then((nueva) => (nueva && sePuedeGuardar(nueva) ? avisarClientes(url) : null))
+        .catch(() => null)
+    );
+    return respuestaHTML(entrada.html);
+  }
+
+  try {
+    const response = await descargarMes(url, null);
+    return response || fetch(event.request);
+  } catch (e) {
+    return respuestaHTML('<h2>Sin conexión</h2><p>Este mes no está disponible sin conexión todavía.</p>');
+  }
+}
+
+self.addEventListener('fetch', (event) => {
+  const request = event.request;
+  const url = new URL(request.url);
+
+  if (url.origin !== self.location.origin) {
+    return;
+  }
+
+  // Escrituras y logout invalidan los meses guardados
+  if (request.method !== 'GET' || url.pathname === '/logout') {
+    event.respondWith(
+      fetch(request).then((response) => {
+        event.waitUntil(vaciarMeses().catch(() => null));
+        return response;
+      })
+    );
+    return;
+  }
+
+  if (esMesCalendario(url) && request.headers.get('Accept') !== 'application/json') {
+    event.respondWith(servirMes(event, claveMes(url)));
+    return;
+  }
+
+  if (url.pathname.startsWith('/static/')) {
+    event.respondWith(
+      caches.open(VERSION_SHELL).then(async (cache) => {
+        const guardada = await cache.match(request);
+        const red = fetch(request)
+          .then((response) => {
+            if (response.ok) {
+              cache.put(request, response.clone());
+            }
+            return response;
+          })
+          .catch(() => guardada);
+        if (guardada) {
+          event.waitUntil(red);
+          return guardada;
+        }
+        return red;
+      })
+    );
+  }
+});
+
+// La página pide precargar meses (los contiguos al que se está viendo)
+self.addEventListener('message', (event) => {
+  const datos = event.data || {};
+  if (datos.tipo === 'precargar' && Array.isArray(datos.urls)) {
+    event.waitUntil(Promise.all(datos.urls.map(async (url) => {
+      const entrada = await leerMes(url).catch(() => null);
+      return descargarMes(url, entrada).catch(() => null);
+    })));
+  }
+});
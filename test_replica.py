@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+"""
+Prueba de la réplica de lectura (READ_DATABASE_URL): un segundo fichero SQLite
+hace de réplica. Se "replica" copiando el primario en un momento dado y después
+se escribe solo en el primario, así se ve de qué base lee cada ruta.
+
+    python -m pytest test_replica.py
+"""
+
+import io, os, sqlite3, sys, tempfile
+from pathlib import Path
+
+import openpyxl
+import pytest
+
+if "app.main" in sys.modules:
+    pytest.skip("app.main ya está importada con otra base de datos", allow_module_level=True)
+
+_DIRECTORIO = Path(tempfile.mkdtemp(prefix="replica_"))
+PRIMARIO = _DIRECTORIO / "primario.db"
+REPLICA = _DIRECTORIO / "replica.db"
+os.environ["DATABASE_URL"] = f"sqlite:///{PRIMARIO}"
+os.environ["READ_DATABASE_URL"] = f"sqlite:///{REPLICA}"
+os.environ["ARCHIVO_DIR"] = str(_DIRECTORIO / "archivo")
+
+from fastapi.testclient import TestClient
+from app.main import app, engine, engine_lectura
+
+DESDE, HASTA = "2026-03-01", "2026-03-31"
+
+def replicar():
+    """La réplica se pone al día con el primario"""
+    origen, destino = sqlite3.connect(PRIMARIO), sqlite3.connect(REPLICA)
+    try:
+        origen.backup(destino)
+    finally:
+        origen.close()
+        destino.close()
+
+def contar(fichero: Path, tabla: str) -> int:
+    conexion = sqlite3.connect(fichero)
+    try:
+        return conexion.execute(f'SELECT COUNT(*) FROM "{tabla}"').fetchone()[0]
+    finally:
+        conexion.close()
+
+def guardar_parte(cliente: TestClient, fecha: str):
+    respuesta = cliente.post("/repartidor/parte", data={
+        "fecha": fecha, "km_salida": 100, "km_llegada": 150, "km_diferencia": 50,
+        "num_envios": 3, "horas": 8, "dietas": 10, "rutas_json": "[]",
+    }, follow_redirects=False)
+    assert respuesta.status_code == 302
+
+@pytest.fixture(scope="module")
+def clientes():
+    with TestClient(app) as c:
+        replicar()  # tablas recién creadas
+        c.post("/register", data={"company": "ACME", "company_key": "k1", "username": "jefe", "password": "x", "role": "admin"}, follow_redirects=False)
+        c.post("/register", data={"company": "ACME", "company_key": "k1", "username": "pepe", "password": "x", "role": "repartidor"}, follow_redirects=False)
+        admin, repartidor = TestClient(app), TestClient(app)
+        admin.post("/login", data={"company": "ACME", "username": "jefe", "password": "x"})
+        repartidor.post("/login", data={"company": "ACME", "username": "pepe", "password": "x"})
+
+        # Un parte replicado y otro que la réplica todavía no tiene
+        guardar_parte(repartidor, "2026-03-02")
+        replicar()
+        guardar_parte(repartidor, "2026-03-09")
+        yield admin, repartidor
+
+def test_motores_distintos():
+    assert engine_lectura is not engine
+    assert str(engine.url).endswith("primario.db") and str(engine_lectura.url).endswith("replica.db")
+
+def test_escrituras_en_el_primario(clientes):
+    assert contar(PRIMARIO, "partedia") == 2
+    assert contar(REPLICA, "partedia") == 1
+
+def test_panel_lee_de_la_replica(clientes):
+    admin, _ = clientes
+    html = admin.get(f"/admin?desde={DESDE}&hasta={HASTA}").text
+    assert "02/03/2026" in html
+    assert "09/03/2026" not in html
+
+def test_kpis_leen_de_la_replica(clientes):
+    admin, _ = clientes
+    assert admin.get(f"/admin/kpis?desde={DESDE}&hasta={HASTA}").json()["partes"] == 1
+    serie = admin.get(f"/admin/kpis/serie?desde={DESDE}&hasta={HASTA}").json()
+    assert sum(p["partes"] for p in (serie["puntos"] if isinstance(serie, dict) else serie)) == 1
+
+def test_analitica_lee_de_la_replica(clientes):
+    admin, _ = clientes
+    assert admin.get(f"/admin/analytics?desde={DESDE}&hasta={HASTA}").json()["partes"] == 1
+
+def test_exportacion_lee_de_la_replica(clientes):
+    admin, _ = clientes
+    excel = admin.get(f"/admin/export/excel?desde={DESDE}&hasta={HASTA}")
+    assert excel.status_code == 200
+    filas = list(openpyxl.load_workbook(io.BytesIO(excel.content)).active.iter_rows(values_only=True))
+    fechas = [str(v) for fila in filas for v in fila if v is not None]
+    assert any("02/03/2026" in v or "2026-03-02" in v for v in fechas)
+    assert not any("09/03/2026" in v or "2026-03-09" in v for v in fechas)
+
+def test_autenticacion_en_el_primario(clientes):
+    # Un usuario que la réplica no tiene puede registrarse y entrar
+    c = TestClient(app)  # sin `with`: el arranque volvería a crear las tablas
+    c.post("/register", data={"company": "ACME", "company_key": "k1", "username": "ana", "password": "x", "role": "repartidor"}, follow_redirects=False)
+    respuesta = c.post("/login", data={"company": "ACME", "username": "ana", "password": "x"}, follow_redirects=False)
+    assert respuesta.status_code in (302, 303)
+    assert c.get("/repartidor", follow_redirects=False).status_code == 200
+    assert contar(REPLICA, "user") == 2
+
+def test_repartidor_lee_lo_propio_del_primario(clientes):
+    _, repartidor = clientes
+    dias = repartidor.get("/api/partes-dia/2026-03-09").json()
+    assert len(dias) == 1